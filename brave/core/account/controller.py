@@ -451,10 +451,8 @@ class AccountController(Controller):
 
         user = User.objects(id=user).first()
         # We only show enabled bans in the search window to users without permission
-        for b in user.person.bans:
-            if b.enabled:
-                bans.append(b)
-                continue
+        for b in user.person.active_bans:
+            bans.append(b)
 
         return 'brave.core.account.template.banned', dict(
                 success = True,
@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 from mongoengine import Document, StringField, EmailField, DateTimeField, BooleanField, ReferenceField, ListField
 from mongoengine.fields import LongField
 
+from brave.core.util.cache import CacheVersion
 from brave.core.util.signal import update_modified_timestamp
 from brave.core.util.field import PasswordField, IPAddressField
 
@@ -45,8 +46,6 @@ class User(Document):
     other_accs_char_key = ListField(ReferenceField('User'), db_field='otherAccountsCharKey')
     other_accs_IP = ListField(ReferenceField('User'), db_field='otherAccountsIP')
 
-    _permission_cache = list()
-
     # Permissions
     VIEW_PERM = 'core.account.view.{account_id}'
 
@@ -136,11 +135,15 @@ class User(Document):
         LoginHistory.objects(user=other).update(set__user=self)
 
         from brave.core.group.model import Group
-        from brave.core.application.model import Application, ApplicationGrant
+        from brave.core.application.model import Application, ApplicationGrant, APPLICATION_CACHE_VERSION, \
+            GRANT_CACHE_VERSION
 
+        # Updated directly, so the save signals don't invalidate cached copies of the applications and grants.
         Group.objects(creator=other).update(set__creator=self)
         Application.objects(owner=other).update(set__owner=self)
+        CacheVersion.bump(APPLICATION_CACHE_VERSION)
         ApplicationGrant.objects(user=other).update(set__user=self)
+        CacheVersion.bump(GRANT_CACHE_VERSION)
 
         other.delete()
 
@@ -175,14 +178,9 @@ class User(Document):
         if not self.primary:
             return perms
 
-        bef = datetime.utcnow()
-        per = self.primary.permissions()
-        aft = datetime.utcnow()
-        print "Primary Character {0} permissions took {1}".format(self.primary.name, aft - bef)
-        for p in per:
+        for p in self.primary.permissions():
             perms.add(p)
 
-        print "-----"
         perms = list(perms)
         perms.sort(key=lambda p: p.id)
 
@@ -195,14 +193,9 @@ class User(Document):
         perms = set()
 
         for c in self.characters:
-            bef = datetime.utcnow()
-            per = c.permissions()
-            aft = datetime.utcnow()
-            print "Character {0} permissions took {1}".format(c.name, aft - bef)
-            for p in per:
+            for p in c.permissions():
                 perms.add(p)
 
-        print "-----"
         perms = list(perms)
         perms.sort(key=lambda p: p.id)
 
@@ -219,51 +212,30 @@ class User(Document):
 
         log.debug('Checking if user has permission {0}'.format(permission))
 
-        bef = datetime.utcnow()
-        primary_perms = self.primary_permissions
-        aft = datetime.utcnow()
-        print "Primary Character Permissions took {}".format(aft - bef)
-
-        rbef = datetime.utcnow()
-        res = Permission.set_grants_permission(primary_perms, permission)
-        raft = datetime.utcnow()
-        print "SET GRANTS PERM took {}".format(raft - rbef)
-
-        if res:
-            return res;
-        else:
-
-            log.debug('PRIMARY CHARACTER DOES NOT HAVE PERMISSION, CHECKING OTHER CHARACTERS {0}'.format(permission))
-
-            bef = datetime.utcnow()
-            perms = self.permissions
-            aft = datetime.utcnow()
-            print "Permissions took {}".format(aft - bef)
+        if self.primary and self.primary.has_permission(permission):
+            return True
 
-            rbef = datetime.utcnow()
-            res = Permission.set_grants_permission(perms, permission)
-            raft = datetime.utcnow()
-            print "SET GRANTS PERM took {}".format(raft - rbef)
+        log.debug('PRIMARY CHARACTER DOES NOT HAVE PERMISSION, CHECKING OTHER CHARACTERS {0}'.format(permission))
 
-            return res
+        return any(c.has_permission(permission) for c in self.characters)
 
     def has_any_permission(self, permission):
         """Returns true if the character has a permission that would be granted by permission."""
-        from brave.core.permission.model import WildcardPermission
 
-        p = WildcardPermission.objects(id=permission)
-        if len(p):
-            p = p.first()
-        else:
-            p = WildcardPermission(id=permission)
-        for permID in self.permissions:
-            if p.grants_permission(permID.id):
-                return True
-            if permID.grants_permission(p.id):
+        for c in self.characters:
+            matcher = c.permission_matcher()
+            if matcher.granted_by(permission) or matcher.grants(permission):
                 return True
 
         return False
 
+    @property
+    def permission_matcher(self):
+        """Returns a PermissionMatcher over all permissions that any character this user owns has."""
+        from brave.core.permission.matcher import PermissionMatcher
+
+        return PermissionMatcher(self.permissions)
+
     @staticmethod
     def add_duplicate(acc, other, IP=False):
         """Marks other as a duplicate account to this account.
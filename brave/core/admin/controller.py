@@ -11,6 +11,9 @@ from brave.core.character.model import EVECharacter, EVECorporation, \
 from brave.core.util.predicate import is_administrator
 from brave.core.key.model import EVECredential
 from brave.core.account.model import User
+from brave.core.group.model import GroupMembership
+from brave.core.group.compiled import reference_id
+from brave.core.util.mask import MaskIndex
 from brave.core.permission.util import user_has_permission, \
     user_has_any_permission
 
@@ -62,10 +65,8 @@ class SearchCharInterface(HTTPMethod):
 
         # Limit to characters in the specified group.
         if group:
-            groupList = []
-            for c in chars:
-                if group in c.tags:
-                    groupList.append(c.id)
+            members = GroupMembership.objects(group=group).no_dereference()
+            groupList = [reference_id(c) for c in members.scalar('character')]
 
             chars = chars.filter(id__in=groupList)
 
@@ -78,7 +79,8 @@ class SearchKeyInterface(HTTPMethod):
     """Handles /admin/search/key"""
 
     @user_has_permission('core.admin.search.key')
-    def get(self, keyID=None, keyMask=None, violation=None, submit=None):
+    def get(self, keyID=None, keyMask=None, maskMethod=None, violation=None,
+            submit=None):
 
         # Have to be an admin to access admin pages.
         if not is_administrator:
@@ -94,9 +96,13 @@ class SearchKeyInterface(HTTPMethod):
         if keyID:
             keys = keys.filter(key=keyID)
 
-        # Limit to keys with the specified Mask.
+        # Limit to keys with the specified Mask, or able to satisfy it.
         if keyMask:
-            keys = keys.filter(_mask=keyMask)
+            if maskMethod == 'satisfies':
+                index = MaskIndex.from_credentials(keys)
+                keys = keys.filter(_mask__in=list(index.matching(int(keyMask))))
+            else:
+                keys = keys.filter(_mask=keyMask)
 
         # Limit to keys with the specified violation.
         if violation.lower() == "none":
@@ -15,7 +15,7 @@ from marrow.util.object import load_object as load
 from marrow.util.convert import boolean
 
 from brave.core.api.model import AuthenticationBlacklist, AuthenticationRequest
-from brave.core.api.util import SignedController
+from brave.core.api.util import SignedController, services
 from brave.core.util.eve import EVECharacterKeyMask, api
 from brave.core.permission.model import create_permission
 
@@ -180,8 +180,11 @@ class CoreAPI(SignedController):
 
     def deauthorize(self, token):
         from brave.core.application.model import ApplicationGrant
-        count = ApplicationGrant.objects(id=token,
-                                         application=request.service).delete()
+        grants = ApplicationGrant.objects(id=token, application=request.service)
+        count = grants.count()
+
+        # Deleting runs each grant's delete signals, which invalidate cached copies, and so doesn't return a count.
+        grants.delete()
         return dict(success=bool(count))
 
     def reauthorize(self, token, success=None, failure=None):
@@ -190,21 +193,17 @@ class CoreAPI(SignedController):
         return self.authorize(success=success, failure=failure)
 
     def info(self, token):
-        from brave.core.application.model import ApplicationGrant
-        from brave.core.group.model import Group
-
         # Step 1: Get the appropriate grant.
-        try:
-            token = ApplicationGrant.objects.get(id=token,
-                                                 application=request.service)
-        except ApplicationGrant.DoesNotExist:
+        token, banned = services.grant(request.service, token)
+
+        if token is None:
             return dict(
                 success=False,
                 reason='grant.invalid',
                 message="Your token is not valid, please genereate a new one."
             )
 
-        if token.user.person.banned(app=token.application.short):
+        if banned:
             return dict(
                 success=False,
                 reason='user.banned',
@@ -213,6 +212,19 @@ class CoreAPI(SignedController):
 
         characters_info = {}
 
+        # Subarea bans apply to the user's person, and so to every character.
+        subbans = []
+
+        for b in token.user.person.active_bans:
+
+            if b.ban_type != "subapp":
+                continue
+
+            if b.app != token.application:
+                continue
+
+            subbans.append(b.subarea)
+
         # Step 2: Assemble the information for each character
         def char_info(char):
             # Ensure that this character still belongs to this user.
@@ -221,28 +233,8 @@ class CoreAPI(SignedController):
                 token.reload()
                 return None
 
-            # Match ACLs.
-            tags = []
-            groups_cache = []
-            for group in Group.objects():
-                if group.evaluate(token.user, char):
-                    tags.append(group.id)
-                    groups_cache.append(group)
-
-            subbans = []
-
-            for b in token.user.person.bans:
-
-                if not b.enabled:
-                    continue
-
-                if b.ban_type != "subapp":
-                    continue
-
-                if b.app != token.application:
-                    continue
-
-                subbans.append(b.subarea)
+            # Look up group membership in the materialized index.
+            tags = [group.id for group in char.groups]
 
             return dict(
                 character=dict(id=char.identifier, name=char.name),
@@ -252,8 +244,7 @@ class CoreAPI(SignedController):
                     dict(id=char.alliance.identifier, name=char.alliance.name)
                     if char.alliance else None),
                 tags=tags,
-                perms=char.permissions_tags(token.application,
-                                            groups_cache=groups_cache),
+                perms=char.permissions_tags(token.application),
                 expires=None,
                 mask=token.mask.mask if token.mask else 0,
                 subbans=subbans
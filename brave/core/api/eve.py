@@ -7,24 +7,55 @@ from operator import __or__
 from web.core import request, response, url, config
 from web.auth import user
 from mongoengine import Q
+from bson import ObjectId
 from marrow.util.url import URL
 from marrow.util.object import load_object as load
 from marrow.util.convert import boolean
 
 from brave.core.application.model import Application
-from brave.core.api.model import AuthenticationBlacklist, AuthenticationRequest
+from brave.core.api.model import AuthenticationBlacklist, AuthenticationRequest, ProxyJob
 from brave.core.api.util import SignedController
 from brave.core.util.eve import api
-from brave.core.character.model import EVECharacter
+from brave.core.api.proxy import pipeline, ProxyError
 
 log = __import__('logging').getLogger(__name__)
 
 
 class ProxyAPI(SignedController):
-    def __default__(self, group, endpoint, token=None, anonymous=None, **kw):
-        from brave.core.application.model import ApplicationGrant
-
+    def stats(self):
+        """Report the calling application's proxied requests by endpoint and outcome: answered from the cache, made
+        upstream, refused for exceeding the application's quota, or failed."""
+        
+        return dict(success=True, stats=pipeline.stats(request.service).get(request.service.short, {}))
+    
+    def job(self, job):
+        """Poll a deferred call, returning its result once it has been made."""
+        
+        job = ProxyJob.objects(id=job, application=request.service).first() if ObjectId.is_valid(job) else None
+        
+        if not job:
+            return dict(success=False, reason='job.invalid', message="Unknown or expired job.")
+        
+        if job.state == 'failed':
+            return dict(success=False, reason='eve.unknown',
+                        message="Encountered unexpected error during EVE API call.",
+                        detail=job.error)
+        
+        if job.state != 'done':
+            return dict(success=True, deferred=True, job=unicode(job.id), state=job.state)
+        
+        result = job.result
+        result.update(success=True)
+        return result
+    
+    def __default__(self, group, endpoint, token=None, anonymous=None, defer=None, **kw):
+        """Make an EVE API call on behalf of the application.
+        
+        If defer is true, a call which can't be answered from the cache is made in the background and a job
+        identifier returned to poll for its result; see job()."""
+        
         anonymous = None if anonymous is None else boolean(anonymous)
+        defer = boolean(defer) if defer is not None else False
 
         log.info(
             "service={0!r} group={1} endpoint={2} token={3} anonymous={4} data={5}".format(
@@ -38,17 +69,9 @@ class ProxyAPI(SignedController):
                             group, endpoint))
 
         try:  # Get the appropriate grant.
-            token = ApplicationGrant.objects.get(id=token,
-                                                 application=request.service) if token else None
-        except ApplicationGrant.DoesNotExist:
-            return dict(success=False, reason='grant.invalid',
-                        message="Application grant invalid or expired.")
-
-        if token and token.user.person.banned(app=token.application.short):
-            return dict(
-                success=False,
-                message="This user has been banned from accessing this application."
-            )
+            token = pipeline.grant(request.service, token) if token else None
+        except ProxyError as e:
+            return e.response()
 
         try:  # Load the API endpoint.
             call = getattr(getattr(api, group, None), endpoint)
@@ -68,28 +91,24 @@ class ProxyAPI(SignedController):
                                 group, endpoint))
 
             if call.name.startswith('char'):
-                try:
-                    character = EVECharacter.objects.get(
-                        identifier=kw['characterID'])
-                except KeyError:
-                    if len(token.characters) == 1:
-                        character = token.characters[0]
-                    else:
-                        return dict(success=False,
-                                    reason='character.notspecified',
-                                    message="Must pass a characterID parameter")
-                except EVECharacter.DoesNotExist:
-                    return dict(success=False, reason='character.notfound',
-                                message="Could not find a character with that identifier")
                 # Find an appropriate key to use for this request if one is required or anonymous=False.
-                key = character.credential_for(call.mask)
-                if not key:
-                    return dict(success=False, reason='key.notfound',
-                                message="Could not find EVE API key that authorizes endpoint: {0}.{1}".format(
-                                    group, endpoint))
-
-        try:  # Perform the query or get the cached result.
-            result = call(key, **kw) if key else call(**kw)
+                try:
+                    key = pipeline.credential(request.service, token, call, kw.get('characterID'))
+                except ProxyError as e:
+                    return e.response()
+
+        try:  # Perform the query (or queue it) or get the cached result.
+            if defer:
+                result, job = pipeline.defer(request.service, call, key, **kw)
+                
+                if job:
+                    return dict(success=True, deferred=True, job=unicode(job.id), state=job.state)
+            
+            else:
+                result = pipeline.call(request.service, call, key, **kw)
+        
+        except ProxyError as e:
+            return e.response()
         except Exception as e:
             log.exception("Unable to process request.")
             return dict(success=False, reason='eve.unknown',
@@ -16,7 +16,7 @@ from marrow.util.bunch import Bunch
 from brave.core.util.eve import api
 from brave.core.api.util import SignedController
 from brave.core.character.model import EVEEntity, EVEAlliance, EVECorporation, EVECharacter
-from web.core import cache
+from brave.core.util.cache import LRUCache, CacheVersion
 
 
 log = __import__('logging').getLogger(__name__)
@@ -24,6 +24,27 @@ log = __import__('logging').getLogger(__name__)
 
 _mapping = dict(identifier='id')
 
+# Lookup results by (class, search, fields), each stamped with the versions of the entity classes it was built from.
+lookup_cache = LRUCache(4096, 300)
+
+# The entity classes whose changes can affect a lookup of each class, because the result names them.
+_depends = {
+        EVEAlliance: (EVEAlliance, EVECorporation),
+        EVECorporation: (EVECorporation, EVEAlliance),
+        EVECharacter: (EVECharacter, EVECorporation, EVEAlliance),
+    }
+
+# The fields reported for each entity class.
+_fields = {
+        EVEAlliance: ['identifier', 'name', 'short', 'members', 'founded', 'corporations', 'executor'],
+        EVECorporation: ['identifier', 'name', 'short', 'members', 'founded', 'alliance'],
+        EVECharacter: ['identifier', 'name', 'race', 'bloodline', 'ancestry', 'gender', 'security', 'titles',
+                       'corporation', 'alliance'],
+    }
+
+# References to other entities, which are reported by identifier and name only.
+_references = ('executor', 'corporation', 'alliance')
+
 
 class LookupAPI(SignedController):
     def _only(self, data, only):
@@ -31,43 +52,131 @@ class LookupAPI(SignedController):
         only = only if isinstance(only, list) else [only]
         return dict({k: v for k, v in data.iteritems() if k == 'success' or k in only})
     
-    def _lookup(self, cls, search, fields):
-        #@cache.cache('api.lookup', expires=300)  # five minute expiry
-        def inner(cls, search):
-            record = cls.get(search)
-            if not record: return dict(success=False, message="No matching record found.")
+    @staticmethod
+    def _searches(search):
+        """Accept a list of searches, or a comma-separated string of them, returning them without duplicates."""
+        
+        if not isinstance(search, list):
+            search = search.split(',')
+        
+        searches = []
+        for item in (i.strip() for i in search):
+            if item and item not in searches:
+                searches.append(item)
+        
+        return searches
+    
+    def _lookup(self, cls, search, fields, only=None):
+        return self._lookup_many(cls, [search], fields, only)[search]
+    
+    def _lookup_many(self, cls, searches, fields, only=None):
+        """Return the lookup results for each search, fetching those not cached together."""
+        
+        if only:
+            only = only if isinstance(only, list) else [only]
+            fields = [f for f in fields if _mapping.get(f, f) in only]
+        
+        stamp = CacheVersion.stamp(*(c.cache_version() for c in _depends[cls]))
+        key = lambda search: (cls.__name__, search.lower(), tuple(fields))
+        results = dict()
+        
+        for search in searches:
+            cached = lookup_cache.get(key(search))
+            if cached is not None and cached[0] == stamp:
+                results[search] = cached[1]
+        
+        missing = [search for search in searches if search not in results]
+        if missing:
+            for search, result in self._fetch(cls, missing, fields).iteritems():
+                lookup_cache.set(key(search), (stamp, result))
+                results[search] = result
+        
+        return dict((search, Bunch(result)) for search, result in results.iteritems())
+    
+    def _fetch(self, cls, searches, fields):
+        """Look up many records, loading (and dereferencing) only what is needed to report the given fields.
+        
+        Whatever the number of searches, this takes one query for the records themselves, one to name the entities they
+        refer to, and (for alliances) one for their corporations."""
+        
+        # Corporation tickers are loaded on demand; see EVECorporation.short.
+        loaded_fields = [('_short' if f == 'short' and cls is EVECorporation else f) for f in fields if f != 'corporations']
+        records = cls.get_many(searches, fields=loaded_fields or ['identifier'])
+        
+        def process(value):
+            if hasattr(value, 'strftime'):
+                return value.strftime('%y-%m-%d %H:%M:%S')
+            if isinstance(value, list) or hasattr(value, '__iter__'):
+                return [process(i) for i in value]
+            return value
+        
+        # Name the referenced entities without loading them in full.
+        references = dict()
+        for search, record in records.iteritems():
+            refs = dict((f, record._data.get(f)) for f in fields if f in _references)
+            references[search] = dict((f, getattr(ref, 'id', ref)) for f, ref in refs.iteritems() if ref is not None)
+        
+        ids = set(i for refs in references.itervalues() for i in refs.itervalues())
+        names = dict()
+        
+        if ids:
+            names = dict((i, dict(id=identifier, name=name)) for i, identifier, name in EVEEntity.objects(
+                    id__in=list(ids)).scalar('id', 'identifier', 'name'))
+        
+        # Alliance membership, read raw so that the alliance references aren't dereferenced.
+        corporations = dict()
+        
+        if 'corporations' in fields and records:
+            for doc in EVECorporation.objects(alliance__in=[r.id for r in records.itervalues()]).only(
+                    'identifier', 'name', 'joined', 'alliance').as_pymongo():
+                corporations.setdefault(doc['alliance'], []).append(dict(
+                        id=doc.get('i'), name=doc.get('n'), joined=process(doc.get('j'))))
+        
+        results = dict()
+        
+        for search in searches:
+            record = records.get(search)
+            if not record:
+                results[search] = dict(success=False, message="No matching record found.")
+                continue
             
             result = Bunch(success=True)
             
-            def process(value):
-                if isinstance(value, EVEEntity):
-                    if cls is EVEAlliance and isinstance(value, EVECorporation):
-                        return dict(id=value.identifier, name=value.name, joined=process(value.joined))
-                    return dict(id=value.identifier, name=value.name)
-                if hasattr(value, 'strftime'):
-                    return value.strftime('%y-%m-%d %H:%M:%S')
-                if isinstance(value, list) or hasattr(value, '__iter__'):
-                    return [process(i) for i in value]
-                return value
-            
             for field in fields:
-                result[_mapping.get(field, field)] = process(getattr(record, field))
+                if field in _references:
+                    value = names.get(references[search].get(field))
+                elif field == 'corporations':
+                    value = corporations.get(record.id, [])
+                else:
+                    value = process(getattr(record, field))
+                
+                result[_mapping.get(field, field)] = value
             
-            return result
+            results[search] = result
         
-        return inner(cls, search)
+        return results
+    
+    def _batch(self, cls, search, fields, only):
+        results = self._lookup_many(cls, self._searches(search), fields, only)
+        return dict(success=True, results=dict((k, self._only(v, only)) for k, v in results.iteritems()))
     
     def alliance(self, search, only=None):
-        return self._only(self._lookup(EVEAlliance, search, [
-                'identifier', 'name', 'short', 'members', 'founded', 'corporations', 'executor'
-            ]), only)
+        return self._only(self._lookup(EVEAlliance, search, _fields[EVEAlliance], only), only)
     
     def corporation(self, search, only=None):
-        return self._only(self._lookup(EVECorporation, search, [
-                'identifier', 'name', 'short', 'members', 'founded', 'alliance'
-            ]), only)
+        return self._only(self._lookup(EVECorporation, search, _fields[EVECorporation], only), only)
     
     def character(self, search, only=None):
-        return self._only(self._lookup(EVECharacter, search, [
-                'identifier', 'name', 'race', 'bloodline', 'ancestry', 'gender', 'security', 'titles', 'corporation', 'alliance'
-            ]), only)
+        return self._only(self._lookup(EVECharacter, search, _fields[EVECharacter], only), only)
+    
+    def alliances(self, search, only=None):
+        """Look up many alliances, given as a list or comma-separated string of identifiers or names."""
+        return self._batch(EVEAlliance, search, _fields[EVEAlliance], only)
+    
+    def corporations(self, search, only=None):
+        """Look up many corporations, given as a list or comma-separated string of identifiers or names."""
+        return self._batch(EVECorporation, search, _fields[EVECorporation], only)
+    
+    def characters(self, search, only=None):
+        """Look up many characters, given as a list or comma-separated string of identifiers or names."""
+        return self._batch(EVECharacter, search, _fields[EVECharacter], only)
@@ -3,7 +3,7 @@
 from __future__ import unicode_literals
 
 from datetime import datetime, timedelta
-from mongoengine import Document, EmbeddedDocument, EmbeddedDocumentField, StringField, EmailField, URLField, DateTimeField, BooleanField, ReferenceField, ListField, IntField
+from mongoengine import Document, EmbeddedDocument, EmbeddedDocumentField, StringField, EmailField, URLField, DateTimeField, BooleanField, ReferenceField, ListField, IntField, DictField
 
 from brave.core.util.signal import update_modified_timestamp
 from brave.core.application.signal import trigger_private_key_generation
@@ -51,3 +51,29 @@ class AuthenticationRequest(Document):
     
     def __repr__(self):
         return 'AuthenticationRequest({0}, {1}, {2}, {3})'.format(self.id, self.application, self.user, self.grant)
+
+
+class ProxyJob(Document):
+    """A deferred EVE API call made through the proxy on behalf of an application, and its outcome once made."""
+    
+    meta = dict(
+            allow_inheritance = False,
+            indexes = [
+                    dict(fields=['expires'], expireAfterSeconds=0)
+                ]
+        )
+    
+    STATES = (('pending', "Pending"), ('done', "Done"), ('failed', "Failed"))
+    
+    application = ReferenceField('Application', db_field='a')
+    call = StringField(db_field='c')
+    arguments = DictField(db_field='p')
+    
+    state = StringField(db_field='s', choices=STATES, default='pending')
+    result = DictField(db_field='r')
+    error = StringField(db_field='x')
+    
+    expires = DateTimeField(db_field='e', default=lambda: datetime.utcnow() + timedelta(minutes=10))
+    
+    def __repr__(self):
+        return 'ProxyJob({0}, {1}, {2})'.format(self.id, self.call, self.state)
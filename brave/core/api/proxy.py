@@ -0,0 +1,227 @@
+# encoding: utf-8
+
+"""The request pipeline behind ProxyAPI.
+
+Proxying an EVE API call on behalf of an application takes several steps: loading the application's grant, checking
+the user isn't banned from the application, loading the character named, choosing the least-permissive key able to
+make the call, and finally making the call.  The pipeline caches what it can between requests:
+
+* The grant (and whether its user is banned) comes from the ServiceCache shared by the signed API controllers.
+* The character and key chosen for each character and call made under a grant are remembered for a short time.
+* Results come from the APICall result cache, keyed by the call, key and arguments actually used, whenever they can.
+
+Each application draws upstream calls from its own token bucket, so that one busy application can't use up the rate
+at which CCP will answer us on behalf of the others; answers from the cache are free.  Requests are tallied by
+application, endpoint, and outcome.
+
+Calls may also be deferred: rather than holding the request open while CCP answers, a ProxyJob is recorded and the call
+made on a pool of workers sharing this process's result cache and connection pool.  The application polls the job for
+the result.  Calls which can be answered from the cache are still answered straight away.
+"""
+
+from __future__ import unicode_literals
+
+from threading import Lock
+from collections import Counter
+
+from web.core import config
+from marrow.util.futures import ScalingPoolExecutor
+
+from brave.core.util.cache import LRUCache
+from brave.core.util.ratelimit import TokenBucket
+
+
+log = __import__('logging').getLogger(__name__)
+
+
+class ProxyError(Exception):
+    """A proxied call can't be made; carries the reason and message returned to the application."""
+
+    def __init__(self, reason, message):
+        super(ProxyError, self).__init__(message)
+        self.reason = reason
+        self.message = message
+
+    def response(self):
+        result = dict(success=False, message=self.message)
+
+        if self.reason:
+            result['reason'] = self.reason
+
+        return result
+
+
+class ProxyPipeline(object):
+    """Resolves, rate limits, and answers proxied EVE API calls for applications."""
+
+    def __init__(self, ttl=30, maxsize=4096):
+        self.credentials = LRUCache(maxsize, ttl)
+        self.quotas = dict()
+        self.counters = dict()
+        self._executor = None
+        self._lock = Lock()
+
+    def quota(self, application):
+        """Return the token bucket upstream calls made for the given application are drawn from."""
+
+        with self._lock:
+            bucket = self.quotas.get(application.id)
+
+            if bucket is None:
+                bucket = self.quotas[application.id] = TokenBucket(
+                        float(config.get('core.proxy.rate', 5)),
+                        float(config.get('core.proxy.burst', 30))
+                    )
+
+            return bucket
+
+    def count(self, application, endpoint, outcome):
+        with self._lock:
+            self.counters.setdefault(application.short, Counter())[(endpoint, outcome)] += 1
+
+    def stats(self, application=None):
+        """Return the request counts of the given application, or of every application, by endpoint and outcome."""
+
+        with self._lock:
+            counters = dict((short, Counter(counts)) for short, counts in self.counters.iteritems()
+                            if application is None or short == application.short)
+
+        result = dict()
+        for short, counts in counters.iteritems():
+            endpoints = result[short] = dict()
+            for (endpoint, outcome), n in counts.iteritems():
+                endpoints.setdefault(endpoint, dict())[outcome] = n
+
+        return result
+
+    def grant(self, application, token):
+        """Return the given grant of the application, or raise ProxyError if it is invalid or its user banned."""
+
+        from brave.core.api.util import services
+
+        grant, banned = services.grant(application, token)
+
+        if grant is None:
+            raise ProxyError('grant.invalid', "Application grant invalid or expired.")
+
+        if banned:
+            raise ProxyError(None, "This user has been banned from accessing this application.")
+
+        return grant
+
+    def credential(self, application, grant, call, character=None):
+        """Return the key to make the given call with for the given character (an identifier), or the grant's only
+        character if none is given, raising ProxyError if there isn't one."""
+
+        from brave.core.character.model import EVECharacter
+
+        key = (application.id, grant.id if grant else None, character, call.name)
+        credential = self.credentials.get(key)
+
+        if credential is not None:
+            return credential
+
+        if character is not None:
+            try:
+                character = EVECharacter.objects.get(identifier=character)
+            except EVECharacter.DoesNotExist:
+                raise ProxyError('character.notfound', "Could not find a character with that identifier")
+
+        elif grant and len(grant.characters) == 1:
+            character = grant.characters[0]
+
+        else:
+            raise ProxyError('character.notspecified', "Must pass a characterID parameter")
+
+        # Find an appropriate key to use for this request.
+        credential = character.credential_for(call.mask)
+
+        if not credential:
+            raise ProxyError('key.notfound', "Could not find EVE API key that authorizes endpoint: {0}".format(
+                    call.name))
+
+        return self.credentials.set(key, credential)
+
+    def cached(self, application, call, credential, **kw):
+        """Return the result of the call from the in-process or database result cache, or None if it has to be made."""
+
+        result = call.cached(*((credential, ) if credential else ()), **kw)
+
+        if result is not None:
+            self.count(application, call.name, 'cached')
+
+        return result
+
+    def spend(self, application, call):
+        """Charge an upstream call to the application's quota, raising ProxyError if it has been used up."""
+
+        quota = self.quota(application)
+
+        if not quota.try_acquire():
+            self.count(application, call.name, 'throttled')
+            raise ProxyError('quota.exceeded', "Request quota exceeded; retry in {0:.1f} seconds.".format(
+                    quota.wait_time()))
+
+    def upstream(self, application, call, credential, **kw):
+        try:
+            result = call(*((credential, ) if credential else ()), **kw)
+        except:
+            self.count(application, call.name, 'error')
+            raise
+
+        self.count(application, call.name, 'upstream')
+        return result
+
+    def call(self, application, call, credential, **kw):
+        """Answer the call from the result cache if possible, otherwise make it if the application's quota allows."""
+
+        result = self.cached(application, call, credential, **kw)
+
+        if result is None:
+            self.spend(application, call)
+            result = self.upstream(application, call, credential, **kw)
+
+        return result
+
+    def executor(self):
+        """Return the pool deferred calls are made on, creating it from configuration on first use."""
+
+        with self._lock:
+            if self._executor is None:
+                workers = int(config.get('core.proxy.workers', 4))
+                self._executor = ScalingPoolExecutor(1, workers, 60)
+
+            return self._executor
+
+    def defer(self, application, call, credential, **kw):
+        """Answer the call from the result cache if possible; otherwise queue it if the application's quota allows.
+
+        Returns a (result, job) tuple, one of which is None.  The ProxyJob records the result once the call has been
+        made, and the result cache holds it too, so the application may poll either."""
+
+        from brave.core.api.model import ProxyJob
+
+        result = self.cached(application, call, credential, **kw)
+
+        if result is not None:
+            return result, None
+
+        self.spend(application, call)
+
+        job = ProxyJob(application=application, call=call.name, arguments=kw).save()
+        self.count(application, call.name, 'deferred')
+
+        def complete(receipt):
+            # Recording the result may fail too (it may not be storable, say); the job mustn't be left pending.
+            try:
+                ProxyJob.objects(id=job.id).update_one(set__state='done', set__result=receipt.result())
+            except Exception as e:
+                log.exception("Unable to process deferred request.")
+                ProxyJob.objects(id=job.id).update_one(set__state='failed', set__error=unicode(e))
+
+        self.executor().submit(self.upstream, application, call, credential, **kw).add_done_callback(complete)
+
+        return None, job
+
+
+pipeline = ProxyPipeline()
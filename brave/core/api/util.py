@@ -2,13 +2,187 @@
 
 from __future__ import unicode_literals
 
+from time import time
+from threading import Lock
+from datetime import datetime, timedelta
+from binascii import hexlify, unhexlify
+from hashlib import sha256
+
+from ecdsa.keys import SigningKey, VerifyingKey, BadSignatureError
+from ecdsa.curves import NIST256p
+from webob import Response
+from web.core import request
+from web.core.http import HTTPBadRequest
+from web.core.templating import render
+
 from braveapi.controller import SignedController as OriginalSignedController
-from brave.core.application.model import Application
+from brave.core.application.model import Application, ApplicationGrant, APPLICATION_CACHE_VERSION, \
+    GRANT_CACHE_VERSION
+from brave.core.ban.model import BAN_CACHE_VERSION
+from brave.core.util.cache import LRUCache, CacheVersion
 
 
 log = __import__('logging').getLogger(__name__)
 
 
+class ServiceCache(object):
+    """Applications, with their parsed keys, by identifier, and their grants by token.
+
+    Every signed API request needs the calling application and both of its keys, and most then load a grant.  These are
+    kept here instead of being loaded and parsed anew each time.  Saving or deleting an application, grant, or ban bumps
+    a CacheVersion, which is checked at most every interval seconds; grants are also only kept for grant_ttl seconds.
+    """
+
+    def __init__(self, interval=5, grant_ttl=60):
+        self.interval = interval
+        self.applications = LRUCache(256)
+        self.grants = LRUCache(4096, grant_ttl)
+        self._stamp = None
+        self._checked = 0
+        self._lock = Lock()
+
+    def check(self):
+        """Forget whatever has changed since we last looked, if it's been long enough since we did."""
+
+        if time() - self._checked <= self.interval:
+            return
+
+        with self._lock:
+            if time() - self._checked <= self.interval:
+                return  # Another thread got here first.
+
+            stamp = CacheVersion.stamp(APPLICATION_CACHE_VERSION, GRANT_CACHE_VERSION, BAN_CACHE_VERSION)
+
+            if self._stamp is not None:
+                if stamp[0] != self._stamp[0]:
+                    self.applications.clear()
+                    self.grants.clear()  # Grants refer to their application.
+
+                elif stamp[1:] != self._stamp[1:]:
+                    self.grants.clear()  # Grants, or whether their users are banned, have changed.
+
+            self._stamp = stamp
+            self._checked = time()
+
+    def application(self, identifier):
+        """Return the (application, public verifying key, private signing key) of the given application identifier.
+
+        Raises Application.DoesNotExist if there is no such application."""
+
+        self.check()
+
+        cached = self.applications.get(identifier)
+        if cached is not None:
+            return cached
+
+        application = Application.objects.get(id=identifier)
+
+        public = VerifyingKey.from_string(unhexlify(application.key.public.encode('utf-8')), curve=NIST256p,
+                                          hashfunc=sha256)
+        private = SigningKey.from_string(unhexlify(application.key.private), curve=NIST256p,
+                                         hashfunc=sha256) if application.key.private else None
+
+        # Don't remember an application still waiting for its key to be generated.
+        if private is None:
+            return application, public, private
+
+        return self.applications.set(identifier, (application, public, private))
+
+    def grant(self, application, token):
+        """Return the grant of the given application with the given token, or None, and whether its user is banned
+        from the application."""
+
+        self.check()
+
+        key = (application.id, token)
+        cached = self.grants.get(key)
+
+        if cached is None:
+            try:
+                grant = ApplicationGrant.objects.get(id=token, application=application)
+            except ApplicationGrant.DoesNotExist:
+                grant = None
+
+            banned = bool(grant and grant.user.person.banned(app=application.short))
+            cached = self.grants.set(key, (grant, banned))
+
+        return cached
+
+
+services = ServiceCache()
+
+
 class SignedController(OriginalSignedController):
+    """A signed API controller whose applications, keys, and grants come from the ServiceCache.
+
+    The request checks are those of braveapi's SignedController, which parses the application's keys on every request.
+    """
+
     def __service__(self, identifier):
-        return Application.objects.get(id=identifier)
+        return services.application(identifier)[0]
+
+    def __before__(self, *args, **kw):
+        """Validate the request signature, load the relevant data."""
+
+        if 'X-Service' not in request.headers or 'X-Signature' not in request.headers:
+            log.error("Digitally signed request missing headers.")
+            raise HTTPBadRequest("Missing headers.")
+
+        try:
+            request.service, key, request.service_key = services.application(request.headers['X-Service'])
+        except:
+            log.exception("Exception attempting to load service: %s", request.headers['X-Service'])
+            raise HTTPBadRequest("Unknown or invalid service identity.")
+
+        log.debug("Canonical request:\n\n\"{r.headers[Date]}\n{r.url}\n{r.body}\"".format(r=request))
+
+        date = datetime.strptime(request.headers['Date'], '%a, %d %b %Y %H:%M:%S GMT')
+        if datetime.utcnow() - date > timedelta(seconds=15):
+            log.warning("Received request that is over 15 seconds old, rejecting.")
+            raise HTTPBadRequest("Request over 15 seconds old.")
+
+        # We allow requests 1s from the future to account for slight clock skew.
+        if datetime.utcnow() - date < timedelta(seconds=-1):
+            log.warning("Received a request from the future; please check this systems time for validity.")
+            raise HTTPBadRequest("Request from the future, please check your time for validity.")
+
+        try:
+            key.verify(
+                unhexlify(request.headers['X-Signature']),
+                "{r.headers[Date]}\n{r.url}\n{r.body}".format(r=request))
+        except BadSignatureError:
+            try:
+                # Try verifying again with the time adjusted by one second.
+                date = date - timedelta(seconds=1)
+                key.verify(
+                    unhexlify(request.headers['X-Signature']),
+                    "{date}\n{r.url}\n{r.body}".format(r=request, date=date.strftime('%a, %d %b %Y %H:%M:%S GMT')))
+            except BadSignatureError:
+                raise HTTPBadRequest("Invalid request signature.")
+
+        return args, kw
+
+    def __after__(self, result, *args, **kw):
+        """Generate the JSON response and sign."""
+
+        key = request.service_key
+
+        response = Response(status=200, charset='utf-8')
+        response.date = datetime.utcnow()
+        response.last_modified = result.pop('updated', None)
+
+        ct, body = render('json:', result)
+        response.headers[b'Content-Type'] = str(ct)  # protect against lack of conversion in Flup
+        response.body = body
+
+        canon = "{req.service.id}\n{resp.headers[Date]}\n{req.url}\n{resp.body}".format(
+                    req = request,
+                    resp = response
+            )
+        response.headers[b'X-Signature'] = hexlify(key.sign(canon))
+        log.debug("Signing response: %s", response.headers[b'X-Signature'])
+        log.debug("Canonical data:\n%r", canon)
+
+        del response.date  # TODO: This works around an odd bug of sending two Date header values.
+
+        return response
@@ -53,7 +53,7 @@ class BrowseController(Controller):
         devRecords = list()
         
         # Cache the user's permissions
-        user_perms = user.permissions
+        user_perms = user.permission_matcher
         
         # Retrieve non-development applications that the user is able to authorize
         for r in Application.objects(development__in=[False, None]):
@@ -145,7 +145,7 @@ class ApplicationList(HTTPMethod):
     def get(self):
         adminRecords = set()
         
-        user_perms = user.permissions
+        user_perms = user.permission_matcher
         
         for app in Application.objects():
             if app.owner.id != user.id and Permission.set_grants_permission(user_perms, app.edit_perm):
@@ -3,14 +3,20 @@
 from __future__ import unicode_literals
 
 from datetime import datetime, timedelta
-from mongoengine import Document, EmbeddedDocument, EmbeddedDocumentField, StringField, EmailField, URLField, DateTimeField, BooleanField, ReferenceField, ListField, IntField
+from mongoengine import Document, EmbeddedDocument, EmbeddedDocumentField, StringField, EmailField, URLField, DateTimeField, BooleanField, ReferenceField, ListField, IntField, signals
 
+from brave.core.util.cache import CacheVersion
 from brave.core.util.signal import update_modified_timestamp
 from brave.core.application.signal import trigger_private_key_generation
 
 
 log = __import__('logging').getLogger(__name__)
 
+# The CacheVersions bumped whenever an application (including its keys) or grant changes; see
+# brave.core.api.util.ServiceCache.
+APPLICATION_CACHE_VERSION = 'applications'
+GRANT_CACHE_VERSION = 'grants'
+
 
 
 class ApplicationKeys(EmbeddedDocument):
@@ -97,6 +103,14 @@ class Application(Document):
     @property
     def authorize_perm(self):
         return self.get_perm('AUTHORIZE')
+    
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        CacheVersion.bump(APPLICATION_CACHE_VERSION)
+    
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        CacheVersion.bump(APPLICATION_CACHE_VERSION)
 
 
 class ApplicationGrant(Document):
@@ -166,6 +180,14 @@ class ApplicationGrant(Document):
         for grant in cls.objects(character=character):
             grant.delete()
     
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        CacheVersion.bump(GRANT_CACHE_VERSION)
+    
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        CacheVersion.bump(GRANT_CACHE_VERSION)
+    
     def __repr__(self):
         return 'Grant({0}, "{1}", "{2}", {3})'.format(self.id, self.user, self.application, self.mask).encode('ascii', 'backslashreplace')
 
@@ -188,3 +210,8 @@ class ApplicationGrant(Document):
         else:
             self.characters.remove(character)
             self.save()
+
+
+for _sender in (Application, ApplicationGrant):
+    signals.post_save.connect(_sender.post_save, sender=_sender)
+    signals.post_delete.connect(_sender.post_delete, sender=_sender)
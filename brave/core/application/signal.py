@@ -9,13 +9,14 @@ from ecdsa.curves import NIST256p
 
 from web.core import config
 
+from brave.core.util.cache import CacheVersion
 from brave.core.util.signal import signal, post_save, validator_pool
 
 log = __import__('logging').getLogger(__name__)
 
 
 def generate_key(identifier):
-    from brave.core.application.model import Application
+    from brave.core.application.model import Application, APPLICATION_CACHE_VERSION
     
     key = SigningKey.generate(NIST256p, hashfunc=sha256)
     Application.objects(
@@ -24,6 +25,9 @@ def generate_key(identifier):
         ).update(
             set__key__private = hexlify(key.to_string())
         )
+    
+    # Updated directly, so the save signals didn't invalidate cached copies of the application.
+    CacheVersion.bump(APPLICATION_CACHE_VERSION)
 
 
 def log_error(receipt):
@@ -1,11 +1,18 @@
-from mongoengine import EmbeddedDocument, EmbeddedDocumentField, Document, StringField, DateTimeField, BooleanField, ReferenceField, ListField, ValidationError
-from brave.core.person.model import Person, PersonEvent
+from mongoengine import EmbeddedDocument, EmbeddedDocumentField, Document, StringField, DateTimeField, BooleanField, ReferenceField, ListField, ValidationError, Q, signals
+from brave.core.person.model import Person, PersonAlias
 from brave.core.account.model import User
 from brave.core.application.model import Application
+from brave.core.util.cache import LRUCache, CacheVersion
 from datetime import datetime, timedelta
 
 log = __import__('logging').getLogger(__name__)
 
+# The CacheVersion bumped on every change to any ban, invalidating the active ban cache.
+BAN_CACHE_VERSION = 'bans'
+
+# Possibly active bans by person id; see PersonBan.active_for.
+active_ban_cache = LRUCache(4096)
+
 
 class Ban(Document):
     meta = dict(
@@ -270,12 +277,27 @@ class Ban(Document):
 
         return False
 
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        CacheVersion.bump(BAN_CACHE_VERSION)
+
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        CacheVersion.bump(BAN_CACHE_VERSION)
+
 
 class PersonBan(Ban):
     """This Ban class is for Bans that apply to a single Person."""
 
-    # Stores the ObjectID of the person this event happened to, We store it as a string rather
-    # than as a reference for when a Person are deleted during a merge.
+    meta = dict(
+        indexes = [
+            ('orig_person', '_enabled', 'expires'),
+            ('ban_type', 'app'),
+        ],
+    )
+
+    # Stores the ObjectID of the person this ban applies to, We store it as a string rather than as a reference for
+    # when a Person is deleted during a merge. Person.merge moves bans over to the surviving person.
     orig_person = StringField(db_field='p', required=True)
 
     # Records the actual banned entity
@@ -295,12 +317,44 @@ class PersonBan(Ban):
     def person(self):
         """The Person that this ban describes currently. Can be different than orig_person, in the event that the person
         the event originally described was merged into another person."""
-        person = Person.objects(id=self.orig_person)
-        if person:
-            return person.first()
+        return Person.objects(id=PersonAlias.find(self.orig_person)).first()
+
+    @staticmethod
+    def active_for(person):
+        """Returns the enabled, unexpired bans of the given person (or person id).
+
+        Results are cached per person until any ban changes; expiry is checked on every call."""
+
+        person = str(getattr(person, 'id', person))
+        stamp = CacheVersion.current(BAN_CACHE_VERSION)
 
-        person_merge = PersonEvent.objects(target_ident=self.orig_person).first()
-        return person_merge.current_person
+        cached = active_ban_cache.get(person)
+        if cached is not None and cached[0] == stamp:
+            bans = cached[1]
+        else:
+            bans = PersonBan.objects(Q(expires=None) | Q(expires__gt=datetime.utcnow()),
+                                     orig_person=person, _enabled=True)
+            bans = active_ban_cache.set(person, (stamp, list(bans)))[1]
+
+        return [b for b in bans if b.enabled]
+
+    @staticmethod
+    def merged(old, new):
+        """Moves the bans of a person that has been merged into another person over to that person."""
+
+        if PersonBan.objects(orig_person=str(old.id)).update(set__orig_person=str(new.id)):
+            CacheVersion.bump(BAN_CACHE_VERSION)
+
+    @staticmethod
+    def update_people():
+        """Points the bans of people merged before Person.merge maintained orig_person at the current person."""
+
+        for ban in PersonBan.objects.only('orig_person'):
+            person = ban.person
+            if person and str(person.id) != ban.orig_person:
+                PersonBan.objects(id=ban.id).update_one(set__orig_person=str(person.id))
+
+        CacheVersion.bump(BAN_CACHE_VERSION)
 
 class BanHistory(EmbeddedDocument):
     meta = dict(
@@ -377,3 +431,8 @@ class ModifyTypeBanHistory(BanHistory):
         if new.startswith("SUBAPP"):
             new += "({0})".format(self.new_subarea)
         return "Changed type from {0} to {1}".format(prev, new)
+
+
+for _sender in (Ban, PersonBan):
+    signals.post_save.connect(Ban.post_save, sender=_sender)
+    signals.post_delete.connect(Ban.post_delete, sender=_sender)
@@ -9,43 +9,115 @@ from datetime import datetime
 
 from brave.core.helper import get_membership
 from mongoengine import Document, StringField, DateTimeField, ReferenceField, \
-    IntField, BooleanField, FloatField, ListField, NULLIFY, PULL
+    IntField, BooleanField, FloatField, ListField, NULLIFY, PULL, Q, signals
 from brave.core.util.signal import update_modified_timestamp
 from brave.core.key.model import EVECredential
-from brave.core.util import evelink
-from brave.core.permission.model import Permission, WildcardPermission
+from brave.core.util.cache import LRUCache, CacheVersion
+from brave.core.util.mask import least_permissive
+from brave.core.character.ticker import tickers
+from brave.core.permission.model import Permission, PERMISSION_CACHE_VERSION
+from brave.core.permission.matcher import PermissionMatcher
 from brave.core.application.model import Application
 
 log = __import__('logging').getLogger(__name__)
 
+# Effective permissions by (character id, application prefix); see EVECharacter.permissions.
+permission_cache = LRUCache(4096)
+
+# The CacheVersion bumped on every change to an entity of the given class; see EVEEntity.cache_version.
+ENTITY_CACHE_VERSION = 'entities.{0}'
+
 
 @update_modified_timestamp.signal
 class EVEEntity(Document):
     meta = dict(
         allow_inheritance=True,
         indexes=[
-            'identifier'
+            'identifier',
+            '_name',
         ],
         # TODO: migrate and rename collection
     )
 
     identifier = IntField(db_field='i', unique=True)
     name = StringField(db_field='n')
+    _name = StringField(db_field='nl')  # The name, case-folded for lookups.
 
     modified = DateTimeField(db_field='m', default=datetime.utcnow)
 
+    # The fields whose changes bump the class's CacheVersion, or None for all of them.
+    VERSIONED_FIELDS = None
+
     @classmethod
-    def get(cls, query=None, **kw):
+    def get(cls, query=None, fields=None, **kw):
+        """Find an entity by identifier or (case-insensitively) by name, loading only the given fields if any."""
+
         if query.isnumeric():
             kw['identifier'] = query
         else:
-            kw['name'] = query
+            kw['_name'] = query.lower()
+
+        queryset = cls.objects.only(*fields) if fields else cls.objects
 
         try:
-            return cls.objects.get(**kw)
+            return queryset.get(**kw)
         except cls.DoesNotExist:
             return None
 
+    @classmethod
+    def get_many(cls, queries, fields=None):
+        """Find many entities by identifier or name with one query, returning a mapping of query to entity for those
+        found.  As with get(), only the given fields are loaded, if any."""
+
+        # Several queries may fold to the same identifier or name ("0123" and "123", "Foo" and "foo".)
+        identifiers = dict()
+        names = dict()
+        for q in queries:
+            if q.isnumeric():
+                identifiers.setdefault(int(q), []).append(q)
+            else:
+                names.setdefault(q.lower(), []).append(q)
+
+        queryset = cls.objects(Q(identifier__in=list(identifiers)) | Q(_name__in=list(names)))
+        if fields:
+            queryset = queryset.only('identifier', '_name', *fields)
+
+        found = dict()
+        for entity in queryset:
+            for q in identifiers.get(entity.identifier, ()) + names.get(entity._name, ()):
+                found[q] = entity
+
+        return found
+
+    @classmethod
+    def cache_version(cls):
+        """The name of the CacheVersion bumped whenever an entity of this class changes."""
+        return ENTITY_CACHE_VERSION.format(cls.__name__)
+
+    @classmethod
+    def pre_save(cls, sender, document, **kwargs):
+        document._name = document.name.lower() if document.name else None
+
+        fields = sender.VERSIONED_FIELDS
+        if fields is None or document._created or document.pk is None:
+            document._version_changed = True
+            return
+
+        db_fields = [document._fields[name].db_field for name in fields]
+        document._version_changed = any(f.split('.')[0] in db_fields for f in document._get_changed_fields())
+
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        if not getattr(document, '_version_changed', True):
+            return
+
+        document._version_changed = False
+        CacheVersion.bump(sender.cache_version())
+
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        CacheVersion.bump(sender.cache_version())
+
     def __repr__(self):
         return '{0}({1}, {2}, "{3}")'.format(self.__class__.__name__, self.id,
                                              self.identifier, self.name)
@@ -72,78 +144,9 @@ class EVEAlliance(EVEEntity):
 
     @classmethod
     def populate(cls):
-        log.info("Populating alliances (and minimal corporate information) "
-                 "from AllianceList.")
-
-        results, a, b, c, d = None, 0, 0, 0, 0
-        eve = evelink.eve.EVE()
-        try:
-            results = eve.alliances().result
-        except:
-            log.exception("Failed call.")
-            results = None
-
-        if not results:
-            log.error("Unable to retrieve AllianceList.")
-            return
-
-        for b, row in enumerate(results.values()):
-            log.info("Synchronizing Alliance %d: %s", row['id'], row['name'])
-            record, created = EVEAlliance.objects.get_or_create(
-                identifier=row['id'],
-            )
-
-            if created:
-                a += 1
-
-            record.name = row['name']
-            record.short = row['ticker']
-            record.founded = datetime.fromtimestamp(row['timestamp'])
-            members = row['member_count']
-            record = record.save()
-
-            executor = row['executor_id']
-
-            try:
-                mapping = eve.character_names_from_ids(
-                    row['member_corps'].keys()).result
-            except:
-                log.exception("Failed to get full mapping.  Falling back.")
-                mapping = None
-
-            for corp in row['member_corps'].values():
-                log.info("Synchronizing corporation: %d", corp['id'])
-                corporation, created = EVECorporation.objects.get_or_create(
-                    identifier=corp['id'],
-                )
-
-                d += 1
-                if created:
-                    c += 1
-
-                if mapping:
-                    corporation.name = mapping[corp['id']]
-                elif not corporation.name:
-                    try:
-                        result = eve.character_name_from_id(corp['id']).result
-                        corporation.name = result['name']
-                    except:
-                        log.exception("Unable to get corporation name for %d.",
-                                      corp['id'])
-                        continue
-
-                corporation.alliance = record
-                corporation.joined = datetime.fromtimestamp(corp['timestamp'])
-                corporation.save()
-
-                if corporation.identifier == executor:
-                    record.executor = corporation
-                    record.save()
-
-        log.info(
-            "Population complete, %d/%d alliances, "
-            "%d/%d corporations created/updated.",
-            a, b, c, d)
+        """Synchronize every alliance, and minimal information about its member corporations, from the AllianceList."""
+        from brave.core.character.sync import AllianceSync
+        return AllianceSync().run()
 
 
 class EVECorporation(EVEEntity):
@@ -161,12 +164,9 @@ class EVECorporation(EVEEntity):
 
     @property
     def short(self):
+        """The corporation's ticker.  If we don't have it yet this is None, and it is fetched in the background."""
         if not self._short:
-            corp = evelink.corp.Corp(evelink.api.API())
-            result = corp.corporation_sheet(self.identifier).result
-            self._short = result['ticker']
-            EVECorporation.objects(identifier=self.identifier).update(
-                set___short=self._short)
+            self._short = tickers.get(self.identifier)
         return self._short
 
     @short.setter
@@ -174,6 +174,7 @@ class EVECorporation(EVEEntity):
         self._short = short
 
 
+@update_modified_timestamp.signal
 class EVECharacter(EVEEntity):
     meta = dict(
         indexes=[
@@ -201,7 +202,10 @@ class EVECharacter(EVEEntity):
 
     owner = ReferenceField('User', db_field='o', reverse_delete_rule=NULLIFY)
 
-    _permissions_cache = dict()
+    # Characters are saved on every key refresh, so only changes to the fields character lookups report by reference
+    # or which matter to applications bump the CacheVersion; the rest (security status, say) may be up to the lookup
+    # cache's TTL out of date.
+    VERSIONED_FIELDS = ('name', 'corporation', 'alliance', 'titles')
 
     # Permissions
     VIEW_PERM = 'core.character.view.{character_id}'
@@ -210,12 +214,7 @@ class EVECharacter(EVEEntity):
     # DEPRECATED
     @property
     def tags(self):
-        from brave.core.group.model import Group
-        mapping = dict()
-
-        for group in Group.objects:
-            if group.evaluate(self.owner, self):
-                mapping[group.id] = group
+        mapping = dict((group.id, group) for group in self.groups)
 
         def titlesort(i):
             return mapping[i].title
@@ -225,22 +224,11 @@ class EVECharacter(EVEEntity):
 
     @property
     def groups(self):
-        """Returns the groups a character is in."""
+        """Returns the groups a character is in, according to the group membership index."""
 
-        from brave.core.group.model import Group
+        from brave.core.group.model import Group, GroupMembership
 
-        char_groups = set()
-
-        for group in Group.objects:
-            bef = datetime.utcnow()
-            res = group.evaluate(self.owner, self)
-            aft = datetime.utcnow()
-            # print "Evaluation for group {0} took {1}".format(
-            #     group.id, aft-bef)
-            if res:
-                char_groups.add(group)
-
-        return char_groups
+        return set(Group.objects(id__in=GroupMembership.groups_for(self)))
 
     @property
     def person(self):
@@ -264,6 +252,18 @@ class EVECharacter(EVEEntity):
         """Return all permissions that the character has that start with core
         or app. An app of None returns all of the character's permissions."""
 
+        return list(self._permissions(app, groups_cache)[0])
+
+    def permission_matcher(self, app=None):
+        """Return a PermissionMatcher over the permissions returned by
+        permissions(app), for repeated checks against them."""
+
+        return self._permissions(app)[1]
+
+    def _permissions(self, app=None, groups_cache=None):
+        """Return a tuple of the character's permissions and a matcher over
+        them, from the cache when possible."""
+
         # Use a set so we don't need to worry about characters having
         # a permission from multiple groups.
         permissions = set()
@@ -279,29 +279,27 @@ class EVECharacter(EVEEntity):
         if app and app[-1] != '.':
             app = app + '.'
 
-        # make sure we are not re-evaluating character permissions
-        app_check = app
-        if app_check is None:
-            app_check = '_None.'
+        # Serve the effective permissions from the cache if nothing they're derived from has changed since: the
+        # global version covers groups and permissions, the character's modification time covers its personal
+        # permissions and its group memberships (which the group membership index updates when they change).
+        if groups_cache is None and self.id is not None:
+            key = (self.id, app)
+            stamp = (CacheVersion.current(PERMISSION_CACHE_VERSION),
+                     EVECharacter.objects(id=self.id).scalar('modified').first())
+
+            cached = permission_cache.get(key)
+            if cached is not None and cached[0] == stamp:
+                return cached[1:]
 
         # save time re-evalutating groups
         if groups_cache is not None:
             groups = groups_cache
         else:
-            bef = datetime.utcnow()
             groups = self.groups
-            aft = datetime.utcnow()
-            print "Groups eval for character {0} took {1}".format(self.name,
-                                                                  aft - bef)
 
         # Return permissions from groups that this character has.
         for group in groups:
-            gbef = datetime.utcnow()
-            perms = group.permissions
-            gaft = datetime.utcnow()
-            # print "Pulling group permissions for"
-            #       "group {0} took {1}".format(group.id, gaft-gbef)
-            for perm in perms:
+            for perm in group.permissions:
                 # Append all of the group's permissions
                 # when no app is specified.
                 if not app:
@@ -325,11 +323,13 @@ class EVECharacter(EVEEntity):
             if perm.id.startswith('core') or perm.id.startswith(app):
                 permissions.add(perm)
 
-        # Save Permissions list in memory cache
-        permissions = list(permissions)
-        permissions.sort()
+        permissions = sorted(permissions)
+        result = (tuple(permissions), PermissionMatcher(permissions))
 
-        return permissions
+        if groups_cache is None and self.id is not None:
+            permission_cache.set(key, (stamp, ) + result)
+
+        return result
 
     def permissions_tags(self, application=None, groups_cache=None):
         """Returns just the string for the permissions
@@ -351,31 +351,13 @@ class EVECharacter(EVEEntity):
         if isinstance(permission, Permission):
             permission = permission.id
 
-        bef = datetime.utcnow()
-        permissions = self.permissions()
-        aft = datetime.utcnow()
-        print "Permissions loading took {} ms".format(aft - bef)
-
-        rbef = datetime.utcnow()
-        res = Permission.set_grants_permission(permissions, permission)
-        raft = datetime.utcnow()
-        print "Set grants permission took {} ms".format(raft - rbef)
-
-        return res
+        return self.permission_matcher().grants(permission)
 
     def has_any_permission(self, permission):
         """Returns true if the character has a permission that
         would be granted by permission."""
-        p = WildcardPermission.objects(id=permission)
-        if len(p):
-            p = p.first()
-        else:
-            p = WildcardPermission(id=permission)
-        for permID in self.permissions():
-            if p.grants_permission(permID.id):
-                return True
 
-        return False
+        return self.permission_matcher().granted_by(permission)
 
     @property
     def has_verified_key(self):
@@ -387,25 +369,17 @@ class EVECharacter(EVEEntity):
         """Return the least-permissive API key that
         can satisfy the given mask."""
 
-        candidates = [i for i in self.credentials if
-                      not mask or not i.mask or i.mask.has_access(mask)]
-
-        lowest = None
-        lowest_count = None
-        for candidate in candidates:
-            bc = candidate.mask.number_of_functions()
-            if lowest_count is None or bc < lowest_count:
-                lowest, lowest_count = candidate, bc
-
-        return lowest
+        mask = getattr(mask, 'mask', mask)  # Either an EVEKeyMask or the integer itself.
+        return least_permissive(((i, i.mask.mask if i.mask else None) for i in self.credentials), mask)
 
     def credential_multi_for(self, masks):
         """Returns the lowest permission API key that
         can satisfy the highest possible given mask."""
 
         for mask in masks:
-            if self.credential_for(mask):
-                return mask, self.credential_for(mask)
+            credential = self.credential_for(mask)
+            if credential:
+                return mask, credential
 
         return None, None
 
@@ -489,3 +463,9 @@ class EVECharacter(EVEEntity):
         char.save()
 
         return char
+
+
+for _sender in (EVEAlliance, EVECorporation, EVECharacter):
+    signals.pre_save.connect(EVEEntity.pre_save, sender=_sender)
+    signals.post_save.connect(EVEEntity.post_save, sender=_sender)
+    signals.post_delete.connect(EVEEntity.post_delete, sender=_sender)
@@ -0,0 +1,281 @@
+# encoding: utf-8
+
+"""Bulk synchronization of EVE entities: alliances and their member corporations from the AllianceList, and the
+corporations and alliances characters belong to.
+
+Incoming data is compared against the existing EVEEntity documents, loaded in one query, and only the fields that
+differ are written, as upserts batched into unordered bulk operations where the MongoDB driver supports them.  Missing
+corporation names are looked up in chunks rather than one corporation at a time.
+"""
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from brave.core.util import evelink
+from brave.core.util.cache import CacheVersion
+from brave.core.character.model import EVEEntity, EVEAlliance, EVECorporation
+
+
+log = __import__('logging').getLogger(__name__)
+
+
+class Writer(object):
+    """Accumulates updates and upserts by EVE identifier, executing them in batches.
+
+    Changes are given as raw fields.  Like a save, writing maintains the modification time and case-folded name and
+    invalidates cached lookups of the classes written."""
+
+    def __init__(self, collection, batch_size=1000):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.pending = []
+        self.classes = set()
+        self.written = 0
+
+    def upsert(self, identifier, cls, changes):
+        """Set the given fields of an entity, creating it as an instance of cls if it doesn't exist."""
+        self.write(identifier, cls, {'$set': self.prepare(changes), '$setOnInsert': {'_cls': cls._class_name}}, True)
+
+    def update(self, identifier, cls, changes):
+        """Set the given fields of an existing entity."""
+        self.write(identifier, cls, {'$set': self.prepare(changes)}, False)
+
+    @staticmethod
+    def prepare(changes):
+        changes = dict(changes, m=datetime.utcnow())
+
+        if 'n' in changes:
+            changes['nl'] = changes['n'].lower() if changes['n'] else None
+
+        return changes
+
+    def write(self, identifier, cls, update, upsert):
+        self.pending.append((identifier, update, upsert))
+        self.classes.add(cls)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, []
+        bulk = getattr(self.collection, 'initialize_unordered_bulk_op', None)
+
+        if bulk is None:  # Drivers older than 2.7 have no bulk API.
+            for identifier, update, upsert in pending:
+                self.collection.update({'i': identifier}, update, upsert=upsert)
+        else:
+            bulk = bulk()
+            for identifier, update, upsert in pending:
+                operation = bulk.find({'i': identifier})
+                (operation.upsert() if upsert else operation).update_one(update)
+            bulk.execute()
+
+        self.written += len(pending)
+
+        for cls in self.classes:
+            CacheVersion.bump(cls.cache_version())
+
+        self.classes.clear()
+
+
+def chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def load(collection, identifiers, fields):
+    """Return the given raw fields of the entities with the given EVE identifiers, by identifier."""
+
+    fields = dict((f, 1) for f in ('i', ) + tuple(fields))
+    existing = dict()
+
+    for chunk in chunks(identifiers, 10000):
+        for doc in collection.find({'i': {'$in': chunk}}, fields):
+            existing[doc['i']] = doc
+
+    return existing
+
+
+def ids(collection, identifiers, existing):
+    """Return the ObjectIds of the given entities by identifier, fetching those not already in existing."""
+
+    missing = [i for i in identifiers if i not in existing]
+    result = dict((i, existing[i]['_id']) for i in identifiers if i in existing)
+
+    for chunk in chunks(missing, 10000):
+        for doc in collection.find({'i': {'$in': chunk}}, dict(i=1)):
+            result[doc['i']] = doc['_id']
+
+    return result
+
+
+def diff(existing, desired):
+    """Return the fields of desired whose values differ from those of the existing raw document."""
+    existing = existing or {}
+    return dict((k, v) for k, v in desired.iteritems() if existing.get(k) != v)
+
+
+def resolve_affiliations(collection, writer, affiliations):
+    """Return the ObjectIds of the corporations and alliances in the given affiliations, by identifier.
+
+    Affiliations are dictionaries as returned by evelink's affiliations_for_characters.  Corporations and alliances
+    which don't exist yet are created; those whose name, or whose corporation's alliance, differs are updated.  Each
+    is resolved once, however many of the affiliations share it.
+    """
+
+    corporations = dict()
+    alliances = dict()
+
+    for affiliation in affiliations:
+        alliance = affiliation.get('alliance') or {}
+        if alliance.get('id'):
+            alliances[alliance['id']] = alliance['name']
+
+        corp = affiliation['corp']
+        if corp.get('id'):
+            corporations[corp['id']] = (corp['name'], alliance.get('id'))
+
+    existing = load(collection, list(corporations) + list(alliances), ('n', 'alliance'))
+
+    for identifier, name in alliances.iteritems():
+        changes = diff(existing.get(identifier), dict(n=name))
+        if changes:
+            writer.upsert(identifier, EVEAlliance, changes)
+
+    writer.flush()
+    alliance_ids = ids(collection, alliances, existing)
+
+    for identifier, (name, alliance) in corporations.iteritems():
+        changes = diff(existing.get(identifier), dict(n=name, alliance=alliance_ids.get(alliance)))
+        if changes:
+            writer.upsert(identifier, EVECorporation, changes)
+
+    writer.flush()
+
+    return ids(collection, corporations, existing), alliance_ids
+
+
+class AllianceSync(object):
+    """Synchronize the AllianceList into the EVEEntity collection.
+
+    Call run() to perform a sync; the counts of what was seen and written are left in the stats attribute."""
+
+    NAME_CHUNK = 250
+
+    def __init__(self, eve=None, batch_size=1000):
+        self.eve = eve or evelink.eve.EVE()
+        self.collection = EVEEntity._get_collection()
+        self.batch_size = batch_size
+        self.stats = dict(alliances=0, corporations=0, created=0, updated=0, unnamed=0)
+
+    def names(self, identifiers):
+        """Look up the names of the given corporations in chunks, returning those that could be found."""
+
+        names = dict()
+        pending = list(chunks(identifiers, self.NAME_CHUNK))
+
+        while pending:
+            chunk = pending.pop()
+
+            try:
+                names.update(self.eve.character_names_from_ids(chunk).result)
+            except:
+                # A single invalid ID fails the whole call, so narrow it down by halves.
+                if len(chunk) > 1:
+                    half = len(chunk) // 2
+                    pending.extend((chunk[:half], chunk[half:]))
+                else:
+                    log.exception("Unable to get corporation name for %d.", chunk[0])
+
+        return names
+
+    def count(self, existing, identifier, changes):
+        if changes:
+            self.stats['updated' if identifier in existing else 'created'] += 1
+
+    def run(self):
+        log.info("Populating alliances (and minimal corporate information) from AllianceList.")
+
+        try:
+            alliances = self.eve.alliances().result
+        except:
+            log.exception("Failed call.")
+            alliances = None
+
+        if not alliances:
+            log.error("Unable to retrieve AllianceList.")
+            return
+
+        corporations = dict()
+        for alliance in alliances.itervalues():
+            for corp in alliance['member_corps'].itervalues():
+                corporations[corp['id']] = (alliance['id'], corp)
+
+        self.stats['alliances'] = len(alliances)
+        self.stats['corporations'] = len(corporations)
+
+        existing = load(self.collection, list(alliances) + list(corporations), ('n', 's', 'e', 'f', 'x', 'j', 'alliance'))
+
+        # Alliances first, so that the corporations can refer to them.
+        writer = Writer(self.collection, self.batch_size)
+
+        for identifier, row in alliances.iteritems():
+            changes = diff(existing.get(identifier), dict(
+                    n = row['name'],
+                    s = row['ticker'],
+                    e = row['member_count'],
+                    f = datetime.fromtimestamp(row['timestamp']),
+                ))
+
+            self.count(existing, identifier, changes)
+            if changes:
+                writer.upsert(identifier, EVEAlliance, changes)
+
+        writer.flush()
+        alliance_ids = ids(self.collection, alliances, existing)
+
+        # Then the corporations, naming those we don't have a name for yet.
+        unnamed = set(i for i in corporations if not (existing.get(i) or {}).get('n'))
+        names = self.names(unnamed) if unnamed else dict()
+
+        for identifier, (alliance, corp) in corporations.iteritems():
+            desired = dict(alliance=alliance_ids[alliance], j=datetime.fromtimestamp(corp['timestamp']))
+
+            if identifier in names:
+                desired['n'] = names[identifier]
+            elif identifier in unnamed:
+                self.stats['unnamed'] += 1
+                continue
+
+            changes = diff(existing.get(identifier), desired)
+
+            self.count(existing, identifier, changes)
+            if changes:
+                writer.upsert(identifier, EVECorporation, changes)
+
+        writer.flush()
+
+        # Finally, each alliance's executor corporation.
+        executors = [row['executor_id'] for row in alliances.itervalues()]
+        corporation_ids = ids(self.collection, [i for i in executors if i in corporations], existing)
+
+        for identifier, row in alliances.iteritems():
+            executor = corporation_ids.get(row['executor_id'])
+            if executor is None:
+                continue
+
+            changes = diff(existing.get(identifier), dict(x=executor))
+            if changes:
+                writer.upsert(identifier, EVEAlliance, changes)
+
+        writer.flush()
+
+        log.info("Population complete, %(alliances)d alliances and %(corporations)d corporations: %(created)d created, "
+                 "%(updated)d updated, %(unnamed)d skipped for lack of a name.", self.stats)
+
+        return self.stats
@@ -0,0 +1,147 @@
+# encoding: utf-8
+
+"""Background backfill of corporation tickers.
+
+Corporation tickers aren't part of the AllianceList or character affiliations, so they are fetched from each
+corporation's sheet the first time they are wanted.  Rather than doing so while a page or API response waits,
+EVECorporation.short asks the TickerBackfill, which answers with whatever it already knows and queues the rest.  Queued
+corporations are fetched by a single worker on the validator pool and their tickers written in batches.  Corporations
+whose sheet couldn't be fetched aren't tried again until the retry interval has passed.
+"""
+
+from __future__ import unicode_literals
+
+from threading import Lock
+from itertools import islice
+from collections import OrderedDict, Counter
+
+from brave.core.util import evelink
+from brave.core.util.cache import LRUCache
+from brave.core.util.signal import validator_pool
+
+
+log = __import__('logging').getLogger(__name__)
+
+
+class TickerBackfill(object):
+    """Queues corporations whose ticker is unknown, fetching and storing their tickers in the background."""
+
+    def __init__(self, batch_size=50, retry=3600, maxsize=65536):
+        self.batch_size = batch_size
+        self.known = LRUCache(maxsize)
+        self.failed = LRUCache(maxsize, retry)
+        self.stats = Counter()
+        self.pending = OrderedDict()  # Used as an ordered set of corporation identifiers.
+        self.running = False
+        self._lock = Lock()
+
+    def get(self, identifier):
+        """Return the ticker of the given corporation if known, otherwise queue it to be fetched and return None."""
+
+        ticker = self.known.get(identifier)
+
+        if ticker is None:
+            self.queue(identifier)
+
+        return ticker
+
+    def queue(self, identifier):
+        """Queue the given corporation to have its ticker fetched, unless it is already queued or recently failed."""
+
+        if not identifier or identifier in self.failed:
+            return False
+
+        with self._lock:
+            if identifier in self.pending:
+                return False
+
+            self.pending[identifier] = True
+            self.stats['queued'] += 1
+
+            start, self.running = not self.running, True
+
+        if start:
+            validator_pool.submit(self.drain).add_done_callback(self.log_error)
+
+        return True
+
+    @staticmethod
+    def log_error(receipt):
+        try:
+            receipt.result()
+        except:
+            log.exception("Error backfilling corporation tickers.")
+
+    def take(self):
+        """Remove and return the next batch of queued corporations, noting that we've stopped if there are none."""
+
+        with self._lock:
+            batch = list(islice(self.pending, self.batch_size))
+
+            for identifier in batch:
+                del self.pending[identifier]
+
+            if not batch:
+                self.running = False
+
+            return batch
+
+    def drain(self):
+        try:
+            while True:
+                batch = self.take()
+                if not batch:
+                    return
+
+                self.backfill(batch)
+
+        except:
+            with self._lock:
+                self.running = False
+
+            raise
+
+    @staticmethod
+    def fetch(identifier):
+        corp = evelink.corp.Corp(evelink.api.API())
+        return corp.corporation_sheet(identifier).result['ticker']
+
+    def backfill(self, batch):
+        """Fetch the tickers of a batch of corporations, writing those found together."""
+
+        # These have to be imported here, because the character models import this module.
+        from brave.core.character.model import EVEEntity, EVECorporation
+        from brave.core.character.sync import Writer, load
+
+        collection = EVEEntity._get_collection()
+        writer = Writer(collection)
+
+        # Another process may have stored some of these since the documents asking for them were loaded.
+        for identifier, doc in load(collection, batch, ('s', )).iteritems():
+            if doc.get('s'):
+                self.stats['stored'] += 1
+                self.known.set(identifier, doc['s'])
+
+        for identifier in batch:
+            if identifier in self.known:
+                continue
+
+            try:
+                ticker = self.fetch(identifier)
+            except:
+                log.warning("Unable to get the ticker of corporation %d.", identifier, exc_info=True)
+                ticker = None
+
+            if not ticker:
+                self.stats['failed'] += 1
+                self.failed.set(identifier, True)
+                continue
+
+            self.stats['fetched'] += 1
+            self.known.set(identifier, ticker)
+            writer.update(identifier, EVECorporation, dict(s=ticker))
+
+        writer.flush()
+
+
+tickers = TickerBackfill()
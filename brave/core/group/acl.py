@@ -7,6 +7,7 @@ from collections import OrderedDict
 from mongoengine import Document, EmbeddedDocument, EmbeddedDocumentField, StringField, EmailField, URLField, DateTimeField, BooleanField, ReferenceField, ListField, IntField
 
 from brave.core.util.signal import update_modified_timestamp
+from brave.core.util.mask import satisfies
 
 from brave.core.character.model import EVECharacter, EVECorporation, EVEAlliance
 
@@ -35,6 +36,11 @@ class ACLRule(EmbeddedDocument):
         in to it."""
         raise NotImplementedError()
     
+    def compile(self):
+        """Return an (operation, operand) pair for the compiled evaluator in brave.core.group.compiled. Rules
+        which can't be expressed as a flat predicate fall back to having their evaluate method called."""
+        return 'evaluate', self
+    
     def __repr__(self):
         return "{0}({1})".format(self.__class__.__name__, self)
     
@@ -78,6 +84,9 @@ class ACLList(ACLRule):
         # this acl rule doesn't match or is not applicable
         return self.grant if self.inverse else None
     
+    def compile(self):
+        return self.KINDS[self.kind].lower(), frozenset(self.ids)
+    
     def target_objects(self):
         return self.KIND_CLS[self.kind].objects(identifier__in=self.ids)
     
@@ -123,6 +132,9 @@ class ACLKey(ACLRule):
         
         return self.grant if self.inverse else None
     
+    def compile(self):
+        return 'key', self.kind
+    
     def __unicode__(self):
         return '{grant} if user {has} submitted a {kind} key'.format(
                 grant='grant' if self.grant else 'deny',
@@ -143,6 +155,9 @@ class ACLTitle(ACLRule):
         # this acl rule doesn't match or is not applicable
         return self.grant if self.inverse else None
     
+    def compile(self):
+        return 'title', frozenset(self.titles)
+    
     def __unicode__(self):
         return "{grant} if user {has} the corporate title {set}".format(
                 grant='grant' if self.grant else 'deny',
@@ -163,6 +178,9 @@ class ACLRole(ACLRule):
         # this acl rule doesn't match or is not applicable
         return self.grant if self.inverse else None
     
+    def compile(self):
+        return 'role', frozenset(self.roles)
+    
     def __unicode__(self):
         return "{grant} if user {has} the corporate role {set}".format(
                 grant='grant' if self.grant else 'deny',
@@ -179,12 +197,14 @@ class ACLMask(ACLRule):
     def evaluate(self, user, character, _context=None):
         mask = self.mask
         
-        for cred in character.credentials:
-            if cred.mask.has_access(mask):
-                return None if self.inverse else self.grant
+        if any(cred.mask and satisfies(cred.mask.mask, mask) for cred in character.credentials):
+            return None if self.inverse else self.grant
         
         return self.grant if self.inverse else None
     
+    def compile(self):
+        return 'mask', self.mask or 0
+    
     def __unicode__(self):
         return '{grant} if user {has} submitted a key supporting permissions {mask}'.format(
                 grant='grant' if self.grant else 'deny',
@@ -202,6 +222,9 @@ class ACLVerySecure(ACLRule):
         
         return self.grant if self.inverse else None
     
+    def compile(self):
+        return 'otp', None
+    
     def __repr__(self):
         return "ACLVerySecure({0})".format(self.human_readable_repr())
     
@@ -243,6 +266,11 @@ class ACLGroupMembership(ACLRule):
             id = groups_referenced.pop()
             assert id == self.group.id
 
+    def compile(self):
+        # Read the raw reference so that compiling doesn't dereference the group.
+        group = self._data.get('group')
+        return 'group', getattr(group, 'id', group)
+
     def __repr__(self):
         return "ACLGroupMembership({0} {1} {2!r})".format(
             'grant' if self.grant else 'deny',
@@ -0,0 +1,231 @@
+# encoding: utf-8
+
+"""Compiled group membership evaluation.
+
+`Group.evaluate` walks a group's rules for one character at a time, and every rule dereferences the character's
+credentials, corporation, and alliance again.  Here each group's rule sets are compiled once into a flat program of
+pre-resolved predicates (identifier sets, title and role sets, integer masks) which is then run against a single
+snapshot of the character's facts, evaluating every group in one pass:
+
+    groups = compiled_groups()
+    for group in groups.evaluate(user, character):
+        group.id
+
+The compiled programs are shared by the whole process and rebuilt whenever a group is saved or deleted.
+"""
+
+from __future__ import unicode_literals
+
+from threading import Lock
+from collections import OrderedDict
+
+from brave.core.util.mask import satisfies
+from brave.core.group.acl import CyclicGroupReference
+
+
+log = __import__('logging').getLogger(__name__)
+
+
+def reference_id(value):
+    """Return the primary key of a raw reference value (a DBRef or a Document) without dereferencing it."""
+    return getattr(value, 'id', value)
+
+
+def reference_ids(document, field):
+    """Return the primary keys referenced by a list of references without dereferencing them."""
+    return [reference_id(i) for i in document._data.get(field) or []]
+
+
+class CharacterFacts(object):
+    """Everything the ACL rules look at for a given user and character, loaded once."""
+
+    def __init__(self, user, character):
+        from brave.core.character.model import EVECorporation, EVEAlliance
+        from brave.core.key.model import EVECredential
+
+        self.user = user
+        self.character = character
+        self.id = character.id
+        self.identifier = character.identifier
+        self.owned = bool(character._data.get('owner'))
+        self.titles = frozenset(character.titles)
+        self.roles = frozenset(character.roles)
+        self.otp = bool(user and user.otp_required)
+
+        corporation = reference_id(character._data.get('corporation'))
+        alliance = reference_id(character._data.get('alliance'))
+        self.corporation = EVECorporation.objects(id=corporation).scalar('identifier').first() if corporation else None
+        self.alliance = EVEAlliance.objects(id=alliance).scalar('identifier').first() if alliance else None
+
+        self.kinds = set()
+        self.masks = []
+
+        credentials = reference_ids(character, 'credentials')
+        for kind, mask in EVECredential.objects(id__in=credentials).scalar('kind', '_mask') if credentials else []:
+            if not kind:
+                continue
+
+            self.kinds.add(kind)
+
+            # Credentials of an unknown kind have no usable mask; see EVECredential.mask.
+            if kind in ('Account', 'Character', 'Corporation'):
+                self.masks.append(mask or 0)
+
+
+# Each matcher answers "does this rule apply to the character?" given the rule's compiled operand, the character's
+# facts, and a callable used to resolve membership in other groups.
+MATCHERS = dict(
+        character = lambda operand, facts, member: facts.identifier in operand,
+        corporation = lambda operand, facts, member: facts.corporation in operand,
+        alliance = lambda operand, facts, member: facts.alliance is not None and facts.alliance in operand,
+        key = lambda operand, facts, member: operand in facts.kinds,
+        title = lambda operand, facts, member: not operand.isdisjoint(facts.titles),
+        role = lambda operand, facts, member: not operand.isdisjoint(facts.roles),
+        mask = lambda operand, facts, member: any(satisfies(mask, operand) for mask in facts.masks),
+        otp = lambda operand, facts, member: facts.otp,
+        group = lambda operand, facts, member: member(operand),
+    )
+
+
+def compile_rules(rules):
+    """Compile a list of ACLRule instances into a tuple of (operation, operand, grant, inverse) instructions."""
+    return tuple(rule.compile() + (rule.grant, rule.inverse) for rule in rules)
+
+
+class CompiledGroup(object):
+    """The compiled form of a single group's rule sets and manual membership lists."""
+
+    def __init__(self, group):
+        self.id = group.id
+        self.group = group
+        self.rules = compile_rules(group.rules)
+        self.join_rules = compile_rules(group.join_rules)
+        self.request_rules = compile_rules(group.request_rules)
+        self.join_members = frozenset(reference_ids(group, 'join_members'))
+        self.request_members = frozenset(reference_ids(group, 'request_members'))
+        self.dependencies = frozenset(operand for operation, operand, grant, inverse in
+                                      self.rules + self.join_rules + self.request_rules if operation == 'group')
+
+    def __repr__(self):
+        return 'CompiledGroup({0})'.format(self.id).encode('ascii', 'backslashreplace')
+
+
+class CompiledGroups(object):
+    """An immutable snapshot of every group, compiled for single-pass evaluation."""
+
+    def __init__(self, groups, stamp=None):
+        self.stamp = stamp
+        self.groups = OrderedDict((group.id, CompiledGroup(group)) for group in groups)
+
+    def evaluate(self, user, character):
+        """Return the Group documents the character is a member of, evaluating every group at once."""
+
+        facts = CharacterFacts(user, character)
+        member = self.resolver(facts)
+
+        return [compiled.group for compiled in self.groups.itervalues() if member(compiled.id)]
+
+    def evaluate_group(self, user, character, group_id, rule_set=None, known=None):
+        """Evaluate a single group, with the same rule_set semantics as Group.evaluate.
+
+        Known memberships of other groups (a mapping of group id to boolean) are used as-is for nested group rules."""
+
+        facts = CharacterFacts(user, character)
+
+        if group_id not in self.groups:
+            return False
+
+        return self.membership(self.groups[group_id], facts, rule_set, self.resolver(facts, known))
+
+    def resolver(self, facts, known=None):
+        """Return a memoizing callable answering whether the character described by facts is in a given group.
+
+        Nested group references are evaluated at most once per character no matter how many groups refer to them.
+        """
+
+        results = dict(known or ())
+        evaluating = []
+
+        def member(group_id):
+            if group_id in results:
+                return results[group_id]
+
+            if group_id in evaluating:
+                raise CyclicGroupReference(list(evaluating))
+
+            compiled = self.groups.get(group_id)
+            if compiled is None:
+                log.warning("Rule references missing group %s.", group_id)
+                results[group_id] = False
+                return False
+
+            evaluating.append(group_id)
+            try:
+                result = results[group_id] = bool(self.membership(compiled, facts, None, member))
+            finally:
+                evaluating.pop()
+
+            return result
+
+        return member
+
+    def membership(self, compiled, facts, rule_set, member):
+        """Run a compiled group's program against a character's facts. Mirrors Group.evaluate."""
+
+        # If the character has no owner (and therefore no API key), deny them access to every group.
+        if not facts.owned:
+            return False
+
+        if rule_set == 'request':
+            program = compiled.request_rules
+        elif rule_set == 'join':
+            program = compiled.join_rules
+        elif rule_set == 'main':
+            program = compiled.rules
+        else:
+            if facts.id in compiled.join_members and self.membership(compiled, facts, 'join', member):
+                return True
+
+            if facts.id in compiled.request_members and self.membership(compiled, facts, 'request', member):
+                return True
+
+            program = compiled.rules
+
+        for operation, operand, grant, inverse in program:
+            if operation == 'evaluate':
+                result = operand.evaluate(facts.user, facts.character)
+            elif MATCHERS[operation](operand, facts, member):
+                result = None if inverse else grant
+            else:
+                result = grant if inverse else None
+
+            if result is not None:
+                return result
+
+        return False  # deny by default
+
+
+_snapshot = None
+_snapshot_lock = Lock()
+
+
+def compiled_groups():
+    """Return the current CompiledGroups snapshot, recompiling it if any group has changed since it was built."""
+
+    global _snapshot
+
+    from brave.core.group.model import Group
+
+    latest = Group.objects.order_by('-modified').only('modified').first()
+    stamp = (Group.objects.count(), latest.modified if latest else None)
+
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.stamp == stamp:
+        return snapshot
+
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.stamp != stamp:
+            log.debug("Compiling group rules.")
+            _snapshot = CompiledGroups(Group.objects(), stamp)
+
+        return _snapshot
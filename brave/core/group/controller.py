@@ -15,7 +15,7 @@ from brave.core.group.model import Group, GroupCategory
 from brave.core.group.acl import ACLList, ACLKey, ACLTitle, ACLRole, ACLMask, ACLVerySecure, ACLGroupMembership, CyclicGroupReference
 from brave.core.util import post_only
 from brave.core.util.predicate import authenticate
-from brave.core.permission.util import user_has_permission, user_has_any_permission
+from brave.core.permission.util import user_has_permission, user_has_any_permission, request_permissions
 from brave.core.permission.model import Permission, WildcardPermission, GRANT_WILDCARD
 
 import json
@@ -33,7 +33,7 @@ class OneGroupController(Controller):
         except Group.DoesNotExist:
             raise HTTPNotFound()
 
-        if not user or not user.has_permission(self.group.view_perm):
+        if not user or not request_permissions().has_permission(self.group.view_perm):
             raise HTTPNotFound()
     
     @post_only
@@ -317,7 +317,7 @@ class ManageGroupList(HTTPMethod):
         
         visibleGroups = list()
         
-        user_perms = user.permissions
+        user_perms = user.permission_matcher
         
         for g in groups:
             if Permission.set_grants_permission(user_perms, g.view_perm):
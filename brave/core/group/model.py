@@ -4,13 +4,21 @@ from __future__ import unicode_literals
 
 import itertools
 
+from collections import defaultdict
+
 from datetime import datetime
 from mongoengine import Document, EmbeddedDocument, EmbeddedDocumentField, StringField, EmailField, URLField, DateTimeField, BooleanField, ReferenceField, ListField, IntField, Q, signals
 
-from brave.core.util.signal import update_modified_timestamp
+from web.core import config
+
+from brave.core.util.signal import update_modified_timestamp, validator_pool
 from brave.core.group.acl import ACLRule, ACLGroupMembership, CyclicGroupReference
-from brave.core.permission.model import Permission, WildcardPermission
+from brave.core.group.compiled import compiled_groups, reference_id, reference_ids
+from brave.core.util.cache import CacheVersion
+from brave.core.permission.model import Permission, WildcardPermission, PERMISSION_CACHE_VERSION
 from brave.core.character.model import EVECharacter
+from brave.core.key.model import EVECredential
+from brave.core.account.model import User
 
 
 log = __import__('logging').getLogger(__name__)
@@ -35,63 +43,203 @@ class GroupCategory(Document):
     members = ListField(ReferenceField('Group'), db_field='m', default=list)
 
 
-class GroupMembershipCache(Document):
+class GroupMembership(Document):
+    """The materialized group membership index: one document for every (group, character) pair where the character
+    is a member of the group.
+
+    Rather than being evaluated on read, the index is updated incrementally as its inputs change: group rules and
+    join/request lists (Group saves), a character's corporation, alliance, titles, roles, credentials, or owner
+    (EVECharacter saves), a credential's kind or mask (EVECredential saves and deletes, i.e. EVECredential.pull), and
+    a user's OTP requirement (User saves). Use rebuild() to populate it from scratch."""
+
     meta = dict(
-            collection = 'GroupMembershipCacheList',
+            collection = 'GroupMemberships',
             allow_inheritance = False,
-            indexes = [],
+            indexes = [
+                    dict(fields=['group', 'character'], unique=True),
+                    'character',
+                ],
         )
-    
-    id = StringField(db_field='_id', primary_key=True)
-    rule_set = StringField(db_field='r')
-    members = ListField(IntField(), db_field='my', unique=False, default=list)
-    not_members = ListField(IntField(), db_field='mn', unique=False, default=list)
-    
+
+    group = StringField(db_field='g', required=True)
+    character = ReferenceField(EVECharacter, db_field='c', required=True)
+    modified = DateTimeField(db_field='m', default=datetime.utcnow)
+
+    # The database fields of each document which, when changed, can change group membership.
+    CHARACTER_FIELDS = ('corporation', 'alliance', 'titles', 'roles', 'credentials', 'owner')
+    CREDENTIAL_FIELDS = ('kind', '_mask')
+    USER_FIELDS = ('rotp', 'otp')
+    GROUP_RULE_FIELDS = ('rules', 'join_rules', 'request_rules')
+    GROUP_MEMBER_FIELDS = ('join_members', 'request_members')
+
     def __repr__(self):
-        return 'GroupMembershipCache({0})'.format(self.id).encode('ascii', 'backslashreplace')
+        return 'GroupMembership({0}, {1})'.format(self.group, reference_id(self._data.get('character')))
 
-    def evaluate(self, char):
-        if char.identifier in self.members:
-            return True
-        else:
-            if char.identifier in self.not_members:
-                return False
-            else:
-                return None
-    
-    def is_member(self, char):
-        if char.identifier in self.members:
-            return True
+    @classmethod
+    def groups_for(cls, character):
+        """Return the ids of the groups the character is a member of."""
+        return list(cls.objects(character=character).scalar('group'))
+
+    @classmethod
+    def members_of(cls, group):
+        """Return a queryset of the characters that are members of the group."""
+        group = getattr(group, 'id', group)
+        ids = [reference_id(i) for i in cls.objects(group=group).no_dereference().scalar('character')]
+        return EVECharacter.objects(id__in=ids)
+
+    @classmethod
+    def store(cls, character, added=(), removed=()):
+        """Apply a membership delta for a single character."""
+
+        if not added and not removed:
+            return
+
+        if removed:
+            cls.objects(character=character, group__in=list(removed)).delete()
+
+        now = datetime.utcnow()
+        for group in added:
+            # Upsert rather than insert so that concurrent refreshes of the same character can't collide.
+            cls.objects(group=group, character=character).update_one(upsert=True, set__modified=now)
+
+        # Touch the character so that anything cached against its group memberships (e.g. its permissions) expires.
+        EVECharacter.objects(id=character.id).update_one(set__modified=now)
+
+    @classmethod
+    def refresh_characters(cls, characters):
+        """Re-evaluate every group for each of the given characters, storing only the differences."""
+
+        snapshot = compiled_groups()
+
+        for character in characters:
+            current = set(g.id for g in snapshot.evaluate(character.owner, character))
+            stored = set(cls.groups_for(character))
+            cls.store(character, current - stored, stored - current)
+
+    @classmethod
+    def refresh_group(cls, group, characters=None):
+        """Re-evaluate a group for the given characters (or for every owned character if none are given), then
+        propagate any resulting membership changes to the groups that depend on it through nested group rules.
+
+        Dependent groups are visited in topological order and only for the characters whose membership of one of their
+        dependencies actually changed; their nested group rules are answered from the index rather than re-evaluated.
+        """
+
+        snapshot = compiled_groups()
+
+        if group not in snapshot.groups:
+            cls.objects(group=group).delete()
+            return
+
+        changed = {group: cls._refresh_group(snapshot, group, characters)}
+
+        for dependent, dependencies in Group.dependents(group):
+            affected = set()
+            for dependency in dependencies:
+                affected.update(changed.get(dependency, ()))
+
+            if affected and dependent in snapshot.groups:
+                changed[dependent] = cls._refresh_group(snapshot, dependent, affected)
+
+    @classmethod
+    def _refresh_group(cls, snapshot, group, characters):
+        """Re-evaluate a single group, returning the ids of the characters whose membership changed."""
+
+        compiled = snapshot.groups[group]
+
+        if characters is None:
+            characters = EVECharacter.objects(owner__ne=None)
+            stored = cls.objects(group=group)
+            nested = cls.objects(group__in=list(compiled.dependencies))
         else:
-            return False
-    
-    def is_not_member(self, char):
-        if char.identifier in self.not_members:
+            characters = EVECharacter.objects(id__in=list(characters))
+            ids = list(characters.scalar('id'))
+            stored = cls.objects(group=group, character__in=ids)
+            nested = cls.objects(group__in=list(compiled.dependencies), character__in=ids)
+
+        stored = set(reference_id(i) for i in stored.no_dereference().scalar('character'))
+
+        # The memberships of the groups this one nests, already brought up to date by refresh_group.
+        memberships = defaultdict(set)
+        if compiled.dependencies:
+            for dependency, character in nested.no_dereference().scalar('group', 'character'):
+                memberships[reference_id(character)].add(dependency)
+
+        changed = set()
+
+        for character in characters:
+            known = dict((i, i in memberships[character.id]) for i in compiled.dependencies)
+            member = bool(snapshot.evaluate_group(character.owner, character, group, known=known))
+
+            if member != (character.id in stored):
+                cls.store(character, [group] if member else (), () if member else [group])
+                changed.add(character.id)
+
+        return changed
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the entire index."""
+        cls.refresh_characters(EVECharacter.objects(owner__ne=None))
+        cls.objects(character__nin=EVECharacter.objects(owner__ne=None).scalar('id')).delete()
+
+    @staticmethod
+    def schedule(fn, *args):
+        """Run index maintenance in the background, or immediately in development, like the other save signals."""
+
+        if config.get('debug', False):
+            return fn(*args)
+
+        def log_error(receipt):
+            try:
+                receipt.result()
+            except:
+                log.exception("Error updating the group membership index.")
+
+        validator_pool.submit(fn, *args).add_done_callback(log_error)
+
+    @staticmethod
+    def changed(document, fields):
+        """Determine if a document is new or any of the given fields have changed, from within a pre_save signal."""
+
+        if document._created or document.pk is None:
             return True
-        else:
-            return False
-    
-    def set_is_member(self, char):
-        #print "    Setting Char({char}) IS in Group({group})".format(char=char.name, group=self.id)
-        if char.identifier not in self.members:
-            self.members.append(char.identifier)
 
-        if char.identifier in self.not_members:
-            self.not_members.remove(char.identifier)
+        changed = document._get_changed_fields()
+        db_fields = [document._fields[name].db_field for name in fields]
+        return any(f.split('.')[0] in db_fields for f in changed)
 
-        self.save()
-        return True
-    
-    def set_is_not_member(self, char):
-        #print "    Setting Char({char}) IS NOT in Group({group})".format(char=char.name, group=self.id)
-        if char.identifier not in self.not_members:
-            self.not_members.append(char.identifier)
+    @classmethod
+    def pre_save(cls, sender, document, **kwargs):
+        document._membership_changed = cls.changed(document, {
+                EVECharacter: cls.CHARACTER_FIELDS,
+                EVECredential: cls.CREDENTIAL_FIELDS,
+                User: cls.USER_FIELDS,
+            }[sender])
 
-        if char.identifier in self.members:
-            self.members.remove(char.identifier)
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        if not getattr(document, '_membership_changed', False):
+            return
+
+        document._membership_changed = False
+
+        if sender is EVECharacter:
+            cls.schedule(cls.refresh_characters, [document])
+        else:
+            cls.schedule(cls.refresh_characters, list(document.characters))
 
-        self.save()
-        return True
+    @classmethod
+    def credential_pre_delete(cls, sender, document, **kwargs):
+        document._membership_characters = list(document.characters)
+
+    @classmethod
+    def credential_post_delete(cls, sender, document, **kwargs):
+        cls.schedule(cls.refresh_characters, getattr(document, '_membership_characters', []))
+
+    @classmethod
+    def character_post_delete(cls, sender, document, **kwargs):
+        cls.objects(character=document).delete()
 
 
 @update_modified_timestamp.signal
@@ -99,7 +247,7 @@ class Group(Document):
     meta = dict(
             collection = 'Groups',
             allow_inheritance = False,
-            indexes = [],
+            indexes = ['_dependencies'],
         )
 
     id = StringField(db_field='_id', primary_key=True)
@@ -117,6 +265,11 @@ class Group(Document):
     modified = DateTimeField(db_field='m', default=datetime.utcnow)
     _permissions = ListField(ReferenceField(Permission), db_field='p')
 
+    # The group dependency graph: the ids of the groups this group's rules nest, and this group's position in a
+    # topological ordering of the graph (0 for groups which nest no others). Both are maintained on save.
+    _dependencies = ListField(StringField(), db_field='d', default=list)
+    _rank = IntField(db_field='dr', default=0)
+
     # Permissions
     VIEW_PERM = 'core.group.view.{group_id}'
     EDIT_ACL_PERM = 'core.group.edit.acl.{group_id}'
@@ -131,24 +284,135 @@ class Group(Document):
 
     @classmethod
     def pre_save(cls, sender, document, **kwargs):
+        document._dependencies = document.dependency_ids()
         document.cycle_check()
 
+        rank = document.calculate_rank()
+        document._rank_changed = rank != document._rank
+        document._rank = rank
+
+        # Work out which part of the membership index this save invalidates: every character if the rules changed,
+        # otherwise only the characters added to or removed from the join and request lists.
+        if GroupMembership.changed(document, GroupMembership.GROUP_RULE_FIELDS):
+            document._membership_changed = None
+        elif GroupMembership.changed(document, GroupMembership.GROUP_MEMBER_FIELDS):
+            previous = Group.objects(id=document.id).only(*GroupMembership.GROUP_MEMBER_FIELDS).first()
+            before = set(reference_ids(previous, 'join_members') + reference_ids(previous, 'request_members')) \
+                    if previous else set()
+            after = set(reference_ids(document, 'join_members') + reference_ids(document, 'request_members'))
+            document._membership_changed = before ^ after
+        else:
+            document._membership_changed = set()
+
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        CacheVersion.bump(PERMISSION_CACHE_VERSION)
+
+        if getattr(document, '_rank_changed', False):
+            document._rank_changed = False
+            Group.update_ranks(document.id)
+
+        changed = getattr(document, '_membership_changed', set())
+        document._membership_changed = set()
+
+        if changed is None or changed:
+            GroupMembership.schedule(GroupMembership.refresh_group, document.id, changed)
+
     @classmethod
     def pre_delete(cls, sender, document, **kwargs):
         references = document.get_references()
         if len(references):
             raise GroupReferenceException(references)
 
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        GroupMembership.objects(group=document.id).delete()
+        CacheVersion.bump(PERMISSION_CACHE_VERSION)
+
     def get_references(self):
-        # mongo is stupid and/or I am stupid, so I cannot figure out how to do
-        # this in the db.
-        ids = [g.id for g in Group.objects().only('rules', 'join_rules', 'request_rules')
-               if any(isinstance(r, ACLGroupMembership) and r.group.id == self.id
-                      for r in itertools.chain(g.rules, g.join_rules, g.request_rules))]
-        groups = Group.objects(**{'id__in': ids})
-        assert len(ids) == len(groups)
-        return groups
-    
+        """Returns the groups whose rules nest this group."""
+        return Group.objects(_dependencies=self.id)
+
+    def dependency_ids(self):
+        """Returns the ids of the groups this group's rules nest, read from the rules rather than the stored graph."""
+
+        ids = []
+
+        for rule in itertools.chain(self.rules, self.join_rules, self.request_rules):
+            if isinstance(rule, ACLGroupMembership):
+                group = reference_id(rule._data.get('group'))
+                if group not in ids:
+                    ids.append(group)
+
+        return ids
+
+    def calculate_rank(self):
+        dependencies = self._dependencies
+        if not dependencies:
+            return 0
+
+        return max(Group.objects(id__in=dependencies).scalar('_rank') or [0]) + 1
+
+    @staticmethod
+    def update_ranks(group):
+        """Propagate a change in the rank of the given group to every group that depends on it."""
+
+        pending = [group]
+
+        while pending:
+            current = pending.pop(0)
+
+            for dependent in Group.objects(_dependencies=current).only('_dependencies', '_rank'):
+                rank = dependent.calculate_rank()
+                if rank != dependent._rank:
+                    # Updated directly: this changes neither rules nor membership, so skip the save signals.
+                    Group.objects(id=dependent.id).update_one(set___rank=rank)
+                    pending.append(dependent.id)
+
+    @staticmethod
+    def dependents(group):
+        """Returns (id, dependency ids) for each group that depends on the given group, directly or through other
+        nested groups, in topological order."""
+
+        found = dict()
+        frontier = [group]
+
+        while frontier:
+            query = Group.objects(_dependencies__in=frontier).scalar('id', '_dependencies', '_rank')
+            frontier = []
+
+            for id, dependencies, rank in query:
+                if id not in found:
+                    found[id] = (rank, dependencies)
+                    frontier.append(id)
+
+        return [(id, found[id][1]) for id in sorted(found, key=lambda i: found[i][0])]
+
+    @staticmethod
+    def rebuild_dependencies():
+        """Rebuild the stored dependency graph from every group's rules, for groups saved before it existed."""
+
+        groups = list(Group.objects.only('rules', 'join_rules', 'request_rules'))
+        graph = dict((g.id, g.dependency_ids()) for g in groups)
+        ranks = dict()
+
+        def rank(id, path=()):
+            if id in path:
+                raise CyclicGroupReference(list(path))
+
+            if id not in ranks:
+                ranks[id] = max([rank(i, path + (id, )) + 1 for i in graph.get(id, ()) if i in graph] or [0])
+
+            return ranks[id]
+
+        for id in graph:
+            Group.objects(id=id).update_one(set___dependencies=graph[id], set___rank=rank(id))
+
+    @property
+    def members(self):
+        """Returns the characters in this group, according to the membership index."""
+        return GroupMembership.members_of(self)
+
     @property
     def permissions(self):
         """Returns the permissions that this group grants as Permission objects. Note, this is mostly here for backwards
@@ -221,76 +485,44 @@ class Group(Document):
             aft = datetime.utcnow()
             #print "ELSE FOR GROUP {} TOOK: {}".format(self.id, aft-bef)
         
-        def cache_result(group, result):
-            if result is not None:
-                cache = GroupMembershipCache.objects(id=group.id)
-
-                #print "Saving Cache Char({char}) in Group({group}, rule_set[{rules}]): {result}".format(char=character.name, group=self.id, rules=rule_set, result=result)
-
-                # if cache for this group already exists
-                if cache:
-                    cache = cache[0]
-                    if result is True:
-                        cache.set_is_member(character)
-                    else:
-                        cache.set_is_not_member(character)
-                else:
-                    # otherwise, create the group cache and add our first entry
-                    cache = GroupMembershipCache(id=group.id, rule_set=rule_set)
-                    if result is True:
-                        cache.set_is_member(character)
-                    else:
-                        cache.set_is_not_member(character)
-
-        def check_cache(group):
-            cache_search = GroupMembershipCache.objects(id=group.id, rule_set=rule_set)
-            if cache_search:
-                cache = cache_search[0]
-                result = cache.evaluate(character)
-                #print "Cache Check Result on group({group}) with ruleset({rules}): {result}".format(result=result, group=group.id, rules=rule_set)
-                if result is not None:
-                    return result
-        
-        # use cached group membership lists
-        #cache = check_cache(self)
-        #if cache is not None:
-        #    return cache
-
-        # properly evaluate rules and cache the results
+        # properly evaluate rules
         for rule in rules:
             # print "Evaluating Rules for Char({char}) is in Group({group}): {rule}".format(char=character.name, group=self.id, rule=rule)
             result = rule.evaluate(user, character, _context=_context)
             if result is not None:
-        #        cache_result(self, result)
                 return result
-        
-        # no rules matched, save a false for group evaluation
-        result = False
-        #cache_result(self, False)
 
         return False  # deny by default
 
-    def cycle_check(self, rules=None, groups_referenced=None):
-        if groups_referenced is None:
-            groups_referenced = []
+    def cycle_check(self):
+        """Raise CyclicGroupReference if this group's rules nest it, directly or through other groups.
 
-        if rules is None:
-            self.cycle_check(self.request_rules, groups_referenced)
-            self.cycle_check(self.join_rules, groups_referenced)
-            self.cycle_check(self.rules, groups_referenced)
-            return
+        The groups this one nests are read from its (possibly unsaved) rules, all others from the stored graph."""
 
-        if self.id in groups_referenced:
-            raise CyclicGroupReference(list(groups_referenced))
-        groups_referenced.append(self.id)
+        graph = {self.id: self.dependency_ids()}
+        verified = set()
+        path = []
 
-        try:
-            for rule in rules:
-                if isinstance(rule, ACLGroupMembership):
-                    rule.group.cycle_check(groups_referenced=groups_referenced)
-        finally:
-            id = groups_referenced.pop()
-            assert id == self.id
+        def visit(id):
+            if id in path:
+                raise CyclicGroupReference(list(path))
+
+            if id in verified:
+                return
+
+            if id not in graph:
+                graph[id] = Group.objects(id=id).scalar('_dependencies').first() or []
+
+            path.append(id)
+            try:
+                for dependency in graph[id]:
+                    visit(dependency)
+            finally:
+                path.pop()
+
+            verified.add(id)
+
+        visit(self.id)
 
     @staticmethod
     def create(id, title, user, rules=[]):
@@ -372,4 +604,14 @@ class Group(Document):
 
 
 signals.pre_save.connect(Group.pre_save, sender=Group)
+signals.post_save.connect(Group.post_save, sender=Group)
 signals.pre_delete.connect(Group.pre_delete, sender=Group)
+signals.post_delete.connect(Group.post_delete, sender=Group)
+
+for _sender in (EVECharacter, EVECredential, User):
+    signals.pre_save.connect(GroupMembership.pre_save, sender=_sender)
+    signals.post_save.connect(GroupMembership.post_save, sender=_sender)
+
+signals.pre_delete.connect(GroupMembership.credential_pre_delete, sender=EVECredential)
+signals.post_delete.connect(GroupMembership.credential_post_delete, sender=EVECredential)
+signals.post_delete.connect(GroupMembership.character_post_delete, sender=EVECharacter)
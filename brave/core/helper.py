@@ -1,37 +1,135 @@
-def get_membership(info):
-    print info
-    from brave.core.character.model import EVEAlliance, EVECorporation, EVECharacter
-    # don't remove any of model imports even if they seem unused
-    # they have to be imported because of how mongoengine works
-    # also, this import has to be inside the method, because
-    # otherwise paster can't find the module
+from datetime import datetime
+
+from brave.core.util.cache import LRUCache, CacheVersion
+
+
+class EntityResolver(object):
+    """Resolves the corporations and alliances named in EVE API results to their documents.
+
+    Documents are created the first time they are seen and saved again only if their name (or, for corporations,
+    alliance) has changed.  Resolved documents are remembered for ttl seconds, so characters of the same corporation
+    don't repeat the same queries.
+    """
+
+    def __init__(self, ttl=300, maxsize=16384):
+        self.cache = LRUCache(maxsize, ttl)
+
+    @staticmethod
+    def _models():
+        # These have to be imported here, because the character models import this module.
+        from brave.core.character.model import EVEAlliance, EVECorporation
+        return EVEAlliance, EVECorporation
+
+    @staticmethod
+    def pair(info):
+        """Return the (corporation id, corporation name, alliance id, alliance name) of an evelink character result."""
+
+        # This is a stupid edge-case to cover inconsistency between API calls.
+        alliance = info.get('alliance') or {}
+
+        return (info['corp']['id'], info['corp']['name'],
+                alliance.get('id') or None, alliance.get('name') or None)
+
+    def alliance(self, identifier, name, known=None):
+        """Return the alliance document with the given identifier and name, if any.
+
+        If known is given it is the already-loaded document, or False if there isn't one."""
+
+        EVEAlliance, _ = self._models()
+
+        if not identifier:
+            return None
+
+        alliance = self.cache.get((EVEAlliance, identifier))
+
+        if alliance is None:
+            alliance = EVEAlliance.objects(identifier=identifier).first() if known is None else known or None
+
+        if alliance is None:
+            alliance, _ = EVEAlliance.objects.get_or_create(identifier=identifier, defaults=dict(name=name))
+
+        if alliance.name != name:
+            EVEAlliance.objects(id=alliance.id).update_one(set__name=name, set___name=name.lower() if name else None,
+                                                           set__modified=datetime.utcnow())
+            CacheVersion.bump(EVEAlliance.cache_version())
+            alliance.name = name
 
-    # This is a stupid edge-case to cover inconsistency between API calls.
-    allianceID = info['alliance']['id']
-    allianceName = info['alliance']['name'] if info['alliance']['name'] else None
-    corporationName = info['corp']['name']
+        return self.cache.set((EVEAlliance, identifier), alliance)
 
+    def corporation(self, identifier, name, alliance, known=None):
+        """Return the corporation document with the given identifier, name and alliance document.
 
-    alliance, created = EVEAlliance.objects.get_or_create(
-            identifier=allianceID,
-            defaults=dict(name=allianceName)
-        ) if allianceID else (None, False)
+        If known is given it is the already-loaded document, or False if there isn't one."""
 
-    if alliance and not created and alliance.name != allianceName:
-        alliance.name = allianceName
-        alliance = alliance.save()
+        _, EVECorporation = self._models()
 
-    corporation, created = EVECorporation.objects.get_or_create(
-            identifier=info['corp']['id'],
-            defaults=dict(name=corporationName, alliance=alliance)
-        )
+        corporation = self.cache.get((EVECorporation, identifier))
 
-    if corporation.name != corporationName:
-        corporation.name = corporationName
+        if corporation is None:
+            corporation = EVECorporation.objects(identifier=identifier).first() if known is None else known or None
 
-    corporation.alliance = alliance
+        if corporation is None:
+            corporation, _ = EVECorporation.objects.get_or_create(
+                    identifier = identifier,
+                    defaults = dict(name=name, alliance=alliance)
+                )
 
-    if corporation._changed_fields:
-        corporation = corporation.save()
+        changes = dict()
 
-    return corporation, alliance
\ No newline at end of file
+        if corporation.name != name:
+            changes['set__name'] = corporation.name = name
+            changes['set___name'] = name.lower() if name else None
+
+        current = corporation._data.get('alliance')
+        current = getattr(current, 'id', current)
+
+        if current != (alliance.id if alliance is not None else None):
+            changes['set__alliance'] = corporation.alliance = alliance
+
+        if changes:
+            EVECorporation.objects(id=corporation.id).update_one(set__modified=datetime.utcnow(), **changes)
+            CacheVersion.bump(EVECorporation.cache_version())
+
+        return self.cache.set((EVECorporation, identifier), corporation)
+
+    def resolve(self, info):
+        """Return the (corporation, alliance) documents for an evelink character result."""
+        return self.resolve_many([self.pair(info)])[0]
+
+    def resolve_many(self, pairs):
+        """Return the (corporation, alliance) documents for each of many (corporation id, corporation name,
+        alliance id, alliance name) tuples, loading any not already cached with one query per kind of entity."""
+
+        EVEAlliance, EVECorporation = self._models()
+        pairs = list(pairs)
+
+        missing = lambda cls, ids: [i for i in set(ids) if i and (cls, i) not in self.cache]
+        alliances = missing(EVEAlliance, (p[2] for p in pairs))
+        corporations = missing(EVECorporation, (p[0] for p in pairs))
+
+        # Whatever we looked up and didn't find doesn't exist yet, so there's no point looking for it again.
+        known = dict(((EVEAlliance, i), False) for i in alliances)
+        known.update(((EVECorporation, i), False) for i in corporations)
+
+        if alliances:
+            known.update(((EVEAlliance, a.identifier), a) for a in EVEAlliance.objects(identifier__in=alliances))
+        if corporations:
+            known.update(((EVECorporation, c.identifier), c) for c in EVECorporation.objects(
+                    identifier__in=corporations))
+
+        results = []
+        for corporation, corporation_name, alliance, alliance_name in pairs:
+            alliance = self.alliance(alliance, alliance_name, known.get((EVEAlliance, alliance)))
+            corporation = self.corporation(corporation, corporation_name, alliance,
+                                           known.get((EVECorporation, corporation)))
+            results.append((corporation, alliance))
+
+        return results
+
+
+resolver = EntityResolver()
+
+
+def get_membership(info):
+    """Return the (corporation, alliance) documents for an evelink character result, creating or updating them."""
+    return resolver.resolve(info)
@@ -147,7 +147,12 @@ class EVECredential(Document):
 
             raise
 
-        char.corporation, char.alliance = get_membership(info)
+        # A reference is marked changed whenever it's assigned (the stored DBRef never equals the document), so only
+        # assign those which differ, lest every refresh look like a change of corporation.
+        for field, value in zip(('corporation', 'alliance'), get_membership(info)):
+            current = char._data.get(field)
+            if getattr(current, 'id', current) != getattr(value, 'id', value):
+                setattr(char, field, value)
 
         char.name = info['name']
         char.owner = self.owner
@@ -0,0 +1,132 @@
+# encoding: utf-8
+
+"""Matching permission strings against a set of held permissions.
+
+A PermissionMatcher is built once from a set of Permission (and WildcardPermission) documents and then answers, in
+time proportional to the number of segments in the permission being checked rather than the size of the set:
+
+* grants(permission): does any held permission grant this permission?  (Permission.set_grants_permission)
+* granted_by(permission): does this permission, read as a wildcard, grant any held permission?
+  (the "has any permission" checks)
+
+Both follow WildcardPermission.grants_permission exactly: a '*' segment matches any single segment, and a trailing '*'
+segment additionally matches any number of further segments. Plain Permissions only ever match their exact id.
+"""
+
+from __future__ import unicode_literals
+
+from brave.core.permission.model import Permission, WildcardPermission, GRANT_WILDCARD
+
+
+class Node(object):
+    __slots__ = ('children', 'terminal', 'tail')
+
+    def __init__(self):
+        self.children = dict()
+        self.terminal = False  # A permission ends at this node.
+        self.tail = False  # A permission ending in a wildcard segment continues from this node.
+
+    def insert(self, segments):
+        """Add a permission ending at the node for the given segments, returning that node's parent."""
+
+        parent = self
+
+        for segment in segments[:-1]:
+            parent = parent.children.setdefault(segment, Node())
+
+        parent.children.setdefault(segments[-1], Node()).terminal = True
+        return parent
+
+
+class PermissionMatcher(object):
+    """A segment trie over a set of permissions."""
+
+    def __init__(self, permissions=()):
+        self.permissions = []
+        self.exact = set()  # The ids of every held permission, which trivially grant themselves.
+        self.wildcards = Node()  # Held WildcardPermissions, by segment, with '*' segments matching anything.
+        self.literals = Node()  # Every held permission id, by segment, with '*' segments taken literally.
+
+        for permission in permissions:
+            self.add(permission)
+
+    def __len__(self):
+        return len(self.permissions)
+
+    def __iter__(self):
+        return iter(self.permissions)
+
+    def add(self, permission):
+        self.permissions.append(permission)
+        self.exact.add(permission.id)
+        self.literals.insert(permission.id.split('.'))
+
+        if isinstance(permission, WildcardPermission):
+            segments = permission.id.split('.')
+            parent = self.wildcards.insert(segments)
+
+            if segments[-1] == GRANT_WILDCARD:
+                parent.tail = True
+
+    def grants(self, permission):
+        """Return True if any held permission grants the given permission (a string or Permission)."""
+
+        if isinstance(permission, Permission):
+            permission = permission.id
+
+        if permission in self.exact:
+            return True
+
+        segments = permission.split('.')
+        pending = [(self.wildcards, 0)]
+
+        while pending:
+            node, depth = pending.pop()
+
+            if depth == len(segments):
+                if node.terminal:
+                    return True
+                continue
+
+            if node.tail:
+                return True
+
+            for child in (node.children.get(segments[depth]), node.children.get(GRANT_WILDCARD)):
+                if child is not None:
+                    pending.append((child, depth + 1))
+
+        return False
+
+    def granted_by(self, permission):
+        """Return True if the given permission string, read as a WildcardPermission, grants any held permission."""
+
+        if isinstance(permission, Permission):
+            permission = permission.id
+
+        segments = permission.split('.')
+        last = len(segments) - 1
+        pending = [(self.literals, 0)]
+
+        while pending:
+            node, depth = pending.pop()
+
+            if depth == len(segments):
+                if node.terminal:
+                    return True
+                continue
+
+            segment = segments[depth]
+
+            if segment != GRANT_WILDCARD:
+                child = node.children.get(segment)
+                if child is not None:
+                    pending.append((child, depth + 1))
+                continue
+
+            # A trailing wildcard matches this and any deeper segments, so any held permission below here will do.
+            if depth == last and node.children:
+                return True
+
+            pending.extend((child, depth + 1) for child in node.children.itervalues())
+
+        return False
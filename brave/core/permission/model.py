@@ -2,13 +2,18 @@
 
 from __future__ import unicode_literals
 
-from mongoengine import Document, StringField
+from mongoengine import Document, StringField, signals
+
+from brave.core.util.cache import CacheVersion
 
 
 log = __import__('logging').getLogger(__name__)
 
 GRANT_WILDCARD = '*'
 
+# The CacheVersion bumped whenever a change to groups or permissions may change any character's effective permissions.
+PERMISSION_CACHE_VERSION = 'permissions'
+
 
 def create_permission(permission, description=None):
     """This function creates and returns a permission object of the correct class (Permission vs. WildcardPermission).
@@ -78,9 +83,15 @@ class Permission(Document):
     
     @staticmethod
     def set_grants_permission(perms, permission):
-        """Loops through a set of permissions and checks if any of them grants the desired permission."""
+        """Checks if any of a set of permissions grants the desired permission. When checking the same set repeatedly,
+        pass a PermissionMatcher built from it rather than the permissions themselves."""
+        
+        from brave.core.permission.matcher import PermissionMatcher
         
-        return any(p.grants_permission(permission) for p in perms)
+        if not isinstance(perms, PermissionMatcher):
+            perms = PermissionMatcher(perms)
+        
+        return perms.grants(permission)
     
     def __eq__(self, other):
         if isinstance(other, Permission):
@@ -100,6 +111,14 @@ class Permission(Document):
     @property
     def revoke_perm(self):
         return self.get_perm('REVOKE')
+
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        CacheVersion.bump(PERMISSION_CACHE_VERSION)
+
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        CacheVersion.bump(PERMISSION_CACHE_VERSION)
         
 class WildcardPermission(Permission):
     
@@ -109,13 +128,21 @@ class WildcardPermission(Permission):
     def get_permissions(self):
         """Returns all Permissions granted by this Permission"""
         
-        from brave.core.application.model import Application
-        
-        # Mongoengine has no way to find objects based on a regex (as far as I can tell at least...)
         perms = set()
 
-        # Loops through all of the permissions, checking if this permission grants access to that permission.
-        for perm in Permission.objects():
+        # Only permissions sharing this permission's literal prefix (the segments before the first wildcard) can
+        # match, and an anchored prefix query can use the _id index.
+        prefix = []
+        for segment in self.id.split('.'):
+            if segment == GRANT_WILDCARD:
+                prefix = ''.join(prefix)
+                break
+            prefix.append(segment + '.')
+        else:
+            prefix = self.id
+
+        # Check the candidates against the full pattern.
+        for perm in Permission.objects(id__startswith=prefix):
             if self.grants_permission(perm.id):
                 perms.add(perm)
         
@@ -154,3 +181,8 @@ class WildcardPermission(Permission):
                 return False
         
         return True
+
+
+for _sender in (Permission, WildcardPermission):
+    signals.post_save.connect(Permission.post_save, sender=_sender)
+    signals.post_delete.connect(Permission.post_delete, sender=_sender)
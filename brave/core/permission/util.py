@@ -2,7 +2,7 @@
 
 from __future__ import unicode_literals
 
-from brave.core.permission.model import WildcardPermission
+from web.core import request
 from web.core.http import HTTPForbidden
 from brave.core.util.predicate import authenticate
 import web.auth
@@ -10,6 +10,84 @@ import web.auth
 log = __import__('logging').getLogger(__name__)
 
 
+class PermissionContext(object):
+    """The effective permissions of a user, resolved at most once and with every distinct check memoized.
+
+    One context is kept per request (see request_permissions), so that stacked permission decorators and the checks
+    made by the controllers they wrap share a single evaluation. The hits and misses counters record how many checks
+    were answered from the memo and how many had to be evaluated."""
+
+    ENVIRON_KEY = 'brave.permissions'
+
+    def __init__(self, user):
+        self.user = user
+        self.hits = 0
+        self.misses = 0
+        self._checks = dict()
+        self._characters = None
+
+    def __repr__(self):
+        return 'PermissionContext({0}, hits={1}, misses={2})'.format(self.user, self.hits, self.misses)
+
+    @property
+    def characters(self):
+        """The user's characters, primary first, each with a matcher over its permissions."""
+
+        if self._characters is None:
+            characters = list(self.user.characters) if self.user else []
+            primary = self.user.primary if self.user else None
+
+            if primary in characters:
+                characters.remove(primary)
+                characters.insert(0, primary)
+
+            self._characters = [(c, c.permission_matcher()) for c in characters]
+
+        return self._characters
+
+    def _check(self, kind, permission, check):
+        key = (kind, permission)
+
+        try:
+            result = self._checks[key]
+        except KeyError:
+            self.misses += 1
+            result = self._checks[key] = any(check(matcher, permission) for c, matcher in self.characters)
+        else:
+            self.hits += 1
+
+        return result
+
+    def has_permission(self, permission):
+        """Returns true if any of the user's characters has the permission."""
+        return self._check('has', permission, lambda matcher, p: matcher.grants(p))
+
+    def has_any_permission(self, permission):
+        """Returns true if any of the user's characters has a permission that would be granted by permission."""
+        return self._check('any', permission, lambda matcher, p: matcher.granted_by(p) or matcher.grants(p))
+
+
+def request_permissions(user=None):
+    """Returns the PermissionContext of the current request for the given (or currently authenticated) user. Outside
+    of a request a new, unshared context is returned."""
+
+    if user is None:
+        user = web.auth.user._current_obj()
+
+    try:
+        environ = request.environ
+    except TypeError:  # No request is active.
+        return PermissionContext(user)
+
+    context = environ.get(PermissionContext.ENVIRON_KEY)
+
+    # Authentication may change during the request (e.g. on log in or out.)
+    if context is None or context.user != user:
+        context = environ[PermissionContext.ENVIRON_KEY] = PermissionContext(user)
+
+    return context
+
+
 def prepare_runtime_permission(self, perm=None, runkw=None, args=None, kwargs=None):
     """This decorator handles the runtime permission aspects of the user permission checking decorators."""
     permission = perm
@@ -61,20 +139,17 @@ def user_has_permission(perm=None, **runkw):
                 log.debug('User not found.')
                 raise HTTPForbidden()
 
+            context = request_permissions(user)
+
             # User has no characters, so they have no permissions.
-            if not len(user.characters):
+            if not context.characters:
                 log.debug('User has no characters.')
                 raise HTTPForbidden()
 
-            # Cycle through the user's permissions, and if they have it leave the method.
-            if user.primary.has_permission(permission):
+            # Check the user's characters, primary first, and if any have it leave the method.
+            if context.has_permission(permission):
                 return function(self, *args, **kwargs)
 
-            # Cycle through the user's permissions, and if they have it leave the method.
-            for c in user.characters:
-                if c.has_permission(permission):
-                    return function(self, *args, **kwargs)
-
             # User doesn't have this permission, so we raise HTTPForbidden
             log.debug('User has no characters with that permission.')
             raise HTTPForbidden()
@@ -107,19 +182,15 @@ def user_has_any_permission(perm=None, **runkw):
                 log.debug('User not found.')
                 raise HTTPForbidden()
 
+            context = request_permissions(user)
+
             # User has no characters, so they have no permissions.
-            if not len(user.characters):
+            if not context.characters:
                 log.debug('User has no characters.')
                 raise HTTPForbidden()
 
-            p = WildcardPermission.objects(id=permission).first()
-            if not p:
-                p = WildcardPermission(id=permission)
-            for permID in user.permissions:
-                if p.grants_permission(permID.id):
-                    return function(self, *args, **kwargs)
-                if permID.grants_permission(p.id):
-                    return function(self, *args, **kwargs)
+            if context.has_any_permission(permission):
+                return function(self, *args, **kwargs)
 
             # User doesn't have this permission, so we raise HTTPForbidden
             log.debug('User has no characters with that permission.')
@@ -1,14 +1,20 @@
 from mongoengine import Document, EmbeddedDocument, EmbeddedDocumentField, StringField, EmailField, DateTimeField, BooleanField, ReferenceField, ListField
+from time import time
+from threading import Lock
 from datetime import datetime
 
 from brave.core.character.model import EVECharacter
 from brave.core.account.model import User
 from brave.core.key.model import EVECredential
 from brave.core.util.field import IPAddressField
+from brave.core.util.cache import LRUCache, CacheVersion
 from brave.core.person.util import get_type, object_repr
 
 log = __import__('logging').getLogger(__name__)
 
+# The CacheVersion bumped whenever the person aliases are rewritten wholesale; see PersonAlias.
+ALIAS_CACHE_VERSION = 'person.aliases'
+
 
 class Person(Document):
     meta = dict(
@@ -89,31 +95,37 @@ class Person(Document):
         return True
 
     def check_for_conflicts(self, check_ip=False):
-        """Checks for conflicts between this Person and every other person."""
-        for c in self._characters:
-            people = Person.objects(_characters=c)
-            if len(people) > 1:
-                Person.merge(people[0], people[1], (c, "component_match"))
-
-        for u in self._users:
-            people = Person.objects(_users=u)
-            if len(people) > 1:
-                Person.merge(people[0], people[1], (u, "component_match"))
-
-        for k in self._keys:
-            people = Person.objects(_keys=k)
-            if len(people) > 1:
-                Person.merge(people[0], people[1], (k, "component_match"))
+        """Checks for conflicts between this Person and every other person, merging any found. Returns the Person
+        that this Person's components belong to afterwards (which may be a different Person, if this one was merged
+        into it.)"""
 
+        fields = ['_characters', '_users', '_keys']
         if check_ip:
-            for i in self._ips:
-                people = Person.objects(_ips=i)
-                if len(people) > 1:
-                    Person.merge(people[0], people[1], (i, "component_match"))
+            fields.append('_ips')
+
+        person = self
+        merged = True
+
+        # Merging brings in new components, which may themselves conflict with yet another person.
+        while merged:
+            merged = False
+
+            for field in fields:
+                components = getattr(person, field)
+                if not components:
+                    continue
+
+                query = {field + '__in': list(components), 'id__ne': person.id}
+                for other in Person.objects(**query):
+                    match = next(c for c in getattr(other, field) if c in components)
+                    person = Person.merge(person, other, (match, "component_match"))
+                    merged = True
+
+        return person
 
     @staticmethod
     def merge(person1, person2, reason, suppress_events=False):
-        """Merges person1 and person2 into one person."""
+        """Merges person1 and person2 into one person, returning the surviving Person."""
         match, reason_string = reason
         person = person1 if person1.complexity >= person2.complexity else person2
         tbd_person = person2 if person1.complexity >= person2.complexity else person1
@@ -152,24 +164,30 @@ class Person(Document):
         person.save()
         tbd_person.delete()
 
+        PersonAlias.union(tbd_person.id, person.id)
+
+        from brave.core.ban.model import PersonBan
+        PersonBan.merged(tbd_person, person)
+
+        return person
+
     @property
     def bans(self):
 
         from brave.core.ban.model import PersonBan
 
-        bans = []
-        for b in PersonBan.objects:
-            if b.person == self:
-                bans.append(b)
+        return list(PersonBan.objects(orig_person=str(self.id)))
 
-        return bans
+    @property
+    def active_bans(self):
+        """The bans of this person that are currently enabled and unexpired."""
 
-    def banned(self, app=None, subarea=None):
-        bans = self.bans
-        for b in bans:
-            if not b.enabled:
-                continue
+        from brave.core.ban.model import PersonBan
 
+        return PersonBan.active_for(self)
+
+    def banned(self, app=None, subarea=None):
+        for b in self.active_bans:
             if b.ban_type == "global":
                 return b
 
@@ -220,12 +238,7 @@ class PersonEvent(Document):
     def current_person(self):
         """The Person that this event describes currently. Can be different than person, in the event that the person
         the event originally described was merged into another person."""
-        person = Person.objects(id=self.person)
-        if person:
-            return person.first()
-
-        person_merge = PersonEvent.objects(target_ident=self.person).first()
-        return person_merge.current_person
+        return Person.objects(id=PersonAlias.find(self.person)).first()
 
     @property
     def target(self):
@@ -297,5 +310,123 @@ class PersonEvent(Document):
         return "PersonEvent({e.id}, action={e.action}, person={e.person}".format(e=self)
 
 
+class PersonAlias(Document):
+    """A union-find forest over Person ids: every Person merged into another gets an alias pointing at the Person it
+    was merged into. Following the aliases from any Person id, past or present, leads to the Person it is now part of.
+
+    Paths are compressed as they are followed, and the links are cached in memory: a Person that has been merged away
+    never comes back, so a link only ever changes to point further along its own path, and even a stale cached link
+    still leads to the right place. Only the final Person of each path needs checking against the database.
+
+    The exception is regenerating the People collection (see generate_people), which may merge people the other way
+    round. It bumps a CacheVersion, checked at most once a minute, which clears the cached links; until then a cycle
+    of stale links is detected and the path followed again from the database."""
+
+    meta = dict(
+        collection='PersonAliases',
+        allow_inheritance=False,
+    )
+
+    # The id of the merged-away Person, and of the Person it was merged into (or one merged into later.)
+    id = StringField(db_field='_id', primary_key=True)
+    parent = StringField(db_field='p', required=True)
+
+    @staticmethod
+    def find(person):
+        """Returns the id of the current Person that the given Person (or Person id) was merged into, or the id itself
+        if it was never merged."""
+
+        alias_version.check()
+
+        start = current = str(getattr(person, 'id', person))
+        cached = True
+        path = []
+        seen = set()
+
+        while True:
+            if current in seen:
+                if not cached:
+                    log.error("Person aliases form a cycle at {0}.".format(current))
+                    return current
+
+                log.warning("Cached person aliases form a cycle at {0}; reloading them.".format(current))
+                alias_cache.clear()
+                current, cached, path, seen = start, False, [], set()
+
+            seen.add(current)
+            parent = alias_cache.get(current) if cached else None
+
+            if parent is None:
+                parent = PersonAlias.objects(id=current).scalar('parent').first()
+
+                if parent is None:
+                    break
+
+                alias_cache.set(current, parent)
+
+            path.append(current)
+            current = parent
+
+        # Point every alias on the path (except the last, which already does) directly at the current Person.
+        compress = path[:-1]
+        if compress:
+            PersonAlias.objects(id__in=compress).update(set__parent=current)
+            for alias in compress:
+                alias_cache.set(alias, current)
+
+        return current
+
+    @staticmethod
+    def rewritten():
+        """Records that the aliases have been rewritten wholesale, invalidating every process's cached links."""
+
+        CacheVersion.bump(ALIAS_CACHE_VERSION)
+        alias_cache.clear()
+
+    @staticmethod
+    def union(old, new):
+        """Records that the Person old was merged into the Person new."""
+
+        old, new = str(old), str(new)
+        PersonAlias.objects(id=old).update_one(upsert=True, set__parent=new)
+        alias_cache.set(old, new)
+
+    @staticmethod
+    def rebuild():
+        """Rebuilds the aliases from the recorded merge events, for merges made before aliases were kept."""
+
+        for event in PersonEvent.objects(action='merge', target_type='person').order_by('time'):
+            PersonAlias.union(event.target_ident, event.person)
+
+
+# Known aliases (merged-away Person id to the id it was merged into); see PersonAlias.
+alias_cache = LRUCache(65536)
+
+
+class AliasVersion(object):
+    """Clears alias_cache when the aliases have been rewritten, checking at most every interval seconds."""
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.value = None
+        self.checked = 0
+        self._lock = Lock()
+
+    def check(self):
+        if time() - self.checked <= self.interval:
+            return
+
+        with self._lock:
+            if time() - self.checked <= self.interval:
+                return  # Another thread got here first.
+
+            value = CacheVersion.current(ALIAS_CACHE_VERSION)
+
+            if self.value is not None and value != self.value:
+                alias_cache.clear()
+
+            self.value = value
+            self.checked = time()
 
 
+alias_version = AliasVersion()
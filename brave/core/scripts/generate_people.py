@@ -1,15 +1,40 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import sys
+import time
+from bson import ObjectId
 from brave.core import core_loadapp
-from brave.core.person.model import Person, PersonEvent
+from brave.core.person.model import Person, PersonEvent, PersonAlias
 
 if __name__ == "__main__":
     core_loadapp("config:"+sys.argv[1] if len(sys.argv) > 1 else None)
 
-def generate_people(dry_run=True, wipe_db=False):
+from brave.core.character.model import EVECharacter
+from brave.core.account.model import User
+from brave.core.key.model import EVECredential
+from brave.core.ban.model import PersonBan
+
+
+# Component types, as recorded in PersonEvents, and the Person field holding each.
+FIELDS = dict(character='_characters', user='_users', key='_keys', ip='_ips')
+
+# Components which Person.check_for_conflicts merges people over (it skips IPs by default.)
+CONFLICTING = ('character', 'user', 'key')
+
+
+def generate_people(dry_run=True, wipe_db=False, bulk=False, batch_size=1000):
     """Note: it is highly recommended that you only use this method on an empty People collection
-    Also note, this is untested for large and complex Person and PersonEVent collections, so use at your own risk."""
+    Also note, this is untested for large and complex Person and PersonEVent collections, so use at your own risk.
+
+    With bulk=True the events are replayed in memory instead (see replay_people), which is much faster but always
+    replaces the People collection, so requires wipe_db=True."""
+
+    if bulk:
+        if not wipe_db:
+            print("Bulk regeneration replaces the People collection; pass wipe_db=True to confirm.")
+            return
+
+        return replay_people(dry_run, batch_size)
 
     persons_modified = 0
     events_processed = 0
@@ -49,3 +74,203 @@ def generate_people(dry_run=True, wipe_db=False):
             Person.merge(p, e.target, (e.match, e.reason), suppress_events=True)
 
     print("Regenerated Person collection: {0} Persons modified, {1} Events processed.".format(persons_modified, events_processed))
+
+
+class Replay(object):
+    """The People collection as it stands after applying PersonEvents, held in memory.
+
+    People are tracked by id in a union-find forest (merged people point at the person they were merged into), each
+    current person maps to its components (by type and identifier), and each conflicting component maps back to the
+    person holding it, so that adding a component someone else holds merges the two just as check_for_conflicts
+    would.
+
+    Which of two people survives a merge is decided by Person.merge and recorded in the merge event that follows, so
+    replaying a merge event makes its survivor the current person even if the two were already merged the other way
+    round."""
+
+    def __init__(self):
+        self.parents = dict()
+        self.components = dict()
+        self.holders = dict()
+
+    def find(self, person):
+        root = person
+        while root in self.parents:
+            root = self.parents[root]
+
+        while person != root:
+            parent = self.parents[person]
+            self.parents[person] = root
+            person = parent
+
+        return root
+
+    def person(self, person):
+        person = self.find(person)
+        if person not in self.components:
+            self.components[person] = dict((kind, []) for kind in FIELDS)
+        return person
+
+    def add(self, person, kind, ident):
+        person = self.person(person)
+
+        if ident not in self.components[person][kind]:
+            self.components[person][kind].append(ident)
+
+        if kind in CONFLICTING:
+            holder = self.holders.get((kind, ident))
+            if holder is not None and self.find(holder) != person:
+                self.merge(person, holder)
+            self.holders[(kind, ident)] = person
+
+    def remove(self, person, kind, ident):
+        person = self.person(person)
+
+        if ident in self.components[person][kind]:
+            self.components[person][kind].remove(ident)
+
+        holder = self.holders.get((kind, ident))
+        if holder is not None and self.find(holder) == person:
+            del self.holders[(kind, ident)]
+
+    def merge(self, person, other):
+        person, other = self.person(person), self.person(other)
+        if person == other:
+            return
+
+        self.parents[other] = person
+
+        for kind, idents in self.components.pop(other).iteritems():
+            for ident in idents:
+                if ident not in self.components[person][kind]:
+                    self.components[person][kind].append(ident)
+                if kind in CONFLICTING:
+                    self.holders[(kind, ident)] = person
+
+    def promote(self, person):
+        """Make the given person the current person of those it has been merged with."""
+
+        root = self.person(person)
+        if root == person:
+            return
+
+        # Path compression leaves person pointing straight at the root, so the links stay a forest.
+        del self.parents[person]
+        self.parents[root] = person
+        self.components[person] = components = self.components.pop(root)
+
+        for kind in CONFLICTING:
+            for ident in components[kind]:
+                if self.holders.get((kind, ident)) == root:
+                    self.holders[(kind, ident)] = person
+
+    def apply(self, event):
+        action, person = event.get('a'), event.get('p')
+        kind, ident = event.get('t'), event.get('g')
+
+        if action == 'merge':
+            self.merge(person, ident)
+            self.promote(person)
+        elif kind in FIELDS and ident is not None:
+            if action == 'add':
+                self.add(person, kind, ident)
+            elif action == 'remove':
+                self.remove(person, kind, ident)
+        else:
+            self.person(person)
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def resolve(replay, batch_size):
+    """Map component identifiers to document ids, one $in query per batch of each component type."""
+
+    wanted = dict((kind, set()) for kind in FIELDS)
+    for components in replay.components.itervalues():
+        for kind, idents in components.iteritems():
+            wanted[kind].update(idents)
+
+    resolved = dict(ip=dict((i, i) for i in wanted['ip']))
+
+    lookups = dict(
+        character=lambda idents: EVECharacter.objects(name__in=idents).scalar('name', 'id'),
+        user=lambda idents: User.objects(username__in=idents).scalar('username', 'id'),
+        key=lambda idents: ((unicode(k), i) for k, i in EVECredential.objects(
+                key__in=[int(k) for k in idents if k.isdigit()]).scalar('key', 'id')),
+    )
+
+    for kind, lookup in lookups.iteritems():
+        resolved[kind] = dict()
+        for batch in chunks(wanted[kind], batch_size):
+            resolved[kind].update(lookup(batch))
+
+    missing = sum(len(wanted[kind]) - len(resolved[kind]) for kind in FIELDS)
+    return resolved, missing
+
+
+def replay_people(dry_run=True, batch_size=1000, report_every=10000):
+    """Regenerate the People collection (and the person aliases) by replaying every PersonEvent in memory, then
+    writing the resulting people in batches."""
+
+    replay = Replay()
+    started = time.time()
+    events = 0
+
+    # Stream the raw events in the order they happened; the ids break ties between events with the same time.
+    cursor = PersonEvent.objects.order_by('time', 'id').only('person', 'action', 'target_type', 'target_ident')
+    for event in cursor.as_pymongo().no_cache():
+        replay.apply(event)
+        events += 1
+
+        if events % report_every == 0:
+            elapsed = time.time() - started
+            print("Replayed {0} events ({1:.0f}/s), {2} people.".format(events, events / elapsed, len(replay.components)))
+
+    elapsed = time.time() - started
+    print("Replayed {0} events in {1:.1f}s: {2} people, {3} merged away.".format(
+            events, elapsed, len(replay.components), len(replay.parents)))
+
+    resolved, missing = resolve(replay, batch_size)
+    if missing:
+        print("{0} components no longer exist and will be left out.".format(missing))
+
+    if dry_run:
+        return
+
+    print("Deleting People collection prior to regeneration.")
+    Person.objects.delete()
+    PersonAlias.objects.delete()
+
+    written = 0
+    for batch in chunks(replay.components.iteritems(), batch_size):
+        people = []
+        for id, components in batch:
+            fields = dict((FIELDS[kind], [resolved[kind][i] for i in idents if i in resolved[kind]])
+                          for kind, idents in components.iteritems())
+            people.append(Person(id=ObjectId(id), **fields))
+
+        Person.objects.insert(people, load_bulk=False)
+        written += len(people)
+        print("Wrote {0} of {1} people ({2:.0f}/s).".format(
+                written, len(replay.components), written / max(time.time() - started - elapsed, 0.001)))
+
+    for batch in chunks(replay.parents, batch_size):
+        PersonAlias.objects.insert([PersonAlias(id=i, parent=replay.find(i)) for i in batch], load_bulk=False)
+
+    # The aliases may now lead elsewhere than before, so running processes must forget the ones they have cached.
+    PersonAlias.rewritten()
+
+    # Bans are matched on the current person, which may have changed for people merged in a different order.
+    PersonBan.update_people()
+
+    print("Regenerated Person collection in {0:.1f}s: {1} people written, {2} events processed.".format(
+            time.time() - started, written, events))
@@ -0,0 +1,24 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import sys
+from brave.core import core_loadapp
+if __name__ == "__main__":
+    core_loadapp("config:"+sys.argv[1] if len(sys.argv) > 1 else None)
+
+from brave.core.character.model import EVEEntity, EVEAlliance, EVECorporation, EVECharacter
+from brave.core.util.cache import CacheVersion
+
+print("storing the case-folded names of alliances, corporations and characters")
+collection = EVEEntity._get_collection()
+updated = 0
+
+for doc in collection.find({'n': {'$exists': True}}, {'n': 1, 'nl': 1}):
+    name = doc['n'].lower() if doc['n'] else None
+    if doc.get('nl') != name:
+        collection.update({'_id': doc['_id']}, {'$set': {'nl': name}})
+        updated += 1
+
+for cls in (EVEAlliance, EVECorporation, EVECharacter):
+    CacheVersion.bump(cls.cache_version())
+
+print("done; {0} updated".format(updated))
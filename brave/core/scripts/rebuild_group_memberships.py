@@ -0,0 +1,15 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import sys
+from brave.core import core_loadapp
+if __name__ == "__main__":
+    core_loadapp("config:"+sys.argv[1] if len(sys.argv) > 1 else None)
+
+from brave.core.group.model import Group, GroupMembership
+
+print("rebuilding the group dependency graph")
+Group.rebuild_dependencies()
+
+print("rebuilding the group membership index")
+GroupMembership.rebuild()
+print("done: {} memberships".format(GroupMembership.objects.count()))
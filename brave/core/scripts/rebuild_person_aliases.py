@@ -0,0 +1,16 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import sys
+from brave.core import core_loadapp
+if __name__ == "__main__":
+    core_loadapp("config:"+sys.argv[1] if len(sys.argv) > 1 else None)
+
+from brave.core.person.model import PersonAlias
+from brave.core.ban.model import PersonBan
+
+print("rebuilding person aliases from merge events")
+PersonAlias.rebuild()
+
+print("pointing bans at the current person of people merged since they were banned")
+PersonBan.update_people()
+print("done")
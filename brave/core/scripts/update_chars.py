@@ -1,116 +1,154 @@
 # update_characters.py
-import random
-
-from collections import defaultdict
 from datetime import datetime, timedelta
 from math import ceil
-from mutex import mutex
-from time import sleep
-from threading import Lock, Thread
-from requests.exceptions import HTTPError
-
-from brave.core.character.model import EVECharacter
-
-chars_by_timeslot = defaultdict(list)
-chars_lock = Lock()
-
-class CredentialUpdateThread(Thread):
-    def __init__(self, char_group_indexes, start_time, interval):
-        super(CredentialUpdateThread, self).__init__()
-        self.char_group_indexes = char_group_indexes
-        self.wake_time = start_time
-        self.interval = interval
-        self.group = 0
-    
-    def run(self):
-        while True:
-            if datetime.now() > self.wake_time:
-                print "warning: no delay between groups! Likely falling behind requested time between pulls."
-            
-            # wait for the next wake time to arrive
-            while datetime.now() < self.wake_time:
-                sleep((self.wake_time - datetime.now()).total_seconds())
-            
-            # grab a copy of the list of chars to update
-            with chars_lock:
-                chars_to_update = chars_by_timeslot[self.char_group_indexes[self.group]]
-            
-            print "Updating {0} chars for this timeslot...".format(len(chars_to_update))
-
-            # do the update
-            for n in chars_to_update:
-                self.update_character(n)
-            
-            # update for the next pass
-            self.group = (self.group + 1) % len(self.char_group_indexes)
-            self.wake_time += self.interval
-    
-    @staticmethod
-    def update_character(n):
-
-        # refresh char
-        char = EVECharacter.objects(name=n).first()
-
-        if not char:
-            print "Char {0} not found".format(n)
+from time import sleep, time
+from marrow.util.futures import ScalingPoolExecutor
+
+from brave.core.util import evelink
+from brave.core.character.model import EVEEntity, EVECharacter
+from brave.core.character.sync import Writer, resolve_affiliations, diff
+from brave.core.group.model import GroupMembership
+
+log = __import__('logging').getLogger(__name__)
+
+# The most characters CCP will look up affiliations for in one call.
+BATCH_SIZE = 250
+
+
+def batches(size=BATCH_SIZE):
+    """Yield the raw id, identifier, name, corporation, alliance and public information of every character, a batch at a
+    time, each fetched with its own short query so that no cursor is held open between batches."""
+
+    fields = ('id', 'identifier', 'name', 'corporation', 'alliance', 'race', 'bloodline', 'security')
+    last = None
+
+    while True:
+        query = EVECharacter.objects(id__gt=last) if last else EVECharacter.objects
+        batch = list(query.order_by('id').only(*fields).limit(size).as_pymongo())
+
+        if not batch:
             return
 
-        char_result = None
+        last = batch[-1]['_id']
+        yield batch
+
+
+def fetch(batch, full=False):
+    """Look up the affiliations (and, if full or we don't have it, the public information) of a batch of characters.
+
+    This only talks to the EVE API, so that batches can be fetched in parallel."""
+
+    eve = evelink.eve.EVE()
+    affiliations = eve.affiliations_for_characters([c['i'] for c in batch]).result
+
+    info = dict()
+    for character in batch:
+        if character['i'] in affiliations and (full or 'ra' not in character):
+            try:
+                info[character['i']] = eve.character_info_from_id(character['i']).result
+            except Exception as e:
+                print("Unable to get public information for {0}: {1}".format(character['i'], e))
+
+    return batch, affiliations, info
+
+
+def store(collection, writer, batch, affiliations, info):
+    """Write the changes to a batch of characters, returning the ids of those whose membership changed."""
+
+    corporations, alliances = resolve_affiliations(collection, writer, affiliations.values())
+    moved = []
+
+    for character in batch:
+        affiliation = affiliations.get(character['i'])
+        if not affiliation:
+            print("Char {0} not found".format(character.get('n', character['i'])))
+            continue
+
+        alliance = (affiliation.get('alliance') or {}).get('id')
+        desired = dict(
+                n = affiliation['name'],
+                corporation = corporations.get(affiliation['corp']['id']),
+                alliance = alliances.get(alliance),
+            )
+
+        details = info.get(character['i'])
+        if details:
+            desired.update(ra=details['race'], bl=details['bloodline'], sec=details['sec_status'])
+
+        changes = diff(character, desired)
+        if not changes:
+            continue
+
+        writer.update(character['i'], EVECharacter, changes)
+
+        if 'corporation' in changes or 'alliance' in changes:
+            moved.append(character['_id'])
+
+    writer.flush()
+    return moved
+
+
+def refresh(pool, threads, interval, full=False):
+    """Refresh every character once, spreading the batches evenly over the given interval."""
+
+    collection = EVEEntity._get_collection()
+    writer = Writer(collection)
+    total = EVECharacter.objects.count()
+    delay = interval.total_seconds() / max(1, int(ceil(float(total) / BATCH_SIZE)))
+    started = time()
+    pending = []
+    refreshed = 0
+
+    def complete(receipt):
         try:
-            print "Pulling char {0}".format(n)
-            char_result = char.pull_character(name=n)
-        except HTTPError as e:
-            print("Error {0}: {1}".format(e.response.status_code, e.response.text))
-        except Exception as ex:
-            char_result = False
-            print("Error {0}".format(ex))
-            
-        if char_result is None:
-            print("Removed disabled char {0} from account {1} with characters {2}".format(n, char.owner, char.characters))
-
-def refresh_charlist(num_timeslots):
-    global chars_by_timeslot
-    
-    with chars_lock:
-        chars_by_timeslot = defaultdict(list)
-        
-        print "Assigning chars to timeslots - starting..."
-        for n in EVECharacter.objects():
-            index = hash(n.id) % num_timeslots
-            #print "Assigning char {0} to timeslot {1}".format(n.name, index)
-            chars_by_timeslot[index].append(n.name)
-
-        print "Assigning chars to timeslots - done!"
-
-def main(minutes_between_pulls=1440, threads=1):
+            batch, affiliations, info = receipt.result()
+        except Exception as e:
+            print("Error refreshing a batch of characters: {0}".format(e))
+            return 0
+
+        moved = store(collection, writer, batch, affiliations, info)
+
+        # The bulk writes bypass the save signals, so bring the group membership index up to date ourselves.
+        if moved:
+            GroupMembership.refresh_characters(EVECharacter.objects(id__in=moved))
+
+        return len(batch)
+
+    for i, batch in enumerate(batches()):
+        pending.append(pool.submit(fetch, batch, full))
+
+        # Apply the results as they arrive, with no more than one batch per worker in flight.
+        while len(pending) >= threads or (pending and pending[0].done()):
+            refreshed += complete(pending.pop(0))
+
+        # Wait for this batch's slot, so that a full pass takes the interval.
+        wake = started + (i + 1) * delay
+        if wake > time():
+            sleep(wake - time())
+
+    for receipt in pending:
+        refreshed += complete(receipt)
+
+    print("Refreshed {0} of {1} chars in {2:.0f}s; {3} changes written.".format(
+            refreshed, total, time() - started, writer.written))
+
+
+def main(minutes_between_pulls=1440, threads=1, full=False):
     """
-    minutes_between_pulls will be rounded up to a multiple of threads. A batch of chars will be
-    pulled every minute, so minutes_between_pulls is also the number of batches, and each thread
-    will begin a batch once every `threads` minutes.
+    Refresh every character's name, corporation and alliance once every minutes_between_pulls, a batch at a time,
+    using up to `threads` concurrent API workers. Public character information (race, bloodline, security status) is
+    fetched for characters missing it, or for every character if full is True.
     """
-    
-    # round up to a multiple of threads
-    minutes_between_pulls = int(ceil(float(minutes_between_pulls) / threads) * threads)
-    
-    refresh_charlist(num_timeslots=minutes_between_pulls)
-    
-    first_start_time = datetime.now() + timedelta(seconds=5)
-    interval = timedelta(minutes=threads)
-    for i in range(0, threads):
-        char_group_indexes = list(range(i, minutes_between_pulls, threads))
-        start_time = first_start_time+timedelta(minutes=i)
-        t = CredentialUpdateThread(char_group_indexes, start_time=start_time, interval=interval)
-        t.daemon = True
-        t.start()
-    
-    # Once every minutes_between_pulls, update the list of charss to pull
-    wake_time = datetime.now() + timedelta(minutes=minutes_between_pulls)
+
+    pool = ScalingPoolExecutor(threads, threads, 60)
+    interval = timedelta(minutes=minutes_between_pulls)
+
     while True:
-        while datetime.now() < wake_time:
-            sleep((wake_time - datetime.now()).total_seconds())
-        
-        print "refreshing charlist - start"
-        refresh_charlist(num_timeslots=minutes_between_pulls)
-        print "refreshing charlist - done"
-
-        wake_time += timedelta(minutes=minutes_between_pulls)
+        started = datetime.now()
+        print("refreshing chars - start")
+        refresh(pool, threads, interval, full)
+        print("refreshing chars - done")
+
+        remaining = (started + interval - datetime.now()).total_seconds()
+        if remaining > 0:
+            sleep(remaining)
@@ -1,103 +1,212 @@
+import heapq
 import random
 
-from collections import defaultdict
+from collections import Counter
 from datetime import datetime, timedelta
-from math import ceil
-from mutex import mutex
 from time import sleep
-from threading import Lock, Thread
-from requests.exceptions import HTTPError
+from threading import Lock
+from requests.exceptions import HTTPError, ConnectionError, Timeout
+from marrow.util.futures import ScalingPoolExecutor
+from web.core import config
 
 from brave.core.key.model import EVECredential
+from brave.core.util.eve import CachedAPIValue
+from brave.core.util.ratelimit import TokenBucket
 
-keys_by_timeslot = defaultdict(list)
-keys_lock = Lock()
+log = __import__('logging').getLogger(__name__)
 
-class CredentialUpdateThread(Thread):
-    def __init__(self, key_group_indexes, start_time, interval):
-        super(CredentialUpdateThread, self).__init__()
-        self.key_group_indexes = key_group_indexes
-        self.wake_time = start_time
+
+class RefreshScheduler(object):
+    """Keeps every API key refreshed once per interval.
+
+    Keys wait in a priority queue ordered by when they are next due: an interval after they were last refreshed, or
+    when the API results cached for them expire, whichever is later (pulling before then would just return the cached
+    results.) Due keys are pulled by a bounded pool of workers, no faster than the token bucket allows. Transient
+    failures are retried with jittered exponential backoff.
+
+    stats() reports the queue depth, how late the most recently dispatched key was (the lag), and how many pulls
+    ended in each outcome."""
+
+    def __init__(self, interval, workers=1, qps=1, retries=3, backoff=60, reload_interval=timedelta(minutes=30)):
         self.interval = interval
-        self.group = 0
-    
-    def run(self):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.reload_interval = reload_interval
+
+        self.bucket = TokenBucket(qps)
+        self.pool = ScalingPoolExecutor(workers, workers, 60)
+
+        self.lock = Lock()
+        self.queue = []  # (due, key) heap
+        self.scheduled = set()  # keys queued or being pulled
+        self.attempts = dict()  # failed attempts, by key
+        self.in_flight = 0
+        self.lag = timedelta(0)
+        self.outcomes = Counter()
+
+    def schedule(self, key, due):
+        with self.lock:
+            heapq.heappush(self.queue, (due, key))
+            self.scheduled.add(key)
+
+    def unschedule(self, key):
+        with self.lock:
+            self.scheduled.discard(key)
+            self.attempts.pop(key, None)
+
+    def tally(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] += 1
+
+    def next_due(self, refreshed, cached_until=None):
+        due = refreshed + self.interval
+        return max(due, cached_until) if cached_until else due
+
+    def load(self):
+        """Queue every key not already queued."""
+
+        cached = dict()
+        for key, expires in CachedAPIValue.objects(expires__gte=datetime.utcnow()).scalar('key', 'expires'):
+            if key and (key not in cached or expires > cached[key]):
+                cached[key] = expires
+
+        added = 0
+        for key, modified in EVECredential.objects.scalar('key', 'modified'):
+            if key in self.scheduled:
+                continue
+
+            self.schedule(key, self.next_due(modified or datetime.utcnow(), cached.get(key)))
+            added += 1
+
+        log.info("Queued %d new keys; %d queued in total.", added, len(self.queue))
+
+    def stats(self):
+        now = datetime.utcnow()
+
+        with self.lock:
+            stats = dict(
+                    depth = len(self.queue),
+                    overdue = sum(1 for due, key in self.queue if due <= now),
+                    in_flight = self.in_flight,
+                    lag = self.lag.total_seconds(),
+                )
+
+            stats.update(self.outcomes)
+
+        return stats
+
+    def report(self):
+        print("key refresh: " + ", ".join("{0}={1}".format(k, v) for k, v in sorted(self.stats().items())))
+
+    def run(self, report_interval=timedelta(minutes=1)):
+        next_reload = next_report = datetime.utcnow()
+
         while True:
-            if datetime.now() > self.wake_time:
-                print "warning: no delay between groups! Likely falling behind requested time between pulls."
-            
-            # wait for the next wake time to arrive
-            while datetime.now() < self.wake_time:
-                sleep((self.wake_time - datetime.now()).total_seconds())
-            
-            # grab a copy of the list of keys to update
-            with keys_lock:
-                keys_to_update = keys_by_timeslot[self.key_group_indexes[self.group]]
-            
-            # do the update
-            for k in keys_to_update:
-                self.update_key(k)
-            
-            # update for the next pass
-            self.group = (self.group + 1) % len(self.key_group_indexes)
-            self.wake_time += self.interval
-    
-    @staticmethod
-    def update_key(k):
-        key = EVECredential.objects(key=k).first()
-        if not key:
-            print "Key {} not found".format(k)
+            now = datetime.utcnow()
+
+            if now >= next_reload:
+                self.load()
+                next_reload = now + self.reload_interval
+
+            if now >= next_report:
+                self.report()
+                next_report = now + report_interval
+
+            with self.lock:
+                due = self.queue[0][0] if self.queue else None
+                ready = due is not None and due <= now and self.in_flight < self.workers
+
+                if ready:
+                    due, key = heapq.heappop(self.queue)
+                    self.in_flight += 1
+                    self.lag = now - due
+
+            if not ready:
+                sleep(1 if due is None or due <= now else min(1, (due - now).total_seconds()))
+                continue
+
+            self.pool.submit(self.pull, key).add_done_callback(self.done)
+
+    def done(self, future):
+        with self.lock:
+            self.in_flight -= 1
+
+        try:
+            future.result()
+        except:
+            log.exception("Unhandled error refreshing a key.")
+
+    def pull(self, key):
+        self.bucket.acquire()
+
+        credential = EVECredential.objects(key=key).first()
+        if not credential:
+            log.info("Key %d not found.", key)
+            self.tally('missing')
+            self.unschedule(key)
             return
+
         try:
-            print "Pulling key ID {0}".format(k)
-            key_result = key.pull()
-            if not key_result:
-                print("Removed disabled key {0} from account {1} with characters {2}".format(k, key.owner, key.characters))
-        except HTTPError as e:
-            print("Error {}: {}".format(e.response.status_code, e.response.text))
-        except Exception as ex:
-            print("Error {}".format(ex))
-
-def refresh_keylist(num_timeslots):
-    global keys_by_timeslot
-    
-    with keys_lock:
-        keys_by_timeslot = defaultdict(list)
-        
-        for k in EVECredential.objects():
-            index = hash(k.id) % num_timeslots
-            print "Assigning key {0} to timeslot {1}".format(k.key, index)
-            keys_by_timeslot[index].append(k.key)
-
-def main(minutes_between_pulls=1440, threads=1):
+            log.debug("Pulling key ID %d.", key)
+            result = credential.pull()
+
+        except (HTTPError, ConnectionError, Timeout) as e:
+            # Retry server-side and network errors; anything else CCP told us is wrong with the key won't change.
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code < 500:
+                log.warning("Error %d refreshing key %d: %s", response.status_code, key, response.text)
+                return self.failed(key)
+
+            return self.retry(key, e)
+
+        except Exception as e:
+            log.exception("Error refreshing key %d.", key)
+            return self.failed(key)
+
+        with self.lock:
+            self.attempts.pop(key, None)
+
+        if not result:
+            log.info("Removed disabled key %d from account %s with characters %s.", key, credential.owner,
+                     list(credential.characters))
+            self.tally('removed')
+            self.unschedule(key)
+            return
+
+        self.tally('updated')
+        cached_until = CachedAPIValue.objects(key=key).order_by('-expires').scalar('expires').first()
+        self.schedule(key, self.next_due(datetime.utcnow(), cached_until))
+
+    def retry(self, key, error):
+        with self.lock:
+            attempt = self.attempts[key] = self.attempts.get(key, 0) + 1
+
+        if attempt > self.retries:
+            log.warning("Giving up on key %d after %d attempts: %s", key, attempt, error)
+            return self.failed(key)
+
+        delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+        log.info("Retrying key %d in %d seconds (attempt %d): %s", key, delay, attempt, error)
+        self.tally('retried')
+        self.schedule(key, datetime.utcnow() + timedelta(seconds=delay))
+
+    def failed(self, key):
+        with self.lock:
+            self.attempts.pop(key, None)
+
+        self.tally('failed')
+        self.schedule(key, self.next_due(datetime.utcnow()))
+
+
+def main(minutes_between_pulls=1440, threads=1, qps=None, retries=3):
     """
-    minutes_between_pulls will be rounded up to a multiple of threads. A batch of keys will be
-    pulled every minute, so minutes_between_pulls is also the number of batches, and each thread
-    will begin a batch once every `threads` minutes.
+    Refresh every key once every minutes_between_pulls, using up to `threads` concurrent workers, pulling at most
+    `qps` keys per second (core.update_keys.qps, by default one) and retrying transient errors `retries` times.
     """
-    
-    # round up to a multiple of threads
-    minutes_between_pulls = int(ceil(float(minutes_between_pulls) / threads) * threads)
-    
-    refresh_keylist(num_timeslots=minutes_between_pulls)
-    
-    first_start_time = datetime.now() + timedelta(seconds=5)
-    interval = timedelta(minutes=threads)
-    for i in range(0, threads):
-        key_group_indexes = list(range(i, minutes_between_pulls, threads))
-        start_time = first_start_time+timedelta(minutes=i)
-        t = CredentialUpdateThread(key_group_indexes, start_time=start_time, interval=interval)
-        t.daemon = True
-        t.start()
-    
-    # Once every minutes_between_pulls, update the list of keys to pull
-    wake_time = datetime.now() + timedelta(minutes=minutes_between_pulls)
-    while True:
-        while datetime.now() < wake_time:
-            sleep((wake_time - datetime.now()).total_seconds())
-        
-        print "refreshing keylist - start"
-        refresh_keylist(num_timeslots=minutes_between_pulls)
-        print "refreshing keylist - done"
-
-        wake_time += timedelta(minutes=minutes_between_pulls)
+
+    if qps is None:
+        qps = float(config.get('core.update_keys.qps', 1))
+
+    scheduler = RefreshScheduler(timedelta(minutes=minutes_between_pulls), workers=threads, qps=qps, retries=retries)
+    scheduler.run()
@@ -0,0 +1,207 @@
+# encoding: utf-8
+
+"""Single-pass parsing of EVE API XML responses.
+
+parse() turns a response body into the same structure the relaxml + bunchify pair used to produce, but does so while
+the document is being read: each element is converted into its final form as soon as it closes, and then discarded.
+No intermediate dictionary tree is built and copied, and strings are converted once per distinct value.
+
+The rules, for reference:
+
+* An element with text (and no attributes) becomes that text, converted to a number, boolean, or comma-separated list
+  where it looks like one.
+* Any other element becomes a Bunch of its (converted) attributes and children.  Children sharing a tag become a list.
+  An element whose only content is a single such child is replaced by that child.
+* <rowset> elements are collected by name onto their parent; each is a Bunch of its key and columns with a list of
+  rows.  Only a row's declared columns (and key) are converted; anything else is left as text.
+"""
+
+from __future__ import unicode_literals
+
+from io import BytesIO
+from xml.etree.cElementTree import iterparse
+
+from marrow.util.bunch import Bunch
+from marrow.util.convert import boolean, number, array
+
+
+log = __import__('logging').getLogger(__name__)
+
+
+class APIError(Exception):
+    """The EVE API returned an <error> instead of a result."""
+
+    def __init__(self, code, message):
+        super(APIError, self).__init__("EVE API error {0}: {1}".format(code, message))
+        self.code = code
+        self.message = message
+
+
+class Converter(object):
+    """Converts text values as bunchify did, remembering the conversion of each distinct value."""
+
+    def __init__(self):
+        self.seen = dict()
+
+    def __call__(self, value, name=None):
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+
+        listy = name in ('key', 'columns')
+        memo = (value, listy)
+
+        try:
+            return self.seen[memo]
+        except KeyError:
+            pass
+
+        result = self.convert(value, listy)
+
+        if not isinstance(result, list):  # Lists are mutable, so each use gets its own.
+            self.seen[memo] = result
+
+        return result
+
+    @staticmethod
+    def convert(value, listy):
+        try:
+            return number(value)
+        except ValueError:
+            pass
+
+        try:
+            return boolean(value)
+        except ValueError:
+            pass
+
+        if ',' in value and (listy or ' ' not in value):
+            return array(value)
+
+        return value
+
+
+class Node(object):
+    """An element being parsed: its tag, attributes, and the values of the children closed so far."""
+
+    __slots__ = ('tag', 'attrib', 'children', 'declared')
+
+    def __init__(self, tag, attrib, declared):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []  # (tag, is_text, value, rowset name) tuples.
+        self.declared = declared  # Columns which are converted in rows below this node, or None for all.
+
+
+def element(node, text, convert):
+    """Return (is_text, value) for a just-closed element."""
+
+    tag, attrib = node.tag, node.attrib
+    stripped = text.strip() if text else ''
+
+    if stripped and not attrib:
+        return True, text
+
+    rowset = tag == 'rowset'
+    row = tag == 'row'
+
+    values = dict()
+    for name, value in attrib.iteritems():
+        if rowset and name == 'name':
+            continue
+
+        if row and node.declared is not None and name not in node.declared:
+            values[name] = value.decode('utf-8') if isinstance(value, bytes) else value
+            continue
+
+        values[name] = convert(value, name)
+
+    # Text alongside attributes is stored as though it were an attribute named after the element; rows carrying text
+    # (such as char.NotificationTexts) hold it in a list, like any other "row" entry.
+    if stripped:
+        values[tag] = [convert(text)] if row else convert(text, tag)
+
+    # Group the children by tag, preserving their order.
+    groups = dict()
+    for child in node.children:
+        groups.setdefault(child[0], []).append(child)
+
+    # An element containing nothing but a single (non-text) element is replaced by it.
+    if not values and len(groups) == 1:
+        children, = groups.values()
+        if len(children) == 1 and not children[0][1]:
+            return False, children[0][2]
+
+    result = Bunch(values)
+
+    for name, children in groups.iteritems():
+        if name == 'rowset':
+            continue
+
+        if len(children) == 1 and name != 'row':
+            is_text, value = children[0][1:3]
+            result[name] = convert(value, name) if is_text else value
+            continue
+
+        result[name] = [convert(v) if textual else v for _, textual, v, _ in children]
+
+    for _, is_text, value, name in groups.get('rowset', ()):
+        result[name] = value
+
+    if rowset:
+        result.setdefault('row', [])
+
+    return False, result
+
+
+def parse(source):
+    """Parse an EVE API response, given as a string or file-like object.
+
+    Returns a Bunch of the result and the raw currentTime and cachedUntil timestamps, raising APIError if the response
+    was an error.
+    """
+
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+
+    convert = Converter()
+    stack = []
+    document = Bunch()
+
+    for event, elem in iterparse(source, events=(b'start', b'end')):
+        if event == 'start':
+            declared = stack[-1].declared if stack else None
+
+            if elem.tag == 'rowset':
+                declared = set(array(elem.get('columns', '')))
+                declared.add(elem.get('key'))
+
+            stack.append(Node(elem.tag, dict(elem.attrib), declared))
+            continue
+
+        node = stack.pop()
+
+        if not stack:  # The closing </eveapi>.
+            break
+
+        if len(stack) == 1:  # The children of <eveapi> itself.
+            if elem.tag == 'error':
+                raise APIError(elem.get('code'), (elem.text or '').strip())
+
+            if elem.tag in ('currentTime', 'cachedUntil'):
+                document[elem.tag] = elem.text
+                elem.clear()
+                continue
+
+        is_text, value = element(node, elem.text, convert)
+
+        stack[-1].children.append((elem.tag, is_text, value, node.attrib.get('name')))
+
+        if len(stack) == 1 and elem.tag == 'result':
+            document.result = convert(value, 'result') if is_text else value
+
+        elem.clear()
+
+    if 'result' not in document:
+        raise ValueError("Response contained no result.")
+
+    return document
@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+"""In-process caching helpers.
+
+LRUCache is a bounded, thread-safe mapping used for memoizing expensive derived values within a single process.
+SingleFlight coalesces concurrent computations of the same value so that only one of them does the work.
+CacheVersion is a set of named counters stored in MongoDB; bumping one invalidates every cache entry (in every process)
+that recorded an older value of it.
+"""
+
+from __future__ import unicode_literals
+
+from time import time
+from threading import Lock, Event
+from collections import OrderedDict, Counter
+
+from mongoengine import Document, StringField, IntField
+
+
+log = __import__('logging').getLogger(__name__)
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """A thread-safe mapping holding at most maxsize entries, evicting the least recently used.
+
+    If ttl (in seconds) is given, entries older than that are treated as missing.  Lookups are tallied in stats as
+    hits, misses, or stale (found, but expired.)"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = Counter()
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.stats['misses'] += 1
+                return default
+
+            if expires is not None and expires < time():
+                self.stats['stale'] += 1
+                return default
+
+            self.stats['hits'] += 1
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, MISSING)
+
+        return default if value is MISSING else value[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls made under the same key.
+
+    The first caller for a key runs the function; any others arriving while it runs wait for, and share, its result
+    (or exception) instead of repeating the work."""
+
+    def __init__(self):
+        self.stats = Counter()
+        self._calls = dict()
+        self._lock = Lock()
+
+    def do(self, key, fn, *args, **kw):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = dict(done=Event())
+                self.stats['calls'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            call['done'].wait()
+
+            if 'error' in call:
+                raise call['error']
+
+            return call['result']
+
+        try:
+            call['result'] = fn(*args, **kw)
+            return call['result']
+
+        except Exception as e:
+            call['error'] = e
+            raise
+
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call['done'].set()
+
+
+class CacheVersion(Document):
+    """A named, persistent counter used to invalidate in-process caches across every process."""
+
+    meta = dict(
+            collection = 'CacheVersions',
+            allow_inheritance = False,
+        )
+
+    id = StringField(db_field='_id', primary_key=True)
+    value = IntField(db_field='v', default=0)
+
+    @classmethod
+    def current(cls, name):
+        """Return the current value of the named counter."""
+        return cls.objects(id=name).scalar('value').first() or 0
+
+    @classmethod
+    def stamp(cls, *names):
+        """Return the current values of the named counters as a tuple, in one query."""
+        values = dict(cls.objects(id__in=names).scalar('id', 'value'))
+        return tuple(values.get(name, 0) for name in names)
+
+    @classmethod
+    def bump(cls, name):
+        """Increment the named counter, invalidating anything cached against its previous value."""
+        cls.objects(id=name).update_one(upsert=True, inc__value=1)
@@ -34,83 +34,33 @@ As a few examples:
 
 from __future__ import print_function
 
-import requests
 from web.core import config
 
+from time import time
+from copy import deepcopy
 from hashlib import sha256
+from threading import Lock
 from datetime import datetime
-from relaxml import xml
-from marrow.util.bunch import Bunch
-from marrow.util.convert import boolean, number, array
 from marrow.templating.serialize.bencode import EnhancedBencode
 from mongoengine import Document, IntField, StringField, ListField, DateTimeField, DictField, BooleanField, MapField, \
     NotUniqueError
 from braveapi.client import bunchify as bunchify_lite
 
+from brave.core.util import http
+from brave.core.util.apixml import parse
+from brave.core.util.cache import LRUCache, SingleFlight, CacheVersion
+from brave.core.util.mask import popcount, satisfies, bits
+
 
 log = __import__('logging').getLogger(__name__)
 
+# Results of API calls, by (key ID, call name, argument hash), each kept until CCP's cachedUntil for it.  This sits
+# in front of the CachedAPIValue collection; concurrent misses for the same call are coalesced into one fetch.
+api_cache = LRUCache(4096)
+api_flight = SingleFlight()
 
-def bunchify(data, name=None):
-    if isinstance(data, Bunch):
-        return data
-    
-    if isinstance(data, list):
-        if name == 'rowset':  # we unpack these into a dictionary based on name
-            return Bunch({i['name']: bunchify(i, 'rowset') for i in data})
-        
-        return [bunchify(i) for i in data]
-    
-    if isinstance(data, dict):
-        data = data.copy()
-        
-        if name == 'row' and 'row' in data:
-            # Special case of CCP's silly key:value text.
-            pass
-        
-        if name and name in data and not data.get(name, '').strip():
-            data.pop(name)
-        
-        if name == 'rowset' and 'name' in data:
-            data.pop('name')
-        
-        if len(data) == 1 and isinstance(data.values()[0], dict):
-            return bunchify(data.values()[0], data.keys()[0])
-        
-        result = Bunch({
-                k: bunchify(
-                        [v] if k in ('row', ) and not isinstance(v, list) else v,
-                        k
-                    ) for k, v in data.iteritems() if k != 'rowset'
-            })
-        
-        if 'rowset' in data:
-            rowset = bunchify(data['rowset'] if isinstance(data['rowset'], list) else [data['rowset']], 'rowset')
-            result.update(rowset)
-        
-        if name == 'rowset':  # rowsets always contain rows, even if there are no results
-            result.setdefault('row', [])
-        
-        return result
-    
-    if isinstance(data, str):
-        data = data.decode('utf-8')
-    
-    if isinstance(data, (str, unicode)):
-        try:
-            return number(data)
-        except ValueError:
-            pass
-        
-        try:
-            return boolean(data)
-        except ValueError:
-            pass
-        
-        if ',' in data and (name in ('key', 'columns') or ' ' not in data):
-            return array(data)
-    
-    return data
+# The CacheVersion bumped whenever the APICall and APIGroup definitions are repopulated; see APIRegistry.
+API_CACHE_VERSION = 'api.calls'
 
 
 class API(object):
@@ -121,10 +71,12 @@ class API(object):
     
     def __getattr__(self, name):
         if self.root:
-            try:
-                return APICall.objects.get(name=self.root + '.' + name)
-            except APICall.DoesNotExist:
+            call = registry.call(self.root + '.' + name)
+            
+            if call is None:
                 raise AttributeError("api object has no attribute '{0}'".format(self.root + '.' + name))
+            
+            return call
         
         return self.__class__(name)
 
@@ -203,18 +155,12 @@ class APICall(Document):
         """Formulate a URL for the given call."""
         return cls.prefix + call.replace('.', '/') + cls.suffix
     
-    def __call__(self, *credential, **payload):
-        """Perform the RPC call while following CCP's caching guidelines."""
+    def _prepare(self, credential, payload):
+        """Return the final payload, its hash, and the in-process cache key for a call with the given arguments."""
         
         if len(credential) > 1:
             raise Exception("The only positional parameter allowed is the credentials object.")
         
-        now = datetime.utcnow()
-        if not self.uriname:
-            uri = self.uri(self.name)
-        else:
-            uri = self.uri(self.uriname)
-        
         # Define the keyID/vCode API key arguments, if we have credentials.
         if credential:
             payload['keyID'] = credential[0].key
@@ -223,17 +169,83 @@ class APICall(Document):
         # Hash the arguments in a reliable way by converting to text in a way which sorts the keys.
         payload_hash = sha256(EnhancedBencode().encode(payload)).hexdigest()
         
-        # Examine the cache.
+        return payload, payload_hash, (payload.get('keyID', None), self.name, payload_hash)
+    
+    def cached(self, *credential, **payload):
+        """Return a copy of the result of this call if it is in the in-process or database cache, without making it, or
+        None."""
+        
+        payload, payload_hash, cache_key = self._prepare(credential, payload)
+        result = api_cache.get(cache_key)
+        
+        if result is None:
+            stored = self._stored(cache_key)
+            result = stored[1] if stored else None
+        
+        return None if result is None else deepcopy(result)
+    
+    def __call__(self, *credential, **payload):
+        """Perform the RPC call while following CCP's caching guidelines."""
+        
+        if not self.uriname:
+            uri = self.uri(self.name)
+        else:
+            uri = self.uri(self.uriname)
+        
+        payload, payload_hash, cache_key = self._prepare(credential, payload)
+        
+        # Examine the in-process cache, then the database, and only then ask CCP.  Callers get their own copy of the
+        # result, as they tend to modify it.
+        result = api_cache.get(cache_key)
+        
+        if result is None:
+            expires, result = api_flight.do(cache_key, self._fetch, uri, payload, payload_hash)
+        
+        return deepcopy(result)
+    
+    @staticmethod
+    def cache_stats():
+        """Return counters describing how API calls have been answered in this process."""
+        
+        stats = dict(('memory_' + k, v) for k, v in api_cache.stats.iteritems())
+        stats.update(api_flight.stats)
+        stats['size'] = len(api_cache)
+        return stats
+    
+    def _stored(self, cache_key):
+        """Return the result of this call, and when it expires, from the database cache, or None.
+        
+        A result found is stored in the in-process cache until it expires."""
+        
+        now = datetime.utcnow()
+        key, name, payload_hash = cache_key
+        
         cv = CachedAPIValue.objects(
-                key = payload.get('keyID', None),
-                name = self.name,
+                key = key,
+                name = name,
                 arguments = payload_hash,
                 expires__gte = now
-            ).first()
+            ).only('expires', 'result').first()
+        
+        if not cv:
+            return None
+        
+        log.info("Returning cached result of %s for key ID %d.", name, key or -1)
+        result = bunchify_lite(cv.result)
+        api_cache.set(cache_key, result, (cv.expires - now).total_seconds())
+        return cv.expires, result
+    
+    def _fetch(self, uri, payload, payload_hash):
+        """Return the result of this call, and when it expires, from the database cache or from CCP.
+        
+        Either way the result is stored in the in-process cache until it expires."""
+        
+        key = payload.get('keyID', None)
+        cache_key = (key, self.name, payload_hash)
         
-        if cv and cv.current:
-            log.info("Returning cached result of %s for key ID %d.", self.name, payload.get('keyID', -1))
-            return bunchify_lite(cv.result)
+        stored = self._stored(cache_key)
+        if stored:
+            return stored
         
         log.info("Making query to %s for key ID %d.", self.name, payload.get('keyID', -1))
 
@@ -241,38 +253,38 @@ class APICall(Document):
         headers = {'User-Agent': 'BRAVE Core Auth; Operated by: {0}'.format(config['core.operator'])}
 
         # Actually perform the query if a cached version could not be found.
-        response = requests.post(uri, data=payload or None, headers=headers)
+        response = http.post(uri, data=payload or None, headers=headers)
         response.raise_for_status()
         
         # We don't want the initial XML prefix.  We should still check it, though.
-        prefix, _, data = response.text.partition('\n')
+        prefix, _, _ = response.content.partition(b'\n')
         
-        if prefix.strip() != "<?xml version='1.0' encoding='UTF-8'?>":
+        if prefix.strip() != b"<?xml version='1.0' encoding='UTF-8'?>":
             raise Exception("Data returned doesn't seem to be XML!")
         
-        # Encode in UTF-8 to prevent a bug when converting from CML to a dict.
-        if isinstance(data, unicode):
-            data = data.encode('UTF-8')
-        
-        data = xml(data)['eveapi']
-        result = bunchify(data['result'], 'result')
-        data = Bunch(data)
+        # Parse the response straight from the bytes received, converting it as we go.
+        data = parse(response.content)
+        result = data.result
         
         if len(result) == 1:
             result = getattr(result, result.keys()[0])
         
+        expires = datetime.strptime(data.cachedUntil, "%Y-%m-%d %H:%M:%S")
+        
         # Upsert (update if exists, create if it doesn't) the cache value.
         CachedAPIValue.objects(
-                key = payload.get('keyID', None),
+                key = key,
                 name = self.name,
                 arguments = payload_hash
             ).update_one(
                 upsert = True,
-                set__expires = datetime.strptime(data.cachedUntil, "%Y-%m-%d %H:%M:%S"),
+                set__expires = expires,
                 set__result = result
             )
         
-        return result
+        api_cache.set(cache_key, result, max(0, (expires - datetime.utcnow()).total_seconds()))
+        
+        return expires, result
 
 
 class CachedAPIValue(Document):
@@ -379,6 +391,10 @@ def populate_calls(force=False):
                     row.groupID).save()
         except NotUniqueError:
             log.info('Call {0} already populated, ignoring'.format(row.name))
+    
+    # Have every process pick up the new definitions, this one straight away.
+    CacheVersion.bump(API_CACHE_VERSION)
+    registry.refresh(force=True)
             
             
     """Classes for storing, interpreting, and comparing key masks."""
@@ -387,6 +403,7 @@ class EVEKeyMask:
     """Base class for representing API key masks."""
     
     NULL = 0
+    kind = None  # The APICall kind whose functions this mask grants access to.
     
     def __init__(self, mask):
         self.mask = mask
@@ -402,10 +419,8 @@ class EVEKeyMask:
     def has_access(self, mask):
         if isinstance(mask, EVEKeyMask):
             mask = mask.mask
-        if self.mask & mask == mask:
-            return True
-            
-        return False
+        
+        return satisfies(self.mask, mask)
         
     def has_multiple_access(self, masks):
         for apiCall in masks:
@@ -418,20 +433,15 @@ class EVEKeyMask:
         """Counts the number of ones in the binary representation of the mask."""
         """This is equivalent to the number of functions that the key provides"""
         """access to as long as the mask is a real mask."""
-        return bin(self.mask).count('1')
+        return popcount(self.mask)
         
     def functionsAllowed(self):
         """Returns a list with the APICall object of all the functions permitted by this mask."""
         
-        funcs = []
-        if not self.functions():
-            return funcs
-            
-        for function in self.functions():
-            if self.has_access(function.mask.mask):
-                funcs.append(function)
+        if self.kind is None:
+            return []
         
-        return funcs
+        return registry.allowed(self.kind, self.mask)
     
     @staticmethod
     def functions():
@@ -441,20 +451,130 @@ class EVEKeyMask:
 class EVECharacterKeyMask(EVEKeyMask):
     """Class for comparing character key masks against the required API calls."""
     
+    kind = 'c'
+    
     def __repr__(self):
         return 'EVECharacterKeyMask({0})'.format(self.mask)
         
     @staticmethod
     def functions():
-        return APICall.objects(kind='c').order_by('mask')
+        return registry.functions('c')
     
     
 class EVECorporationKeyMask(EVEKeyMask):
     """Class for comparing corporation key masks against the required API calls."""
     
+    kind = 'o'
+    
     def __repr__(self):
         return 'EVECorporationKeyMask({0})'.format(self.mask)
         
     @staticmethod
     def functions():
-        return APICall.objects(kind='o').order_by('mask')
+        return registry.functions('o')
+
+
+class APIDefinitions(object):
+    """A snapshot of the APICall and APIGroup definitions, indexed for lookup.
+    
+    Snapshots are never modified once built; refreshing the registry replaces its snapshot with a new one.  Within a
+    snapshot the calls of each kind are ordered by mask and, for answering which functions a key mask allows, indexed
+    by the lowest bit of their own mask."""
+    
+    def __init__(self, version, calls, groups):
+        self.version = version
+        self.calls = dict((call.name, call) for call in calls)
+        self.groups = dict((group.numeric, group) for group in groups)
+        
+        functions = dict()
+        for call in sorted(self.calls.itervalues(), key=lambda call: call._mask or 0):
+            functions.setdefault(call.kind, []).append(call)
+        
+        self.functions = dict((kind, tuple(calls)) for kind, calls in functions.iteritems())
+        
+        self.bits = dict()
+        for kind, calls in self.functions.iteritems():
+            table = self.bits[kind] = dict()
+            for call in calls:
+                mask = call._mask or 0
+                table.setdefault(mask & -mask, []).append(call)
+    
+    @classmethod
+    def load(cls, version):
+        return cls(version, APICall.objects, APIGroup.objects)
+    
+    def allowed(self, kind, mask):
+        """Return the calls of the given kind which the given key mask grants access to, in order of their mask."""
+        
+        table = self.bits.get(kind)
+        if not table:
+            return []
+        
+        allowed = list(table.get(0, ()))
+        
+        for bit in bits(mask):
+            allowed.extend(call for call in table.get(bit, ()) if satisfies(mask, call._mask))
+        
+        # The table groups calls by their lowest bit, so those gathered from several bits interleave by mask.
+        allowed.sort(key=lambda call: call._mask or 0)
+        
+        return allowed
+
+
+class APIRegistry(object):
+    """The process-wide, in-memory APICall and APIGroup definitions.
+    
+    Definitions are loaded once and then only reloaded if populate_calls has run since, which is checked (with a single
+    small query) at most once every interval seconds."""
+    
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._snapshot = None
+        self._checked = 0
+        self._lock = Lock()
+    
+    @property
+    def snapshot(self):
+        snapshot = self._snapshot
+        
+        if snapshot is None or time() - self._checked > self.interval:
+            snapshot = self.refresh()
+        
+        return snapshot
+    
+    def refresh(self, force=False):
+        """Reload the definitions if they have changed, or unconditionally if forced, returning the current snapshot."""
+        
+        with self._lock:
+            snapshot = self._snapshot
+            
+            if not force and snapshot is not None and time() - self._checked <= self.interval:
+                return snapshot  # Another thread got here first.
+            
+            version = CacheVersion.current(API_CACHE_VERSION)
+            
+            if force or snapshot is None or snapshot.version != version:
+                log.info("Loading API call definitions, version %d.", version)
+                snapshot = self._snapshot = APIDefinitions.load(version)
+            
+            self._checked = time()
+            return snapshot
+    
+    def call(self, name):
+        """Return the APICall with the given name, or None."""
+        return self.snapshot.calls.get(name)
+    
+    def group(self, numeric):
+        """Return the APIGroup with the given number, or None."""
+        return self.snapshot.groups.get(numeric)
+    
+    def functions(self, kind):
+        """Return the APICalls of the given kind, ordered by mask."""
+        return self.snapshot.functions.get(kind, ())
+    
+    def allowed(self, kind, mask):
+        """Return the APICalls of the given kind permitted by the given key mask, ordered by mask."""
+        return self.snapshot.allowed(kind, mask)
+
+
+registry = APIRegistry()
@@ -1,12 +1,19 @@
-"""Imports and re-exports from evelink, setting the default cache."""
+"""Imports and re-exports from evelink, setting the default cache and routing requests through the shared pool."""
 
-import pickle
+import json
+import zlib
+import calendar
 
 import evelink
 
+from time import time
 from datetime import datetime, timedelta, tzinfo
+from xml.etree import ElementTree
 from mongoengine import Document, BinaryField, DateTimeField, StringField
 
+from brave.core.util import http
+from brave.core.util.cache import LRUCache
+
 class EvelinkAPICacheEntry(Document):
     meta = dict(
         indexes = [
@@ -25,11 +32,47 @@ class EvelinkAPICacheEntry(Document):
     value = BinaryField()
     expireAt = DateTimeField()
 
+def encode(value):
+    """Serialize a cached value as a one-byte type tag followed by the zlib-compressed data.
+
+    evelink caches raw response bodies (b); ElementTree elements (x) and anything JSON can represent (j) are supported
+    as well."""
+
+    if isinstance(value, str):
+        tag, data = b'b', value
+    elif ElementTree.iselement(value):
+        tag, data = b'x', ElementTree.tostring(value, encoding='utf-8')
+    else:
+        tag, data = b'j', json.dumps(value)
+
+    return tag + zlib.compress(data)
+
+def decode(value):
+    """Reverse encode(), returning None for anything unrecognized (such as entries pickled by older versions.)"""
+
+    value = bytes(value)
+    tag, data = value[:1], value[1:]
+
+    if tag not in (b'b', b'x', b'j'):
+        return None
+
+    data = zlib.decompress(data)
+
+    if tag == b'x':
+        return ElementTree.fromstring(data)
+
+    if tag == b'j':
+        return json.loads(data)
+
+    return data
+
 class MongoCache(evelink.api.APICache):
-    """Mongo-backed evelink APICache implementation"""
+    """Mongo-backed evelink APICache implementation, with a bounded in-memory cache in front.
+
+    Expired entries are removed by the collection's TTL index; reads simply ignore any it hasn't got to yet."""
 
-    def __init__(self):
-        pass
+    def __init__(self, maxsize=4096):
+        self.memory = LRUCache(maxsize)
 
     def get(self, key):
         """Return the value referred to by 'key' if it is cached.
@@ -37,15 +80,19 @@ class MongoCache(evelink.api.APICache):
         key:
             a string hash key
         """
-        entry = EvelinkAPICacheEntry.objects(key=key).first()
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+
+        entry = EvelinkAPICacheEntry.objects(key=key, expireAt__gt=datetime.now(utc)).scalar('value', 'expireAt')
+        entry = entry.first()
         if not entry:
             return None
-        if entry.expireAt < datetime.now(utc):
-            # Mongo's expiration isn't immediate, so we'll check the
-            # expiration time ourselves as well.
-            entry.delete()
-            return None
-        return pickle.loads(entry.value)
+
+        value = decode(entry[0])
+        if value is not None:
+            self.memory.set(key, value, calendar.timegm(entry[1].utctimetuple()) - time())
+        return value
 
     def put(self, key, value, duration):
         """Cache the provided value, referenced by 'key', for the given duration.
@@ -53,21 +100,17 @@ class MongoCache(evelink.api.APICache):
         key:
             a string hash key
         value:
-            an xml.etree.ElementTree.Element object
+            the raw response body (or an xml.etree.ElementTree.Element object)
         duration:
             a number of seconds before this cache entry should expire.
         """
-        new_entry = EvelinkAPICacheEntry(
-            key=key,
-            value=pickle.dumps(value, 2),
-            expireAt=datetime.now(utc) + timedelta(seconds=duration),
+        self.memory.set(key, value, duration)
+
+        EvelinkAPICacheEntry.objects(key=key).update_one(
+            upsert = True,
+            set__value = encode(value),
+            set__expireAt = datetime.now(utc) + timedelta(seconds=duration),
         )
-        try:
-            new_entry.save()
-        except NotUniqueError:
-            # We probably made this query twice at the same time. Hopefully CCP
-            # isn't mad at us.
-            pass
 
 # Pasted from the datetime docs, because the python 2 datetime library is an
 # embarrassment.
@@ -91,7 +134,25 @@ class UTC(tzinfo):
 
 utc = UTC()
 
-# Here, finally, is where it happens: set the default cache and re-export.
+class API(evelink.api.API):
+    """An evelink API which makes its requests through the shared, pooled brave.core.util.http session."""
+
+    def requests_request(self, full_path, params):
+        headers = {'User-Agent': self.user_agent}
+
+        if params:
+            r = http.post(full_path, data=params, headers=headers)
+        else:
+            r = http.get(full_path, headers=headers)
+
+        return r.content, r
+
+    def send_request(self, full_path, params):
+        return self.requests_request(full_path, params)
+
+# Here, finally, is where it happens: set the default cache, swap in the pooled API class (which evelink's auto_api
+# looks up at call time) and re-export.
 evelink.api.default_cache = MongoCache()
+evelink.api.API = API
 from evelink import *  # noqa
 __all__ = evelink.__all__
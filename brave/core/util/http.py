@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+"""A shared, connection-pooled HTTP client for talking to the EVE API.
+
+Every request made through post() and get() reuses one requests Session, so connections (and their TLS sessions) to
+CCP are kept alive and pooled rather than being opened anew for every call.  The pool is configured from:
+
+    core.http.pool_connections  Number of hosts to keep pools for.  (Default 4.)
+    core.http.pool_size         Connections kept open per host; should be at least the number of worker threads.
+                                (Default 16.)
+    core.http.retries           Times to retry a request whose connection failed.  (Default 2.)
+    core.http.connect_timeout   Seconds to wait for a connection.  (Default 10.)
+    core.http.timeout           Seconds to wait for a response.  (Default 60.)
+
+The time taken by each request is recorded in a per-endpoint latency histogram; see stats().
+"""
+
+from __future__ import unicode_literals
+
+from time import time
+from bisect import bisect_left
+from threading import Lock
+from urlparse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from web.core import config
+
+
+log = __import__('logging').getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets; the last bucket collects anything slower.
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_session = None
+_lock = Lock()
+
+
+class LatencyHistogram(object):
+    """Counts of request durations falling into each of BUCKETS, plus their total."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+
+    def observe(self, duration, error=False):
+        self.counts[bisect_left(BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+
+        if error:
+            self.errors += 1
+
+    def as_dict(self):
+        buckets = ['{0:g}'.format(i) for i in BUCKETS] + ['+inf']
+
+        return dict(
+                count = self.count,
+                errors = self.errors,
+                mean = self.total / self.count if self.count else 0.0,
+                buckets = dict(zip(buckets, self.counts)),
+            )
+
+
+histograms = dict()
+
+
+def session():
+    """Return the shared Session, creating it from configuration on first use."""
+
+    global _session
+
+    if _session is not None:
+        return _session
+
+    with _lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                    pool_connections = int(config.get('core.http.pool_connections', 4)),
+                    pool_maxsize = int(config.get('core.http.pool_size', 16))
+                )
+            adapter.max_retries = int(config.get('core.http.retries', 2))
+
+            s = requests.Session()
+            s.mount('https://', adapter)
+            s.mount('http://', adapter)
+            _session = s
+
+    return _session
+
+
+def timeout():
+    # requests 1.x takes a single timeout, applied to both connecting and reading.
+    return max(float(config.get('core.http.connect_timeout', 10)), float(config.get('core.http.timeout', 60)))
+
+
+def endpoint(url):
+    """The histogram a request to the given URL is counted under: its path, without the host or query string."""
+    return urlsplit(url).path
+
+
+def request(method, url, **kw):
+    """Perform a request through the shared session, recording how long it took."""
+
+    kw.setdefault('timeout', timeout())
+    started = time()
+    error = True
+
+    try:
+        response = session().request(method, url, **kw)
+        error = response.status_code >= 500
+        return response
+
+    finally:
+        duration = time() - started
+        name = endpoint(url)
+
+        with _lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = LatencyHistogram()
+
+            histogram.observe(duration, error)
+
+        log.debug("%s %s took %.3fs.", method, name, duration)
+
+
+def get(url, **kw):
+    return request('GET', url, **kw)
+
+
+def post(url, data=None, **kw):
+    return request('POST', url, data=data, **kw)
+
+
+def stats():
+    """Return the latency histogram of every endpoint requested so far, by endpoint."""
+
+    with _lock:
+        return dict((name, histogram.as_dict()) for name, histogram in histograms.iteritems())
@@ -0,0 +1,150 @@
+# encoding: utf-8
+
+"""Analysis of EVE API key access masks.
+
+A key's access mask is an integer with one bit per API call it may make; a key can make a call if every bit of the
+call's mask is set in its own.  The helpers here answer the questions asked of masks throughout the application
+without walking API call definitions or building strings:
+
+    popcount(mask)                      # How many calls a key grants, by table lookup.
+    satisfies(mask, required)           # Can a key with this mask make calls needing the required one?
+    least_permissive(pairs, required)   # Of some (item, mask) pairs, the least-permissive able to satisfy required.
+
+MaskIndex holds the masks of many keys in a compact array for bulk questions, such as which of all the keys in the
+database satisfy a given mask, or how many keys share each mask.  Work is done once per distinct mask rather than once
+per key; there are typically a few hundred distinct masks among tens of thousands of keys.
+
+The bit to API call tables live with the call definitions themselves; see brave.core.util.eve.APIRegistry.
+"""
+
+from __future__ import unicode_literals
+
+from array import array
+from itertools import compress
+from collections import Counter
+
+
+log = __import__('logging').getLogger(__name__)
+
+# The number of set bits in each 16-bit value.
+_POPCOUNT = array(b'B', [0])
+while len(_POPCOUNT) < 0x10000:
+    _POPCOUNT.extend([i + 1 for i in _POPCOUNT])
+
+# Masks are stored and compared as unsigned 32-bit values, as CCP issues them.
+_WIDTH = (1 << 32) - 1
+
+
+def popcount(mask):
+    """Return the number of set bits in the given mask; None counts as zero."""
+
+    mask = (mask or 0) & _WIDTH
+    count = 0
+
+    while mask:
+        count += _POPCOUNT[mask & 0xFFFF]
+        mask >>= 16
+
+    return count
+
+
+def satisfies(mask, required):
+    """Return True if a key with the given mask is able to make calls requiring the required mask."""
+    required = required or 0
+    return (mask or 0) & required == required
+
+
+def bits(mask):
+    """Return the individual bits set in the given mask, lowest first."""
+
+    mask = (mask or 0) & _WIDTH
+    result = []
+
+    while mask:
+        bit = mask & -mask
+        result.append(bit)
+        mask ^= bit
+
+    return result
+
+
+def least_permissive(pairs, required=None):
+    """Return the item of the least-permissive of the given (item, mask) pairs able to satisfy the required mask.
+
+    An item without a mask of its own is assumed to satisfy anything, as is every item if no mask is required.  Of
+    equally permissive items, the first wins.  Returns None if no item qualifies."""
+
+    best = best_count = None
+
+    for item, mask in pairs:
+        if required and mask and not satisfies(mask, required):
+            continue
+
+        count = popcount(mask)
+        if best_count is None or count < best_count:
+            best, best_count = item, count
+
+    return best
+
+
+class MaskIndex(object):
+    """The masks of many keys, held in an array alongside the keys' identifiers, for bulk analysis."""
+
+    def __init__(self, pairs=()):
+        self.ids = []
+        self.masks = array(b'L')
+        self._histogram = None
+
+        for identifier, mask in pairs:
+            self.add(identifier, mask)
+
+    @classmethod
+    def from_credentials(cls, credentials=None):
+        """Index the given EVECredential queryset (by default, every credential) using a single projected query."""
+
+        if credentials is None:
+            from brave.core.key.model import EVECredential
+            credentials = EVECredential.objects
+
+        return cls(credentials.scalar('id', '_mask'))
+
+    def __len__(self):
+        return len(self.masks)
+
+    def add(self, identifier, mask):
+        self.ids.append(identifier)
+        self.masks.append((mask or 0) & _WIDTH)
+        self._histogram = None
+
+    def histogram(self):
+        """Return a Counter of the number of keys with each distinct mask."""
+
+        if self._histogram is None:
+            self._histogram = Counter(self.masks)
+
+        return Counter(self._histogram)
+
+    def matching(self, required):
+        """Return the distinct masks present which satisfy the required mask."""
+        return set(mask for mask in self.histogram() if satisfies(mask, required))
+
+    def satisfying(self, required):
+        """Return the identifiers of the keys able to satisfy the required mask, in the order they were added."""
+
+        matching = self.matching(required)
+        return list(compress(self.ids, (mask in matching for mask in self.masks)))
+
+    def count(self, required):
+        """Return the number of keys able to satisfy the required mask."""
+        return sum(n for mask, n in self.histogram().iteritems() if satisfies(mask, required))
+
+    def functions(self):
+        """Return a Counter of the number of keys granting access to each individual mask bit."""
+
+        result = Counter()
+
+        for mask, n in self.histogram().iteritems():
+            for bit in bits(mask):
+                result[bit] += n
+
+        return result
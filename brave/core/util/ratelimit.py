@@ -0,0 +1,53 @@
+# encoding: utf-8
+
+"""Rate limiting helpers."""
+
+from __future__ import unicode_literals
+
+from time import time, sleep
+from threading import Lock
+
+
+log = __import__('logging').getLogger(__name__)
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket: tokens accrue at rate per second up to capacity, and each operation spends one.
+
+    This permits bursts of up to capacity operations while holding the long-run average to rate per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time()
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        """Spend tokens if they are available right now, returning whether they were."""
+
+        with self._lock:
+            self._refill(time())
+
+            if self.tokens < tokens:
+                return False
+
+            self.tokens -= tokens
+            return True
+
+    def wait_time(self, tokens=1):
+        """Return how many seconds it will be until the given number of tokens are available."""
+
+        with self._lock:
+            self._refill(time())
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def acquire(self, tokens=1):
+        """Spend tokens, blocking until they are available."""
+
+        while not self.try_acquire(tokens):
+            sleep(self.wait_time(tokens))
@@ -13,6 +13,8 @@ from web.core import config
 
 from brave.core import util
 
+log = __import__('logging').getLogger(__name__)
+
 validator_pool = ScalingPoolExecutor(5, 10, 60)
 
 
@@ -40,6 +42,14 @@ class StartupMixIn(Controller):
         
         util.mail = Mailer(config, 'mail')
         util.mail.start()
+        
+        # Load the EVE API call definitions now rather than during the first request to need them.
+        from brave.core.util.eve import registry
+        
+        try:
+            registry.refresh()
+        except:
+            log.exception("Unable to load the EVE API call definitions; they will be loaded on first use.")
 
 
 @signal(pre_save)
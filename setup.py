@@ -33,7 +33,6 @@ setup(
                 'blinker',
                 'pyyaml',
                 'ecdsa',
-                'relaxml',
                 'ipython',
                 'scrypt',
                 'pudb',
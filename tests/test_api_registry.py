@@ -0,0 +1,31 @@
+import unittest
+
+from brave.core.util.eve import APICall, APIDefinitions
+
+
+class APIDefinitionsTestCase(unittest.TestCase):
+    def setUp(self):
+        calls = [APICall(name=name, kind=kind, _mask=mask) for name, kind, mask in (
+                ('char.CharacterSheet', 'c', 8),
+                ('char.AssetList', 'c', 2),
+                ('char.Both', 'c', 10),
+                ('char.WalletJournal', 'c', 2097152),
+                ('eve.CharacterInfo', 'c', 0),
+                ('corp.AssetList', 'o', 2),
+            )]
+
+        self.definitions = APIDefinitions(1, calls, [])
+
+    def names(self, calls):
+        return [call.name for call in calls]
+
+    def test_functions(self):
+        self.assertEqual(self.names(self.definitions.functions['c']), [
+                'eve.CharacterInfo', 'char.AssetList', 'char.CharacterSheet', 'char.Both', 'char.WalletJournal'])
+
+    def test_allowed(self):
+        self.assertEqual(self.names(self.definitions.allowed('c', 2097162)), [
+                'eve.CharacterInfo', 'char.AssetList', 'char.CharacterSheet', 'char.Both', 'char.WalletJournal'])
+        self.assertEqual(self.names(self.definitions.allowed('c', 8)), ['eve.CharacterInfo', 'char.CharacterSheet'])
+        self.assertEqual(self.names(self.definitions.allowed('o', 8)), [])
+        self.assertEqual(self.names(self.definitions.allowed('a', 8)), [])
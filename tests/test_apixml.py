@@ -0,0 +1,79 @@
+import unittest
+
+from brave.core.util.apixml import parse, APIError
+
+
+RESPONSE = b"""<?xml version='1.0' encoding='UTF-8'?>
+<eveapi version="2">
+  <currentTime>2014-01-01 00:00:00</currentTime>
+  <result>%s</result>
+  <cachedUntil>2014-01-01 01:00:00</cachedUntil>
+</eveapi>"""
+
+
+class APIXMLTestCase(unittest.TestCase):
+
+    def test_values(self):
+        data = parse(RESPONSE % b"<serverOpen>True</serverOpen><onlinePlayers>123</onlinePlayers>")
+        self.assertEqual(data.cachedUntil, '2014-01-01 01:00:00')
+        self.assertEqual(data.result, dict(serverOpen=True, onlinePlayers=123))
+
+    def test_key_info(self):
+        data = parse(RESPONSE % b"""
+            <key accessMask="59638024" type="Account" expires="">
+              <rowset name="characters" key="characterID" columns="characterID,characterName,allianceID">
+                <row characterID="898901870" characterName="Desmont McCallock" allianceID="0" />
+              </rowset>
+            </key>""")
+
+        key = data.result
+        self.assertEqual(key.accessMask, 59638024)
+        self.assertEqual(key.type, 'Account')
+        self.assertEqual(key.expires, '')
+        self.assertEqual(key.characters.key, 'characterID')
+        self.assertEqual(key.characters.columns, ['characterID', 'characterName', 'allianceID'])
+        self.assertEqual(key.characters.row, [dict(characterID=898901870, characterName='Desmont McCallock',
+                                                   allianceID=0)])
+
+    def test_nested_rowsets(self):
+        data = parse(RESPONSE % b"""
+            <rowset name="alliances" key="allianceID" columns="name,allianceID">
+              <row name="Alliance, The" allianceID="1" undeclared="2">
+                <rowset name="memberCorporations" key="corporationID" columns="corporationID" />
+              </row>
+            </rowset>""")
+
+        alliance, = data.result.row
+        self.assertEqual(alliance.name, 'Alliance, The')
+        self.assertEqual(alliance.allianceID, 1)
+        self.assertEqual(alliance.undeclared, '2')
+        self.assertEqual(alliance.memberCorporations.row, [])
+        self.assertNotIn('row', alliance)
+
+    def test_text_rows(self):
+        data = parse(RESPONSE % b"""
+            <rowset name="notifications" key="notificationID" columns="notificationID">
+              <row notificationID="1">amount: 5</row>
+            </rowset>""")
+
+        self.assertEqual(data.result.row, [dict(notificationID=1, row=['amount: 5'])])
+
+        data = parse(RESPONSE % b"""
+            <rowset name="notifications" key="notificationID" columns="notificationID">
+              <row notificationID="1">amount: 5</row>
+              <row notificationID="2">isHouseWarmingGift: 1</row>
+            </rowset>""")
+
+        first, second = data.result.row
+        self.assertEqual(first.row, ['amount: 5'])
+        self.assertEqual(second.notificationID, 2)
+        self.assertEqual(second.row, ['isHouseWarmingGift: 1'])
+
+    def test_error(self):
+        body = b"""<?xml version='1.0' encoding='UTF-8'?>
+            <eveapi version="2"><error code="203">Authentication failure.</error></eveapi>"""
+
+        with self.assertRaises(APIError) as context:
+            parse(body)
+
+        self.assertEqual(context.exception.code, '203')
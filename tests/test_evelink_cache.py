@@ -1,6 +1,7 @@
 """Shamelessly cribbed from evelink's test suite and modified."""
 
 import unittest
+from xml.etree import ElementTree
 
 from brave.core.util.evelink import EvelinkAPICacheEntry, MongoCache
 
@@ -23,3 +24,17 @@ class MongoCacheTestCase(unittest.TestCase):
     def test_expire(self):
         self.cache.put('baz', 'qux', -1)
         self.assertEqual(self.cache.get('baz'), None)
+
+    def test_stored_form(self):
+        body = b"<eveapi version='2'><result><foo>bar</foo></result></eveapi>"
+        self.cache.put('body', body, 3600)
+        self.cache.put('tree', ElementTree.fromstring(body), 3600)
+
+        # Bypass the in-memory cache to read back what was stored.
+        cache = MongoCache()
+        self.assertEqual(cache.get('body'), body)
+        self.assertEqual(cache.get('tree').find('result/foo').text, 'bar')
+
+        stored = bytes(EvelinkAPICacheEntry.objects(key='body').scalar('value').first())
+        self.assertEqual(stored[:1], b'b')
+        self.assertNotIn(body, stored)
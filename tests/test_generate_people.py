@@ -0,0 +1,53 @@
+import unittest
+
+from brave.core.scripts.generate_people import Replay
+
+
+def event(action, person, kind=None, ident=None):
+    return dict(a=action, p=person, t=kind, g=ident)
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.replay = Replay()
+
+    def apply(self, *events):
+        for e in events:
+            self.replay.apply(event(*e))
+
+    def test_add_remove(self):
+        self.apply(('add', 'a', 'character', 'Alice'), ('add', 'a', 'ip', '127.0.0.1'),
+                   ('remove', 'a', 'character', 'Alice'))
+
+        self.assertEqual(self.replay.components['a']['character'], [])
+        self.assertEqual(self.replay.components['a']['ip'], ['127.0.0.1'])
+        self.assertNotIn(('character', 'Alice'), self.replay.holders)
+
+    def test_merge(self):
+        self.apply(('add', 'a', 'character', 'Alice'), ('add', 'b', 'user', 'bob'), ('merge', 'a', 'person', 'b'))
+
+        self.assertEqual(self.replay.find('b'), 'a')
+        self.assertNotIn('b', self.replay.components)
+        self.assertEqual(self.replay.components['a']['user'], ['bob'])
+        self.assertEqual(self.replay.holders[('user', 'bob')], 'a')
+
+    def test_conflict_merges(self):
+        self.apply(('add', 'a', 'character', 'Alice'), ('add', 'b', 'character', 'Alice'))
+
+        self.assertEqual(self.replay.find('a'), 'b')
+        self.assertEqual(self.replay.components['b']['character'], ['Alice'])
+
+    def test_conflict_against_recorded_merge(self):
+        # Person.merge kept a, the more complex person, even though b added the conflicting component.
+        self.apply(('add', 'a', 'character', 'Alice'), ('add', 'a', 'user', 'alice'),
+                   ('add', 'b', 'character', 'Alice'), ('merge', 'a', 'person', 'b'))
+
+        self.assertEqual(self.replay.find('b'), 'a')
+        self.assertEqual(list(self.replay.components), ['a'])
+        self.assertEqual(self.replay.components['a']['user'], ['alice'])
+        self.assertEqual(self.replay.holders[('character', 'Alice')], 'a')
+
+        # Later events for either person apply to the survivor.
+        self.apply(('remove', 'b', 'character', 'Alice'))
+        self.assertEqual(self.replay.components['a']['character'], [])
+        self.assertNotIn(('character', 'Alice'), self.replay.holders)
@@ -1,8 +1,11 @@
 import mock
 import unittest
 
-from brave.core.group.model import Group, CyclicGroupReference, GroupReferenceException
-from brave.core.group.acl import ACLRule, ACLGroupMembership
+from brave.core.account.model import User
+from brave.core.character.model import EVEEntity, EVECharacter, EVECorporation
+from brave.core.group.model import Group, GroupMembership, CyclicGroupReference, GroupReferenceException
+from brave.core.group.acl import ACLRule, ACLGroupMembership, ACLList, ACLTitle, ACLVerySecure
+from brave.core.group.compiled import CompiledGroups
 
 
 class ACLGroupMembershipTestCase(unittest.TestCase):
@@ -87,3 +90,148 @@ class ACLGroupMembershipTestCase(unittest.TestCase):
         g1_renamed = g1.rename('new_group')
 
         self.assertEqual(Group.objects(id='g2').first().rules[0].group.id, g1_renamed.id)
+
+    def test_dependency_graph(self):
+        g1 = Group(id='g1').save()
+        g2 = Group(id='g2', rules=[ACLGroupMembership(group=g1)]).save()
+        g3 = Group(id='g3', rules=[ACLGroupMembership(group=g2)], join_rules=[ACLGroupMembership(group=g1)]).save()
+
+        self.assertEqual(['g1'], Group.objects.get(id='g2')._dependencies)
+        self.assertEqual([0, 1, 2], [Group.objects.get(id=i)._rank for i in ('g1', 'g2', 'g3')])
+        self.assertEqual(set(['g2', 'g3']), set(g.id for g in g1.get_references()))
+        self.assertEqual([('g2', ['g1']), ('g3', ['g2', 'g1'])], Group.dependents('g1'))
+
+        # Nesting a new group beneath g1 pushes every dependent further down the order.
+        g0 = Group(id='g0').save()
+        g1.rules = [ACLGroupMembership(group=g0)]
+        g1.save()
+        self.assertEqual([1, 2, 3], [Group.objects.get(id=i)._rank for i in ('g1', 'g2', 'g3')])
+
+        Group.objects.update(set___dependencies=[], set___rank=0)
+        Group.rebuild_dependencies()
+        self.assertEqual([0, 1, 2, 3], [Group.objects.get(id=i)._rank for i in ('g0', 'g1', 'g2', 'g3')])
+
+
+class CompiledGroupsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.user = User(username='compiled', email='compiled@example.com').save()
+        self.corporation = EVECorporation(identifier=1001, name="Compiled Corp").save()
+        self.character = EVECharacter(identifier=2001, name="Compiled Character", corporation=self.corporation,
+                                      owner=self.user, titles=['Director']).save()
+
+    def tearDown(self):
+        Group.drop_collection()
+        GroupMembership.drop_collection()
+        EVEEntity.drop_collection()
+        User.drop_collection()
+
+    def assertMatchesEvaluate(self, groups):
+        compiled = CompiledGroups(Group.objects())
+        expected = set(g.id for g in groups if g.evaluate(self.user, self.character))
+        self.assertEqual(expected, set(g.id for g in compiled.evaluate(self.user, self.character)))
+        return expected
+
+    def test_rules(self):
+        corp = Group(id='corp', rules=[ACLList(grant=True, kind='o', ids=[1001])]).save()
+        other = Group(id='other', rules=[ACLList(grant=True, kind='o', ids=[1002])]).save()
+        title = Group(id='title', rules=[ACLTitle(grant=True, titles=['Director'])]).save()
+        denied = Group(id='denied', rules=[ACLVerySecure(grant=False, inverse=True),
+                                           ACLList(grant=True, kind='c', ids=[2001])]).save()
+
+        self.assertEqual(set(['corp', 'title']), self.assertMatchesEvaluate([corp, other, title, denied]))
+
+    def test_nested(self):
+        inner = Group(id='inner', rules=[ACLTitle(grant=True, titles=['Director'])]).save()
+        outer = Group(id='outer', rules=[ACLGroupMembership(grant=True, group=inner)]).save()
+        inverse = Group(id='inverse', rules=[ACLGroupMembership(grant=True, inverse=True, group=outer)]).save()
+
+        self.assertEqual(set(['inner', 'outer']), self.assertMatchesEvaluate([inner, outer, inverse]))
+
+    def test_join_members(self):
+        joined = Group(id='joined', join_rules=[ACLList(grant=True, kind='o', ids=[1001])],
+                       join_members=[self.character]).save()
+        lapsed = Group(id='lapsed', join_rules=[ACLList(grant=True, kind='o', ids=[1002])],
+                       join_members=[self.character]).save()
+
+        self.assertEqual(set(['joined']), self.assertMatchesEvaluate([joined, lapsed]))
+
+    def test_unowned(self):
+        Group(id='everyone', rules=[ACLList(grant=True, kind='c', ids=[2001])]).save()
+        self.character.owner = None
+        self.character.save()
+
+        self.assertEqual([], CompiledGroups(Group.objects()).evaluate(self.user, self.character))
+
+
+class GroupMembershipTestCase(unittest.TestCase):
+    def setUp(self):
+        self.user = User(username='indexed', email='indexed@example.com').save()
+        self.corporation = EVECorporation(identifier=1001, name="Indexed Corp").save()
+        self.character = EVECharacter(identifier=2001, name="Indexed Character", corporation=self.corporation,
+                                      owner=self.user, titles=['Director']).save()
+
+    def tearDown(self):
+        Group.drop_collection()
+        GroupMembership.drop_collection()
+        EVEEntity.drop_collection()
+        User.drop_collection()
+
+    def assertMembers(self, group, expected):
+        self.assertEqual(set(expected), set(c.id for c in Group.objects.get(id=group).members))
+
+    def test_group_changes(self):
+        g = Group(id='title', rules=[ACLTitle(grant=True, titles=['Director'])]).save()
+        self.assertMembers('title', [self.character.id])
+        self.assertEqual(['title'], GroupMembership.groups_for(self.character))
+
+        g.rules = [ACLTitle(grant=True, titles=['CEO'])]
+        g.save()
+        self.assertMembers('title', [])
+
+        g.delete()
+        self.assertEqual(0, GroupMembership.objects.count())
+
+    def test_character_changes(self):
+        Group(id='title', rules=[ACLTitle(grant=True, titles=['CEO'])]).save()
+        Group(id='nested', rules=[ACLGroupMembership(grant=True, group=Group.objects.get(id='title'))]).save()
+        self.assertMembers('nested', [])
+
+        self.character.titles = ['CEO']
+        self.character.save()
+        self.assertMembers('title', [self.character.id])
+        self.assertMembers('nested', [self.character.id])
+
+        self.character.owner = None
+        self.character.save()
+        self.assertEqual([], GroupMembership.groups_for(self.character))
+
+    def test_nested_propagation(self):
+        inner = Group(id='inner', rules=[ACLTitle(grant=True, titles=['CEO'])]).save()
+        middle = Group(id='middle', rules=[ACLGroupMembership(grant=True, group=inner)]).save()
+        Group(id='outer', rules=[ACLGroupMembership(grant=True, inverse=True, group=middle)]).save()
+        self.assertMembers('outer', [self.character.id])
+
+        inner.rules = [ACLTitle(grant=True, titles=['Director'])]
+        inner.save()
+        self.assertMembers('inner', [self.character.id])
+        self.assertMembers('middle', [self.character.id])
+        self.assertMembers('outer', [])
+
+    def test_join_members(self):
+        g = Group(id='joined', join_rules=[ACLList(grant=True, kind='o', ids=[1001])]).save()
+        self.assertMembers('joined', [])
+
+        g.join_members = [self.character]
+        g.save()
+        self.assertMembers('joined', [self.character.id])
+
+        g.join_members = []
+        g.save()
+        self.assertMembers('joined', [])
+
+    def test_rebuild(self):
+        Group(id='title', rules=[ACLTitle(grant=True, titles=['Director'])]).save()
+        GroupMembership.drop_collection()
+
+        GroupMembership.rebuild()
+        self.assertMembers('title', [self.character.id])
@@ -0,0 +1,42 @@
+import unittest
+
+from brave.core.util.mask import popcount, satisfies, bits, least_permissive, MaskIndex
+
+
+class MaskTestCase(unittest.TestCase):
+
+    def test_popcount(self):
+        for mask in (None, 0, 1, 8, 268435455, 4294967295, 0x8000000100):
+            self.assertEqual(popcount(mask), bin((mask or 0) & 0xFFFFFFFF).count('1'))
+
+    def test_satisfies(self):
+        self.assertTrue(satisfies(15, 8))
+        self.assertTrue(satisfies(15, 0))
+        self.assertTrue(satisfies(15, None))
+        self.assertFalse(satisfies(7, 8))
+        self.assertFalse(satisfies(None, 8))
+
+    def test_bits(self):
+        self.assertEqual(bits(0), [])
+        self.assertEqual(bits(10), [2, 8])
+
+    def test_least_permissive(self):
+        self.assertEqual(least_permissive([('full', 15), ('exact', 8)], 8), 'exact')
+        self.assertEqual(least_permissive([('full', 15), ('unknown', None)], 8), 'unknown')
+        self.assertEqual(least_permissive([('full', 15), ('also', 15)], 8), 'full')
+        self.assertIsNone(least_permissive([('narrow', 7)], 8))
+        self.assertIsNone(least_permissive([], 8))
+
+    def test_index(self):
+        index = MaskIndex([('a', 8), ('b', 15), ('c', 0), ('d', 8)])
+
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.satisfying(8), ['a', 'b', 'd'])
+        self.assertEqual(index.matching(8), set([8, 15]))
+        self.assertEqual(index.count(8), 3)
+        self.assertEqual(dict(index.histogram()), {8: 2, 15: 1, 0: 1})
+        self.assertEqual(dict(index.functions()), {1: 1, 2: 1, 4: 1, 8: 3})
+
+        index.add('e', 7)
+        self.assertEqual(index.count(4), 2)
+        self.assertEqual(index.histogram()[7], 1)
@@ -3,7 +3,10 @@ import unittest
 from brave.core.account.model import User
 from brave.core.character.model import EVECharacter
 from brave.core.permission.model import Permission, WildcardPermission
-from brave.core.group.model import Group
+from brave.core.permission.matcher import PermissionMatcher
+from brave.core.permission.util import PermissionContext
+from brave.core.group.model import Group, GroupMembership
+from brave.core.group.acl import ACLList
 
 class PermissionTest(unittest.TestCase):
     def setUp(self):
@@ -80,3 +83,86 @@ class PermissionTest(unittest.TestCase):
         self.assertEqual(set([p.id for p in g.permissions]),
                          set(['core.permission.grant',
                               '*.test']))
+
+    def test_wildcard_expansion(self):
+        self.createPermsTest()
+        self.assertEqual(set(['core.test.no']),
+                         set(p.id for p in self.createWild('core.test.*').get_permissions()))
+        self.assertEqual(set(['core.hello', 'core.test', 'core.test.no', 'core.permission.grant', 'core.*']),
+                         set(p.id for p in WildcardPermission.objects.get(id='core.*').get_permissions()))
+        self.assertEqual(set(['core.test', 'mumble.test', '*.test']),
+                         set(p.id for p in WildcardPermission.objects.get(id='*.test').get_permissions()))
+        self.assertEqual(set(['mumble.join']),
+                         set(p.id for p in self.createWild('mumble.join').get_permissions()))
+
+
+class PermissionMatcherTest(unittest.TestCase):
+    held = [WildcardPermission('core.*'), WildcardPermission('*.test'), WildcardPermission('mumble.*.join'),
+            Permission('forums.read'), Permission('forums.*.literal')]
+
+    checked = ['core', 'core.test', 'core.a.b.c', 'mumble.test', 'mumble.server.join', 'mumble.server.leave',
+               'mumble.join', 'forums.read', 'forums.read.more', 'forums.x.literal', 'forums.*.literal', '*',
+               'forums.*', '*.read', '*.*.join', 'jabber.*', 'mumble.*', 'core.*', '']
+
+    def test_grants(self):
+        matcher = PermissionMatcher(self.held)
+
+        for permission in self.checked:
+            expected = any(p.grants_permission(permission) for p in self.held)
+            self.assertEqual(expected, matcher.grants(permission), permission)
+            self.assertEqual(expected, Permission.set_grants_permission(self.held, permission), permission)
+
+    def test_granted_by(self):
+        matcher = PermissionMatcher(self.held)
+
+        for permission in self.checked:
+            expected = any(WildcardPermission(permission).grants_permission(p.id) for p in self.held)
+            self.assertEqual(expected, matcher.granted_by(permission), permission)
+
+
+class CharacterPermissionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.user = User(username='cached', email='cached@example.com').save()
+        self.character = EVECharacter(identifier=3001, name="Cached Character", owner=self.user).save()
+        Permission('core.cached').save()
+        Permission('core.grouped').save()
+
+    def tearDown(self):
+        Permission.drop_collection()
+        Group.drop_collection()
+        GroupMembership.drop_collection()
+        EVECharacter.drop_collection()
+        User.drop_collection()
+
+    def ids(self):
+        return set(p.id for p in EVECharacter.objects.get(id=self.character.id).permissions())
+
+    def test_personal_permissions(self):
+        self.assertEqual(set(), self.ids())
+
+        self.character.personal_permissions.append(Permission.objects.get(id='core.cached'))
+        self.character.save()
+        self.assertEqual(set(['core.cached']), self.ids())
+
+    def test_group_changes(self):
+        g = Group(id='cached', rules=[ACLList(grant=True, kind='c', ids=[3001])]).save()
+        self.assertEqual(set(), self.ids())
+
+        g._permissions.append(Permission.objects.get(id='core.grouped'))
+        g.save()
+        self.assertEqual(set(['core.grouped']), self.ids())
+
+        g.rules = []
+        g.save()
+        self.assertEqual(set(), self.ids())
+
+    def test_permission_context(self):
+        self.character.personal_permissions.append(Permission.objects.get(id='core.cached'))
+        self.character.save()
+
+        context = PermissionContext(User.objects.get(id=self.user.id))
+        self.assertTrue(context.has_permission('core.cached'))
+        self.assertTrue(context.has_permission('core.cached'))
+        self.assertTrue(context.has_any_permission('core.*'))
+        self.assertFalse(context.has_permission('core.grouped'))
+        self.assertEqual((1, 3), (context.hits, context.misses))
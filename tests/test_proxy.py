@@ -0,0 +1,114 @@
+import mock
+import unittest
+from datetime import datetime, timedelta
+
+from brave.core.api.model import ProxyJob
+from brave.core.api.proxy import ProxyPipeline, ProxyError
+from brave.core.util.eve import APICall, CachedAPIValue, api_cache
+from brave.core.util.ratelimit import TokenBucket
+
+
+class ProxyPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = ProxyPipeline()
+        self.application = mock.Mock(id='app', short='app')
+        self.call = mock.Mock(mask=8)
+        self.call.name = 'char.CharacterSheet'
+
+    def test_spend(self):
+        self.pipeline.quotas['app'] = bucket = TokenBucket(1, 2)
+
+        with mock.patch.object(bucket, 'try_acquire', side_effect=[True, True, False]):
+            self.pipeline.spend(self.application, self.call)
+            self.pipeline.spend(self.application, self.call)
+
+            with self.assertRaises(ProxyError) as context:
+                self.pipeline.spend(self.application, self.call)
+
+        self.assertEqual(context.exception.reason, 'quota.exceeded')
+        self.assertEqual(context.exception.response()['reason'], 'quota.exceeded')
+        self.assertEqual(self.pipeline.stats(), {'app': {'char.CharacterSheet': dict(throttled=1)}})
+
+    def test_quota_per_application(self):
+        other = mock.Mock(id='other', short='other')
+        self.pipeline.quotas['app'] = bucket = TokenBucket(1, 2)
+
+        self.assertIs(self.pipeline.quota(self.application), bucket)
+        self.assertIsNot(self.pipeline.quota(other), bucket)
+        self.assertIs(self.pipeline.quota(other), self.pipeline.quota(other))
+
+    def test_stats(self):
+        other = mock.Mock(id='other', short='other')
+
+        self.pipeline.count(self.application, 'char.CharacterSheet', 'cached')
+        self.pipeline.count(self.application, 'char.CharacterSheet', 'cached')
+        self.pipeline.count(self.application, 'char.CharacterSheet', 'upstream')
+        self.pipeline.count(self.application, 'eve.CharacterInfo', 'error')
+        self.pipeline.count(other, 'char.CharacterSheet', 'throttled')
+
+        self.assertEqual(self.pipeline.stats(), {
+                'app': {
+                    'char.CharacterSheet': dict(cached=2, upstream=1),
+                    'eve.CharacterInfo': dict(error=1),
+                },
+                'other': {'char.CharacterSheet': dict(throttled=1)},
+            })
+        self.assertEqual(self.pipeline.stats(other), {'other': {'char.CharacterSheet': dict(throttled=1)}})
+
+    def test_credential_cached(self):
+        grant = mock.Mock(id='grant')
+        character = mock.Mock()
+        character.credential_for.return_value = credential = mock.Mock()
+
+        with mock.patch('brave.core.character.model.EVECharacter') as EVECharacter:
+            EVECharacter.objects.get.return_value = character
+
+            self.assertIs(self.pipeline.credential(self.application, grant, self.call, 123), credential)
+            self.assertIs(self.pipeline.credential(self.application, grant, self.call, 123), credential)
+            self.assertEqual(EVECharacter.objects.get.call_count, 1)
+
+            # Another character is looked up on its own.
+            self.pipeline.credential(self.application, grant, self.call, 456)
+            self.assertEqual(EVECharacter.objects.get.call_count, 2)
+
+        character.credential_for.assert_called_with(8)
+
+    def test_credential_missing(self):
+        grant = mock.Mock(id='grant', characters=[mock.Mock()])
+        grant.characters[0].credential_for.return_value = None
+
+        with self.assertRaises(ProxyError) as context:
+            self.pipeline.credential(self.application, grant, self.call)
+
+        self.assertEqual(context.exception.reason, 'key.notfound')
+
+        # Failures aren't remembered.
+        grant.characters[0].credential_for.return_value = credential = mock.Mock()
+        self.assertIs(self.pipeline.credential(self.application, grant, self.call), credential)
+
+
+class DeferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = ProxyPipeline()
+        self.application = mock.Mock(id='app', short='app')
+        self.call = APICall(name='server.ServerStatus', kind='m')
+
+    def tearDown(self):
+        CachedAPIValue.objects.delete()
+        ProxyJob.objects.delete()
+        api_cache.clear()
+
+    def test_database_cached_call_answered_inline(self):
+        # Stored by another process: in the database, but not in this process's cache.
+        payload, payload_hash, cache_key = self.call._prepare((), dict())
+        CachedAPIValue(key=None, name=self.call.name, arguments=payload_hash,
+                       expires=datetime.utcnow() + timedelta(hours=1), result=dict(serverOpen=True)).save()
+
+        with mock.patch.object(self.pipeline, 'spend') as spend:
+            result, job = self.pipeline.defer(self.application, self.call, None)
+
+        self.assertIsNone(job)
+        self.assertEqual(result, dict(serverOpen=True))
+        self.assertEqual(ProxyJob.objects.count(), 0)
+        self.assertFalse(spend.called)
+        self.assertEqual(self.pipeline.stats()['app'], {'server.ServerStatus': dict(cached=1)})
@@ -0,0 +1,37 @@
+import mock
+import unittest
+
+from brave.core.util.ratelimit import TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('brave.core.util.ratelimit.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst(self):
+        bucket = TokenBucket(2, 3)
+
+        self.assertTrue(all(bucket.try_acquire() for i in range(3)))
+        self.assertFalse(bucket.try_acquire())
+        self.assertEqual(bucket.wait_time(), 0.5)
+
+    def test_refill(self):
+        bucket = TokenBucket(2, 3)
+        for i in range(3):
+            bucket.try_acquire()
+
+        self.now += 0.5
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+        # Tokens accrue no further than the capacity, however long the bucket sits unused.
+        self.now += 60
+        self.assertTrue(all(bucket.try_acquire() for i in range(3)))
+        self.assertFalse(bucket.try_acquire())
+
+    def test_default_capacity(self):
+        self.assertEqual(TokenBucket(5).capacity, 5)
+        self.assertEqual(TokenBucket(0.5).capacity, 1)
@@ -0,0 +1,138 @@
+import mock
+import unittest
+from binascii import hexlify
+from hashlib import sha256
+
+from bson import ObjectId
+from ecdsa.keys import SigningKey, VerifyingKey
+from ecdsa.curves import NIST256p
+
+from brave.core.account.model import User
+from brave.core.api.util import ServiceCache
+from brave.core.application.model import ApplicationGrant, APPLICATION_CACHE_VERSION, GRANT_CACHE_VERSION
+from brave.core.application.signal import generate_key
+
+
+def application(private=True):
+    public = SigningKey.generate(NIST256p, hashfunc=sha256).get_verifying_key()
+    key = mock.Mock(public=hexlify(public.to_string()), private=None)
+
+    if private:
+        key.private = hexlify(SigningKey.generate(NIST256p, hashfunc=sha256).to_string())
+
+    return mock.Mock(id='app', short='app', key=key)
+
+
+class ServiceCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.services = ServiceCache(interval=-1)  # Check the versions on every lookup.
+        self.stamp = ('1', '1', '1')
+
+        for name in ('CacheVersion', 'Application', 'ApplicationGrant'):
+            patcher = mock.patch('brave.core.api.util.' + name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+        self.CacheVersion.stamp.side_effect = lambda *names: self.stamp
+        self.Application.objects.get.return_value = self.application = application()
+
+        self.grant = mock.Mock()
+        self.grant.user.person.banned.return_value = False
+        self.ApplicationGrant.objects.get.return_value = self.grant
+
+    def test_application(self):
+        app, public, private = self.services.application('app')
+        self.assertIs(app, self.application)
+        self.assertIsInstance(public, VerifyingKey)
+        self.assertIsInstance(private, SigningKey)
+
+        self.assertIs(self.services.application('app')[0], app)
+        self.assertEqual(self.Application.objects.get.call_count, 1)
+
+    def test_application_awaiting_key(self):
+        self.Application.objects.get.return_value = application(private=False)
+
+        self.assertIsNone(self.services.application('app')[2])
+        self.services.application('app')
+        self.assertEqual(self.Application.objects.get.call_count, 2)
+
+    def test_grant(self):
+        self.assertEqual(self.services.grant(self.application, 'token'), (self.grant, False))
+        self.services.grant(self.application, 'token')
+        self.assertEqual(self.ApplicationGrant.objects.get.call_count, 1)
+
+    def test_grant_missing(self):
+        self.ApplicationGrant.DoesNotExist = Exception
+        self.ApplicationGrant.objects.get.side_effect = Exception
+
+        self.assertEqual(self.services.grant(self.application, 'token'), (None, False))
+
+    def test_application_changed(self):
+        self.services.application('app')
+        self.services.grant(self.application, 'token')
+
+        self.stamp = ('2', '1', '1')
+        self.services.application('app')
+        self.services.grant(self.application, 'token')
+
+        self.assertEqual(self.Application.objects.get.call_count, 2)
+        self.assertEqual(self.ApplicationGrant.objects.get.call_count, 2)
+
+    def test_grant_or_ban_changed(self):
+        self.services.application('app')
+        self.services.grant(self.application, 'token')
+
+        for stamp in (('1', '2', '1'), ('1', '2', '2')):
+            self.stamp = stamp
+            self.services.application('app')
+            self.services.grant(self.application, 'token')
+
+        self.assertEqual(self.Application.objects.get.call_count, 1)
+        self.assertEqual(self.ApplicationGrant.objects.get.call_count, 3)
+
+    def test_checked_at_interval(self):
+        self.services.interval = 60
+        self.services.application('app')
+
+        self.stamp = ('2', '2', '2')
+        self.services.application('app')
+
+        self.assertEqual(self.Application.objects.get.call_count, 1)
+        self.assertEqual(self.CacheVersion.stamp.call_count, 1)
+
+
+class ServiceCacheInvalidationTestCase(unittest.TestCase):
+    """Changes made other than by saving or deleting single documents must still bump the versions."""
+
+    def test_user_merge(self):
+        other = mock.Mock()
+
+        with mock.patch('brave.core.account.model.CacheVersion') as versions, \
+                mock.patch('brave.core.account.model.LoginHistory'), \
+                mock.patch('brave.core.group.model.Group'), \
+                mock.patch('brave.core.application.model.Application') as Application, \
+                mock.patch('brave.core.application.model.ApplicationGrant'):
+            User(username='keep').merge(other)
+
+        Application.objects.assert_called_with(owner=other)
+        versions.bump.assert_any_call(APPLICATION_CACHE_VERSION)
+        versions.bump.assert_any_call(GRANT_CACHE_VERSION)
+
+    def test_generate_key(self):
+        with mock.patch('brave.core.application.signal.CacheVersion') as versions, \
+                mock.patch('brave.core.application.model.Application'):
+            generate_key(ObjectId())
+
+        versions.bump.assert_called_with(APPLICATION_CACHE_VERSION)
+
+    def test_deauthorize(self):
+        # Deleting grants by query, as deauthorize does, runs each grant's delete signal.
+        grant = ObjectId()
+        ApplicationGrant._get_collection().insert({'_id': grant})
+        self.addCleanup(ApplicationGrant.objects(id=grant).delete)
+
+        with mock.patch('brave.core.application.model.CacheVersion') as versions:
+            ApplicationGrant.objects(id=grant).delete()
+
+        versions.bump.assert_called_with(GRANT_CACHE_VERSION)
+        self.assertEqual(ApplicationGrant.objects(id=grant).count(), 0)
@@ -0,0 +1,167 @@
+import mock
+import unittest
+
+from bson import ObjectId
+
+from brave.core.character.model import EVEAlliance, EVECorporation
+from brave.core.character.sync import Writer, AllianceSync, diff, resolve_affiliations
+
+
+class Collection(object):
+    """Enough of a pymongo collection of EVE entities, by identifier, for the sync; with no bulk API."""
+
+    def __init__(self, *docs):
+        self.docs = dict((doc['i'], dict(doc, _id=ObjectId())) for doc in docs)
+        self.updates = []
+
+    def find(self, spec, fields):
+        return [dict((k, v) for k, v in self.docs[i].items() if k in fields or k == '_id')
+                for i in spec['i']['$in'] if i in self.docs]
+
+    def update(self, spec, update, upsert=False):
+        self.updates.append((spec['i'], update, upsert))
+        doc = self.docs.get(spec['i'])
+
+        if doc is None:
+            if not upsert:
+                return
+
+            doc = self.docs[spec['i']] = dict(i=spec['i'], _id=ObjectId())
+            doc.update(update.get('$setOnInsert', {}))
+
+        doc.update(update['$set'])
+
+
+class BulkCollection(Collection):
+    """A collection with the bulk API of newer drivers."""
+
+    def __init__(self, *docs):
+        super(BulkCollection, self).__init__(*docs)
+        self.executed = []
+
+    def initialize_unordered_bulk_op(self):
+        collection = self
+        operations = []
+
+        class Operation(object):
+            def __init__(self, spec):
+                self.spec = spec
+                self.upserting = False
+
+            def upsert(self):
+                self.upserting = True
+                return self
+
+            def update_one(self, update):
+                operations.append((self.spec, update, self.upserting))
+
+        class Bulk(object):
+            def find(self, spec):
+                return Operation(spec)
+
+            def execute(self):
+                collection.executed.append(len(operations))
+                for spec, update, upsert in operations:
+                    Collection.update(collection, spec, update, upsert)
+
+        return Bulk()
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('brave.core.character.sync.CacheVersion')
+        self.CacheVersion = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_diff(self):
+        self.assertEqual(diff(dict(n='Name', e=5), dict(n='Name', e=6)), dict(e=6))
+        self.assertEqual(diff(dict(n='Name'), dict(n='Name')), dict())
+        self.assertEqual(diff(None, dict(n='Name')), dict(n='Name'))
+
+    def test_prepare(self):
+        changes = Writer.prepare(dict(n='Some Name'))
+        self.assertEqual(changes['nl'], 'some name')
+        self.assertIn('m', changes)
+
+        self.assertIsNone(Writer.prepare(dict(n=None))['nl'])
+        self.assertNotIn('nl', Writer.prepare(dict(e=5)))
+
+    def test_fallback(self):
+        collection = Collection(dict(i=1, n='Old'))
+        writer = Writer(collection)
+
+        writer.update(1, EVEAlliance, dict(n='New'))
+        writer.update(2, EVEAlliance, dict(n='Missing'))
+        writer.upsert(3, EVECorporation, dict(n='Created'))
+        writer.flush()
+
+        self.assertEqual(len(collection.updates), 3)
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(collection.docs[1]['nl'], 'new')
+        self.assertNotIn(2, collection.docs)
+        self.assertEqual(collection.docs[3]['_cls'], EVECorporation._class_name)
+        self.assertEqual(collection.updates[2][1]['$setOnInsert'], {'_cls': EVECorporation._class_name})
+        self.assertNotIn('$setOnInsert', collection.updates[0][1])
+
+        self.CacheVersion.bump.assert_any_call(EVEAlliance.cache_version())
+        self.CacheVersion.bump.assert_any_call(EVECorporation.cache_version())
+
+    def test_bulk(self):
+        collection = BulkCollection(dict(i=1, n='Old'))
+        writer = Writer(collection, batch_size=2)
+
+        writer.upsert(1, EVEAlliance, dict(n='New'))
+        writer.upsert(2, EVEAlliance, dict(n='Created'))
+        writer.update(3, EVEAlliance, dict(n='Missing'))
+        self.assertEqual(collection.executed, [2])  # The first batch filled up.
+
+        writer.flush()
+        self.assertEqual(collection.executed, [2, 1])
+        self.assertEqual(collection.docs[1]['n'], 'New')
+        self.assertEqual(collection.docs[2]['_cls'], EVEAlliance._class_name)
+        self.assertNotIn(3, collection.docs)
+
+        writer.flush()
+        self.assertEqual(collection.executed, [2, 1])
+
+    def test_resolve_affiliations(self):
+        collection = Collection(dict(i=10, n='Alliance'), dict(i=100, n='Same Corp'), dict(i=101, n='Moved Corp'))
+        collection.docs[100]['alliance'] = collection.docs[10]['_id']
+
+        affiliations = [
+                dict(corp=dict(id=100, name='Same Corp'), alliance=dict(id=10, name='Alliance')),
+                dict(corp=dict(id=101, name='Moved Corp'), alliance=dict(id=11, name='New Alliance')),
+                dict(corp=dict(id=102, name='New Corp'), alliance=None),
+                dict(corp=dict(id=102, name='New Corp')),
+            ]
+
+        corporations, alliances = resolve_affiliations(collection, Writer(collection), affiliations)
+
+        self.assertEqual(corporations, dict((i, collection.docs[i]['_id']) for i in (100, 101, 102)))
+        self.assertEqual(alliances, dict((i, collection.docs[i]['_id']) for i in (10, 11)))
+
+        # Only what differs is written, once each.
+        written = dict((i, set(update['$set']) - set(['m'])) for i, update, upsert in collection.updates)
+        self.assertEqual(written, {11: set(['n', 'nl']), 101: set(['alliance']), 102: set(['n', 'nl'])})
+        self.assertEqual(len(collection.updates), 3)
+        self.assertEqual(collection.docs[101]['alliance'], alliances[11])
+        self.assertIsNone(collection.docs[102].get('alliance'))
+
+    def test_names(self):
+        eve = mock.Mock()
+
+        def names(chunk):
+            if 13 in chunk:
+                raise Exception("Invalid ID.")
+            return mock.Mock(result=dict((i, 'Corp {0}'.format(i)) for i in chunk))
+
+        eve.character_names_from_ids.side_effect = names
+
+        with mock.patch('brave.core.character.sync.EVEEntity'):
+            sync = AllianceSync(eve)
+
+        sync.NAME_CHUNK = 4
+        result = sync.names(range(10, 20))
+
+        self.assertEqual(sorted(result), [i for i in range(10, 20) if i != 13])
+        self.assertEqual(result[12], 'Corp 12')
@@ -0,0 +1,39 @@
+import mock
+import unittest
+
+from brave.core.character.model import EVEEntity
+from brave.core.character.ticker import TickerBackfill
+
+from tests.test_sync import Collection
+
+
+class TickerBackfillTestCase(unittest.TestCase):
+    def setUp(self):
+        self.collection = Collection(dict(i=1, s='STORD'), dict(i=2), dict(i=3, s=None))
+        self.tickers = TickerBackfill()
+
+        for patcher in (mock.patch.object(EVEEntity, '_get_collection', return_value=self.collection),
+                        mock.patch('brave.core.character.sync.CacheVersion')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_backfill(self):
+        with mock.patch.object(self.tickers, 'fetch', side_effect=lambda i: 'T{0}'.format(i)) as fetch:
+            self.tickers.backfill([1, 2, 3])
+
+        # Tickers already stored, by another process say, aren't fetched again.
+        self.assertEqual([call[0][0] for call in fetch.call_args_list], [2, 3])
+        self.assertEqual([i for i, update, upsert in self.collection.updates], [2, 3])
+        self.assertEqual(self.collection.docs[2]['s'], 'T2')
+
+        self.assertEqual(self.tickers.get(1), 'STORD')
+        self.assertEqual(self.tickers.get(3), 'T3')
+        self.assertEqual(self.tickers.stats, dict(stored=1, fetched=2))
+
+    def test_failed(self):
+        with mock.patch.object(self.tickers, 'fetch', side_effect=Exception("No such corporation.")):
+            self.tickers.backfill([2])
+
+        self.assertEqual(self.collection.updates, [])
+        self.assertIn(2, self.tickers.failed)
+        self.assertFalse(self.tickers.queue(2))
@@ -0,0 +1,134 @@
+import mock
+import unittest
+from datetime import datetime, timedelta
+from requests.exceptions import HTTPError, ConnectionError
+
+from brave.core.scripts.update_keys import RefreshScheduler
+
+
+class RefreshSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2014, 1, 1)
+        self.interval = timedelta(days=1)
+        self.scheduler = RefreshScheduler(self.interval, qps=1000, retries=2, backoff=60)
+
+        patchers = dict(
+                datetime = mock.patch('brave.core.scripts.update_keys.datetime'),
+                uniform = mock.patch('brave.core.scripts.update_keys.random.uniform', return_value=1),
+                EVECredential = mock.patch('brave.core.scripts.update_keys.EVECredential'),
+                CachedAPIValue = mock.patch('brave.core.scripts.update_keys.CachedAPIValue'),
+            )
+
+        for name, patcher in patchers.items():
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+        self.datetime.utcnow.return_value = self.now
+
+        self.credential = self.EVECredential.objects.return_value.first.return_value
+        self.cached_until = self.CachedAPIValue.objects.return_value.order_by.return_value.scalar.return_value.first
+        self.cached_until.return_value = None
+
+    def queued(self):
+        return sorted(self.scheduler.queue)
+
+    def test_next_due(self):
+        self.assertEqual(self.scheduler.next_due(self.now), self.now + self.interval)
+        self.assertEqual(self.scheduler.next_due(self.now, self.now + timedelta(days=2)), self.now + timedelta(days=2))
+        self.assertEqual(self.scheduler.next_due(self.now, self.now + timedelta(hours=1)), self.now + self.interval)
+
+    def test_scheduling(self):
+        self.scheduler.schedule(1, self.now)
+        self.scheduler.attempts[1] = 2
+
+        self.assertEqual(self.scheduler.scheduled, set([1]))
+        self.assertEqual(self.queued(), [(self.now, 1)])
+
+        self.scheduler.unschedule(1)
+        self.assertEqual(self.scheduler.scheduled, set())
+        self.assertEqual(self.scheduler.attempts, dict())
+
+    def test_load(self):
+        later = self.now + timedelta(days=3)
+        self.CachedAPIValue.objects.return_value.scalar.return_value = [(1, later), (1, self.now), (None, later)]
+        self.EVECredential.objects.scalar.return_value = [(1, self.now), (2, None), (3, self.now)]
+        self.scheduler.schedule(3, self.now)
+
+        self.scheduler.load()
+
+        # Key 1 waits for its cached results to expire; key 3 was already queued.
+        self.assertEqual(self.queued(), [(self.now, 3), (self.now + self.interval, 2), (later, 1)])
+
+    def test_pull_updated(self):
+        self.cached_until.return_value = self.now + timedelta(days=2)
+        self.credential.pull.return_value = True
+
+        self.scheduler.pull(1)
+
+        self.assertEqual(self.queued(), [(self.now + timedelta(days=2), 1)])
+        self.assertEqual(self.scheduler.outcomes, dict(updated=1))
+
+    def test_pull_missing(self):
+        self.EVECredential.objects.return_value.first.return_value = None
+        self.scheduler.schedule(1, self.now)
+        self.scheduler.queue = []
+
+        self.scheduler.pull(1)
+
+        self.assertEqual(self.queued(), [])
+        self.assertNotIn(1, self.scheduler.scheduled)
+        self.assertEqual(self.scheduler.outcomes, dict(missing=1))
+
+    def test_pull_removed(self):
+        self.credential.pull.return_value = None
+
+        self.scheduler.pull(1)
+
+        self.assertEqual(self.queued(), [])
+        self.assertEqual(self.scheduler.outcomes, dict(removed=1))
+
+    def test_retry_then_fail(self):
+        self.credential.pull.side_effect = ConnectionError("Connection refused.")
+
+        self.scheduler.pull(1)
+        self.assertEqual(self.queued(), [(self.now + timedelta(seconds=60), 1)])
+        self.assertEqual(self.scheduler.attempts, {1: 1})
+
+        self.scheduler.queue = []
+        self.scheduler.pull(1)
+        self.assertEqual(self.queued(), [(self.now + timedelta(seconds=120), 1)])
+
+        # Out of retries: back to the regular schedule.
+        self.scheduler.queue = []
+        self.scheduler.pull(1)
+        self.assertEqual(self.queued(), [(self.now + self.interval, 1)])
+        self.assertEqual(self.scheduler.attempts, dict())
+        self.assertEqual(self.scheduler.outcomes, dict(retried=2, failed=1))
+
+    def test_http_errors(self):
+        def error(status):
+            e = HTTPError("{0} Error".format(status))
+            e.response = mock.Mock(status_code=status, text="")
+            return e
+
+        # Server errors are retried.
+        self.credential.pull.side_effect = error(503)
+        self.scheduler.pull(1)
+        self.assertEqual(self.queued(), [(self.now + timedelta(seconds=60), 1)])
+
+        # Anything else CCP reports won't change by asking again.
+        self.scheduler.queue = []
+        self.credential.pull.side_effect = error(403)
+        self.scheduler.pull(1)
+        self.assertEqual(self.queued(), [(self.now + self.interval, 1)])
+        self.assertEqual(self.scheduler.attempts, dict())
+        self.assertEqual(self.scheduler.outcomes, dict(retried=1, failed=1))
+
+    def test_success_clears_attempts(self):
+        self.credential.pull.side_effect = [ConnectionError("Connection refused."), True]
+
+        self.scheduler.pull(1)
+        self.scheduler.pull(1)
+
+        self.assertEqual(self.scheduler.attempts, dict())
+        self.assertEqual(self.scheduler.outcomes, dict(retried=1, updated=1))
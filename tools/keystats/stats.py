@@ -1,10 +1,10 @@
 from brave.core.character.model import EVECharacter
 from brave.core.key.model import EVECredential
+from brave.core.util.mask import MaskIndex
 import operator
 import datetime
 
 today = datetime.date.today()
-masks = {}
 masks_user = {}
 
 ages = {}
@@ -21,12 +21,13 @@ for c in EVECharacter.objects():
             continue;
         creds.add(cred)
 
+index = MaskIndex((cred.id, cred._mask) for cred in creds)
+masks = index.histogram()
+
 for cred in creds:
-    m = cred.mask.mask
-    if not m in masks:
-        masks[m] = 0
+    m = cred._mask or 0
+    if not m in masks_user:
         masks_user[m] = set()
-    masks[m] = masks[m] + 1
     if cred.owner.primary:
         masks_user[m].add(str(cred.owner.primary.name))
     else:
@@ -49,6 +50,11 @@ for keys,values in masks_sorted:
     print("Characters: {0}".format(masks_user[keys]))
     print("");
 
+print("---- API KEY MASK BIT: bit --> amount")
+for bit, amount in sorted(index.functions().items()):
+    print("{0} --> {1}".format(bit, amount))
+print("");
+
 print("---- API KEY AGE: days --> amount")
 ages_sorted = sorted(ages.items(), key=operator.itemgetter(0))
 for keys,values in ages_sorted:
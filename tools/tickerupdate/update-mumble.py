@@ -2,7 +2,6 @@ from brave.mumble.auth.model import Ticket
 from web.core import config
 from brave.api.client import API
 
-import time
 api = API(config['api.endpoint'], config['api.identity'], config['api.private'], config['api.public'])
 
 aids = set()
@@ -10,15 +9,17 @@ for t in Ticket.objects(alliance__ticker=None):
     if t.alliance.name:
         aids.add(t.alliance.id)
 
+alliances = api.lookup.alliances(','.join(str(aid) for aid in aids), only='short') if aids else None
+alliances = alliances.results if alliances and alliances.success else {}
+
 for aid in aids:
-    time.sleep(1)
     print("\nAlliance: {0}".format(aid))
-    alliance = api.lookup.alliance(aid, only='short')
-    if not alliance or not alliance.success or not alliance.short:
+    alliance = alliances.get(str(aid))
+    if not alliance or not alliance.get('success') or not alliance.get('short'):
         continue
-    print("Short: {0}".format(alliance.short))
+    print("Short: {0}".format(alliance['short']))
     for t in Ticket.objects(alliance__id=aid):
-        t.alliance.ticker = alliance.short
+        t.alliance.ticker = alliance['short']
         t.save()
 
 cids = set()
@@ -26,14 +27,16 @@ for t in Ticket.objects(corporation__ticker=None):
     if t.corporation.name:
         cids.add(t.corporation.id)
 
+corporations = api.lookup.corporations(','.join(str(cid) for cid in cids), only='short') if cids else None
+corporations = corporations.results if corporations and corporations.success else {}
+
 for cid in cids:
-    time.sleep(1)
     print("\nCorporation: {0}".format(cid))
-    corporation = api.lookup.corporation(cid, only='short')
-    if not corporation or not corporation.success or not corporation.short:
+    corporation = corporations.get(str(cid))
+    if not corporation or not corporation.get('success') or not corporation.get('short'):
         continue
-    print("Short: {0}".format(corporation.short))
+    print("Short: {0}".format(corporation['short']))
     for t in Ticket.objects(corporation__id=cid):
-        t.corporation.ticker = corporation.short
+        t.corporation.ticker = corporation['short']
         t.save()
 